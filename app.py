@@ -7,7 +7,10 @@ logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
 
 # Configure the Streamlit Web Application
 import streamlit as st
-from frontend.state import init_state
+from frontend.state import init_state, select_knowledge_base
+from server.models.embedding import warm_up_embedding_model
+from server.stores.config_store import CONFIG_STORE
+import config
 
 if __name__ == '__main__':
 
@@ -22,7 +25,12 @@ if __name__ == '__main__':
     # Corrected logo display
     st.image("frontend/images/ThinkRAG_Logo.png", use_column_width=True)
 
+    # Load the embedding model in the background on the first run of the process, later runs return at once
+    current_llm_settings = CONFIG_STORE.get(key="current_llm_settings")
+    warm_up_embedding_model(current_llm_settings["embedding_model"] if current_llm_settings else config.DEFAULT_EMBEDDING_MODEL)
+
     init_state()
+    select_knowledge_base()
 
     pages = {
         "Application" : [
@@ -0,0 +1,78 @@
+# Import-time budget check
+# Imports a module in fresh interpreters, reports the wall time and the slowest imports
+# (python -X importtime), and exits with status 1 if the best time exceeds IMPORT_TIME_BUDGET
+# or if any of DEFERRED_IMPORTS was imported, so it can gate CI.
+# Run from the project root:
+#   python -m benchmarks.import_time
+#   python -m benchmarks.import_time --module server.index --budget 3 --runs 5
+
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+from config import IMPORT_TIME_BUDGET, DEFERRED_IMPORTS
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter, prints the elapsed time and the loaded top-level packages
+CHILD_SCRIPT = """
+import sys, time, json, importlib
+start = time.perf_counter()
+importlib.import_module({module!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "modules": sorted({{name.split(".")[0] for name in sys.modules}})}}))
+"""
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)")
+
+def run_child(module: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILD_SCRIPT.format(module=module)]
+    return subprocess.run(command, cwd=PROJECT_ROOT, capture_output=True, text=True, check=True)
+
+def slowest_imports(stderr: str, top: int):
+    # (cumulative, self microseconds, module) of the imports with the largest cumulative time
+    entries = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            entries.append((int(match.group(2)), int(match.group(1)), match.group(3)))
+    entries.sort(reverse=True)
+    return entries[:top]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check the import time of a module against a budget")
+    parser.add_argument("--module", default="server.engine", help="module to import")
+    parser.add_argument("--budget", type=float, default=IMPORT_TIME_BUDGET, help="seconds")
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters, the best time is checked")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to report")
+    args = parser.parse_args()
+
+    times = []
+    modules = []
+    for _ in range(args.runs):
+        result = json.loads(run_child(args.module).stdout.strip().splitlines()[-1])
+        times.append(result["elapsed"])
+        modules = result["modules"]
+    best = min(times)
+    print(f"import {args.module}: best {best:.3f}s, runs {', '.join(f'{t:.3f}s' for t in times)}, budget {args.budget:.3f}s")
+
+    print(f"\nSlowest imports (cumulative / self, ms):")
+    for cumulative, self_time, name in slowest_imports(run_child(args.module, importtime=True).stderr, args.top):
+        print(f"  {cumulative / 1000:9.1f} {self_time / 1000:9.1f}  {name}")
+
+    failed = False
+    loaded = [name for name in DEFERRED_IMPORTS if name in modules]
+    if loaded:
+        print(f"\nFAIL: deferred modules imported eagerly: {', '.join(loaded)}")
+        failed = True
+    if best > args.budget:
+        print(f"\nFAIL: import time {best:.3f}s exceeds the budget of {args.budget:.3f}s")
+        failed = True
+    if not failed:
+        print("\nOK")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+# Benchmark of the ONNX Runtime backend
+# Compares the latency of the embedding and reranker models with PyTorch, ONNX Runtime and
+# int8 quantized ONNX Runtime, and how far the ONNX results drift from the PyTorch ones:
+# cosine similarity of the embeddings, score difference and top-k agreement of the reranker.
+# Run from the project root:
+#   python -m benchmarks.onnx_models
+#   python -m benchmarks.onnx_models --embedding-model bge-small-zh-v1.5 --texts docs.txt
+
+import os
+import time
+import argparse
+import numpy as np
+from config import EMBEDDING_MODEL_PATH, RERANKER_MODEL_PATH, DEFAULT_EMBEDDING_MODEL, DEFAULT_RERANKER_MODEL, MODEL_DIR, RERANKER_MAX_LENGTH
+from server.models.onnx_runtime import OnnxCrossEncoder, OnnxEmbedding, parse_model_entry
+
+SAMPLE_TEXTS = [
+    "检索增强生成（RAG）将检索到的文档片段作为上下文提供给大语言模型。",
+    "向量数据库保存文本块的嵌入向量，并按余弦相似度返回最相近的结果。",
+    "重排序模型对查询和候选段落逐对打分，以提高最终答案的相关性。",
+    "Streamlit 每次交互都会重新执行页面脚本。",
+    "BM25 is a ranking function based on term frequency and document length.",
+    "ONNX Runtime executes exported models on CPU with graph optimizations.",
+    "知识库支持上传 PDF、Word、Markdown 等格式的文件，也支持抓取网页内容。",
+    "量化把 float32 权重转换为 int8，减少内存占用并加快 CPU 推理。",
+]
+SAMPLE_QUERY = "如何提高检索结果的相关性？"
+
+def local_path(entry) -> str:
+    model_path, _ = parse_model_entry(entry)
+    if MODEL_DIR is not None and os.path.exists(f"./{MODEL_DIR}/{model_path}"):
+        return f"./{MODEL_DIR}/{model_path}"
+    return model_path
+
+def timed(fn, repeat: int):
+    fn() # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+def benchmark_embedding(model_path: str, texts, repeat: int):
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+    print(f"Embedding model {model_path}, {len(texts)} texts")
+    torch_model = HuggingFaceEmbedding(model_name=model_path)
+    baseline, latency = timed(lambda: np.asarray(torch_model.get_text_embedding_batch(texts)), repeat)
+    print(f"{'torch':<10} {latency:>9.1f} ms/batch")
+    for quantize in (False, True):
+        onnx_model = OnnxEmbedding(model_path, quantize=quantize)
+        embeddings, latency = timed(lambda: np.asarray(onnx_model.get_text_embedding_batch(texts)), repeat)
+        cosine = (embeddings * baseline).sum(axis=1) / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(baseline, axis=1))
+        name = "onnx-int8" if quantize else "onnx"
+        print(f"{name:<10} {latency:>9.1f} ms/batch   cosine to torch: mean {cosine.mean():.5f} min {cosine.min():.5f}")
+
+def benchmark_reranker(model_path: str, query: str, texts, repeat: int, top_k: int):
+    from sentence_transformers import CrossEncoder
+
+    print(f"Reranker model {model_path}, {len(texts)} pairs")
+    pairs = [(query, text) for text in texts]
+    torch_model = CrossEncoder(model_path, max_length=RERANKER_MAX_LENGTH)
+    torch_model.max_length = min(RERANKER_MAX_LENGTH, torch_model.tokenizer.model_max_length)
+    baseline, latency = timed(lambda: np.asarray(torch_model.predict(pairs, show_progress_bar=False)), repeat)
+    baseline_top = set(np.argsort(-baseline)[:top_k])
+    print(f"{'torch':<10} {latency:>9.1f} ms/batch")
+    for quantize in (False, True):
+        onnx_model = OnnxCrossEncoder(model_path, max_length=RERANKER_MAX_LENGTH, quantize=quantize)
+        scores, latency = timed(lambda: onnx_model.predict(pairs), repeat)
+        top_agreement = len(set(np.argsort(-scores)[:top_k]) & baseline_top) / top_k
+        name = "onnx-int8" if quantize else "onnx"
+        print(f"{name:<10} {latency:>9.1f} ms/batch   max score diff {np.abs(scores - baseline).max():.5f}   top-{top_k} agreement {top_agreement:.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--embedding-model", default=DEFAULT_EMBEDDING_MODEL, choices=list(EMBEDDING_MODEL_PATH.keys()))
+    parser.add_argument("--reranker-model", default=DEFAULT_RERANKER_MODEL, choices=list(RERANKER_MODEL_PATH.keys()))
+    parser.add_argument("--texts", help="Text file with one passage per line, sample passages if not set")
+    parser.add_argument("--query", default=SAMPLE_QUERY)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top-k", type=int, default=2)
+    args = parser.parse_args()
+
+    texts = SAMPLE_TEXTS
+    if args.texts is not None:
+        with open(args.texts, "r", encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+    benchmark_embedding(local_path(EMBEDDING_MODEL_PATH[args.embedding_model]), texts, args.repeat)
+    benchmark_reranker(local_path(RERANKER_MODEL_PATH[args.reranker_model]), args.query, texts, args.repeat, min(args.top_k, len(texts)))
+
+if __name__ == "__main__":
+    main()
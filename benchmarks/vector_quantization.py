@@ -0,0 +1,73 @@
+# Benchmark of quantized embedding search
+# Reports recall@k and query latency of the "int8" and "binary" quantization of MmapVectorStore
+# against the float32 search, with several re-scoring factors.
+# Run from the project root:
+#   python -m benchmarks.vector_quantization
+#   python -m benchmarks.vector_quantization --persist-path storage/default__vector_store.json
+
+import os
+import time
+import argparse
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from server.stores.mmap_vector_store import MmapVectorStore
+
+def synthetic_embeddings(num_vectors: int, dim: int, num_clusters: int, rng: np.random.Generator) -> np.ndarray:
+    # Clustered vectors, closer to real embeddings than uniformly random ones
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, num_clusters, num_vectors)
+    return centers[labels] + 0.5 * rng.standard_normal((num_vectors, dim)).astype(np.float32)
+
+def load_embeddings(persist_path: str) -> np.ndarray:
+    vector_store = MmapVectorStore.from_persist_path(persist_path)
+    return np.concatenate(vector_store._matrices())
+
+def build_store(embeddings: np.ndarray, quantization, rescore_factor: int) -> MmapVectorStore:
+    vector_store = MmapVectorStore(quantization=quantization, rescore_factor=rescore_factor)
+    nodes = [TextNode(id_=str(i), text="", embedding=embedding.tolist()) for i, embedding in enumerate(embeddings)]
+    vector_store.add(nodes)
+    return vector_store
+
+def run_queries(vector_store: MmapVectorStore, queries: np.ndarray, top_k: int):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        result = vector_store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k))
+        results.append(set(result.ids))
+    latency = (time.perf_counter() - start) / len(queries) * 1000
+    return results, latency
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--persist-path", help="Embeddings of a persisted vector store, synthetic embeddings if not set")
+    parser.add_argument("--num-vectors", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1024) # bge-large-zh-v1.5
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--rescore-factors", type=int, nargs="+", default=[1, 4, 10])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.persist_path is not None and os.path.exists(args.persist_path):
+        embeddings = load_embeddings(args.persist_path)
+    else:
+        embeddings = synthetic_embeddings(args.num_vectors, args.dim, num_clusters=256, rng=rng)
+    # Queries near stored vectors, like questions about a stored chunk
+    queries = embeddings[rng.integers(0, len(embeddings), args.num_queries)]
+    queries = queries + 0.3 * np.std(embeddings) * rng.standard_normal(queries.shape).astype(np.float32)
+    print(f"{len(embeddings)} vectors of dimension {embeddings.shape[1]}, {len(queries)} queries, top_k={args.top_k}")
+
+    baseline_store = build_store(embeddings, None, 1)
+    baseline, latency = run_queries(baseline_store, queries, args.top_k)
+    print(f"{'float32':<10} {'':>8} {'recall@k':>9} {1.0:>9.4f} {latency:>9.2f} ms/query {embeddings.nbytes / 2**20:>9.1f} MiB")
+    for quantization in ("int8", "binary"):
+        for rescore_factor in args.rescore_factors:
+            vector_store = build_store(embeddings, quantization, rescore_factor)
+            results, latency = run_queries(vector_store, queries, args.top_k)
+            recall = np.mean([len(result & expected) / len(expected) for result, expected in zip(results, baseline)])
+            codes_size = vector_store._codes[:vector_store._codes_len].nbytes / 2**20
+            print(f"{quantization:<10} {'x' + str(rescore_factor):>8} {'recall@k':>9} {recall:>9.4f} {latency:>9.2f} ms/query {codes_size:>9.1f} MiB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Benchmark of concurrent web fetching
+# Starts a local stub HTTP server with slow, flaky, hanging and missing pages, then fetches the same
+# pages one after another with requests.get (as the web readers did) and with WebFetcher.
+# Reports the wall time of both and checks that WebFetcher fetched every good page, retried the
+# flaky ones, gave up on the hanging and missing ones, and kept to its per-host limit.
+# Exits with status 1 if a check fails.
+# Run from the project root:
+#   python -m benchmarks.web_fetch
+#   python -m benchmarks.web_fetch --pages 500 --delay 0.1 --workers 32 --per-host 8
+
+import sys
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from server.utils.web_fetch import WebFetcher
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay: float, hang: float) -> None:
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.delay = delay
+        self.hang = hang
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.seen_flaky = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes, headers=()) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        server: StubServer = self.server
+        if self.path.startswith("/hang"):
+            # Not counted in flight: the server keeps sleeping after the client gave up
+            time.sleep(server.hang)
+            try:
+                self._send(200, b"<html>late</html>")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            if self.path.startswith("/missing"):
+                self._send(404, b"not found")
+            elif self.path.startswith("/flaky"):
+                with server.lock:
+                    first = self.path not in server.seen_flaky
+                    server.seen_flaky.add(self.path)
+                if first:
+                    self._send(503, b"busy", headers=[("Retry-After", "0")])
+                else:
+                    self._send(200, f"<html><title>{self.path}</title>recovered</html>".encode())
+            else:
+                self._send(200, f"<html><title>{self.path}</title>{'text ' * 200}</html>".encode())
+        except (BrokenPipeError, ConnectionResetError): # the client gave up
+            pass
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+def fetch_sequentially(urls, timeout):
+    ok = 0
+    for url in urls:
+        try:
+            response = requests.get(url, timeout=timeout)
+            ok += response.status_code == 200
+        except requests.RequestException:
+            pass
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--flaky", type=int, default=20, help="Pages that fail once with status 503")
+    parser.add_argument("--delay", type=float, default=0.05, help="Seconds the server takes per page")
+    parser.add_argument("--hang", type=float, default=5.0, help="Seconds the hanging page takes")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--per-host", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=1.0, help="Read timeout of a request")
+    parser.add_argument("--skip-sequential", action="store_true")
+    args = parser.parse_args()
+
+    server = StubServer(delay=args.delay, hang=args.hang)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = server.base_url
+    good_urls = [f"{base}/page/{i}" for i in range(args.pages)]
+    flaky_urls = [f"{base}/flaky/{i}" for i in range(args.flaky)]
+    bad_urls = [f"{base}/hang", f"{base}/missing"]
+    urls = bad_urls + good_urls + flaky_urls
+    print(f"{len(good_urls)} pages, {len(flaky_urls)} flaky, 1 hanging and 1 missing page, {args.delay * 1000:.0f} ms per page")
+
+    if not args.skip_sequential:
+        start = time.perf_counter()
+        ok = fetch_sequentially(bad_urls + good_urls, timeout=(1, args.timeout))
+        print(f"requests.get one by one: {ok} pages in {time.perf_counter() - start:.2f}s (flaky pages not included)")
+    server.seen_flaky.clear()
+    server.max_in_flight = 0
+
+    fetcher = WebFetcher(max_workers=args.workers, per_host=args.per_host, timeout=(1, args.timeout), total_timeout=4 * args.timeout, retries=2, backoff=0.05)
+    start = time.perf_counter()
+    results = fetcher.fetch_all(urls)
+    elapsed = time.perf_counter() - start
+    fetcher.close()
+    by_url = {result.url: result for result in results}
+    print(f"WebFetcher ({args.workers} workers, {args.per_host} per host): {sum(result.ok for result in results)} pages in {elapsed:.2f}s")
+
+    checks = {
+        "results in url order": [result.url for result in results] == urls,
+        "all good pages fetched": all(by_url[url].ok and b"text" in by_url[url].response.content for url in good_urls),
+        "flaky pages fetched on retry": all(by_url[url].ok and by_url[url].attempts == 2 for url in flaky_urls),
+        "hanging page timed out": not by_url[f"{base}/hang"].ok and by_url[f"{base}/hang"].elapsed < args.hang,
+        "missing page not retried": not by_url[f"{base}/missing"].ok and by_url[f"{base}/missing"].attempts == 1,
+        f"at most {args.per_host} requests in flight": server.max_in_flight <= args.per_host,
+    }
+    for name, passed in checks.items():
+        print(f"{'OK  ' if passed else 'FAIL'} {name}")
+    print(f"Max requests in flight: {server.max_in_flight}")
+    server.shutdown()
+    if not all(checks.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
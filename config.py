@@ -8,6 +8,11 @@ STORAGE_DIR = "storage"  # Directory to cache the generated index
 DATA_DIR = "data"        # Directory containing the documents to index
 MODEL_DIR = "localmodels"  # Directory containing the model files; set to None to use remote models
 CONFIG_STORE_FILE = "config_store.json"  # Local storage for configurations
+BM25_STORE_FILE = "bm25_index.json"  # Persisted BM25 inverted index, stored next to the storage context
+BM25_LOG_COMPACT_RATIO = 0.5  # Changes to the BM25 index are appended to bm25_index.json.log, which is compacted into bm25_index.json once larger than this fraction of it
+STORAGE_LOG_FILE = "storage_log.jsonl"  # Append-only log of changes to the local stores in development environment
+STORAGE_LOG_COMPACT_RECORDS = 50  # Compact the log into a new snapshot after this many records
+STORAGE_LOG_COMPACT_BYTES = 256 * 1024 * 1024  # or once the log is larger than this size
 
 # ===========================
 # Device Configuration
@@ -118,6 +123,40 @@ DEFAULT_CHUNK_SIZE = 2048
 DEFAULT_CHUNK_OVERLAP = 512
 ZH_TITLE_ENHANCE = False  # Enable Chinese title enhancement
 
+# ===========================
+# Ingestion Configuration
+# ===========================
+
+INGESTION_NUM_WORKERS = 1  # Number of processes used to split documents; 1 runs the pipeline serially
+# Stages run in this order before the embedding model, which always runs last.
+# Options: "split" (Settings.text_splitter), "zh_title_enhance" (Chinese title enhancement)
+INGESTION_STAGES = ["split", "zh_title_enhance"]
+
+# ===========================
+# BM25 Retrieval Configuration
+# ===========================
+
+BM25_K1 = 1.5  # Term frequency saturation
+BM25_B = 0.75  # Document length normalization
+
+# ===========================
+# Hybrid Retrieval Configuration
+# ===========================
+
+# Seconds the vector and BM25 legs of hybrid retrieval may take, a leg that takes longer is dropped
+# and the answer uses the results of the other leg
+HYBRID_RETRIEVAL_TIMEOUT = 10.0
+# Threads running the retrieval legs, shared by all queries of the process. A thread cannot be stopped, so a leg
+# that timed out keeps its thread until its backend returns: with a slow backend, at most this many legs are pending
+# and further legs wait in the queue. A leg still queued at its deadline is cancelled and never runs.
+HYBRID_RETRIEVAL_WORKERS = 16
+
+# Fusion of the vector and BM25 results, options include "reciprocal_rerank", "relative_score",
+# "dist_based_score" and "simple" (highest original score)
+HYBRID_FUSION_MODE = "dist_based_score"
+HYBRID_RETRIEVER_WEIGHTS = [0.6, 0.4]  # Weights of the vector and BM25 results
+RRF_K = 60  # Rank constant of reciprocal rank fusion
+
 # ===========================
 # Storage Configuration
 # ===========================
@@ -131,6 +170,37 @@ ES_URI = "http://localhost:9200"
 # Default vector database type, options include "es" (Elasticsearch) and "chroma"
 DEFAULT_VS_TYPE = "es"
 
+# Vector store type in development environment, options include "mmap" (memory-mapped NumPy matrix),
+# "hnsw" (approximate nearest neighbour graph, pip install hnswlib) and "simple" (JSON SimpleVectorStore)
+# An existing SimpleVectorStore file is converted when "mmap" or "hnsw" loads it
+DEV_VS_TYPE = "mmap"
+
+# Quantized embeddings of the "mmap" vector store, options include None (float32 only), "int8" and "binary"
+# The first pass of a search runs on the quantized codes in memory, then top_k * VS_RESCORE_FACTOR
+# candidates are re-scored with the float32 embeddings. See benchmarks/vector_quantization.py for recall@k
+VS_QUANTIZATION = None
+VS_RESCORE_FACTOR = 4
+
+# HNSW parameters, higher values give better recall and slower search/indexing
+HNSW_M = 16  # Number of graph neighbours per node
+HNSW_EF_CONSTRUCTION = 200  # Candidate list size when adding nodes
+HNSW_EF_SEARCH = 64  # Candidate list size when searching, hnswlib uses top_k if larger
+HNSW_FILTER_BRUTE_FORCE = 2048  # Filtered searches with at most this many candidates score them exactly instead of walking the graph
+
+# Metadata keys that queries can filter on, indexed by the local vector stores and the BM25 index
+# The derived keys file_ext (extension of file_name), url_host (host of url_source) and
+# creation_day (creation_date as a YYYYMMDD number) are added to the nodes at ingestion
+METADATA_FILTER_KEYS = [
+    "file_type", "file_name", "file_path", "file_ext",
+    "creation_date", "creation_day", "last_modified_date",
+    "url_source", "url_host",
+]
+# Vector databases (Chroma, ES, LanceDB) do not get the filters: most of them only support EQ filters, and nodes
+# ingested before the derived keys existed lack them. The vector leg fetches top_k * VECTOR_POST_FILTER_FACTOR
+# candidates and filters them locally, doubling the candidates up to VECTOR_POST_FILTER_MAX_K while too few match
+VECTOR_POST_FILTER_FACTOR = 10
+VECTOR_POST_FILTER_MAX_K = 1000
+
 # Chat store type, options include "simple" and "redis"
 DEFAULT_CHAT_STORE = "redis"
 CHAT_STORE_FILE_NAME = "chat_store.json"
@@ -150,7 +220,18 @@ DEFAULT_EMBEDDING_MODEL = "bge-small-zh-v1.5"
 EMBEDDING_MODEL_PATH = {
     "bge-small-zh-v1.5": "BAAI/bge-small-zh-v1.5",
     "bge-large-zh-v1.5": "BAAI/bge-large-zh-v1.5",
+    # Run a model with ONNX Runtime on CPU (pip install optimum[onnxruntime]), "onnx-int8" also quantizes it
+    # "bge-large-zh-v1.5-onnx": {"path": "BAAI/bge-large-zh-v1.5", "backend": "onnx-int8"},
 }
+EMBEDDING_BATCH_SIZE = 64  # Number of texts sent to the embedding model at once
+
+# Local embedding cache (SQLite, under STORAGE_DIR), used in development environment where there is no Redis ingestion cache
+EMBEDDING_CACHE_FILE = "embedding_cache.db"
+EMBEDDING_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # Least recently used embeddings are evicted above this size
+
+# In-process LRU cache of query embeddings, backed by Redis in production environment
+QUERY_EMBEDDING_CACHE_SIZE = 4096  # Maximum number of query embeddings kept in memory
+QUERY_EMBEDDING_CACHE_TTL = 7 * 24 * 3600  # Expiry in seconds of query embeddings in Redis
 
 # ===========================
 # Reranker Model Configuration
@@ -160,12 +241,26 @@ DEFAULT_RERANKER_MODEL = "bge-reranker-base"
 RERANKER_MODEL_PATH = {
     "bge-reranker-base": "BAAI/bge-reranker-base",
     "bge-reranker-large": "BAAI/bge-reranker-large",
+    # "bge-reranker-base-onnx": {"path": "BAAI/bge-reranker-base", "backend": "onnx-int8"},
 }
 
 # Use reranker model or not
 USE_RERANKER = False
 RERANKER_MODEL_TOP_N = 2
-RERANKER_MAX_LENGTH = 1024
+RERANKER_MAX_LENGTH = 1024  # Maximum tokens of a (query, passage) pair, longer pairs are truncated
+RERANKER_BATCH_SIZE = 16  # Maximum pairs per batch, pairs of similar length are batched together
+RERANKER_BATCH_TOKENS = 8192  # Maximum padded tokens per batch, fewer long pairs go in a batch
+RERANKER_SCORE_CACHE_SIZE = 10000  # Number of (query, node) scores kept to skip the model for repeated questions
+# Seconds a reranker model may stay unused before it is unloaded to free memory; None keeps models loaded
+RERANKER_IDLE_TIMEOUT = None
+
+# ===========================
+# Answer Cache Configuration
+# ===========================
+
+USE_ANSWER_CACHE = True  # Reuse answers of repeated questions
+ANSWER_CACHE_SIZE = 1000  # Maximum number of cached answers
+ANSWER_CACHE_SIMILARITY_THRESHOLD = None  # e.g. 0.95 to also reuse the answer of a query with embedding similarity above this value; None to match exact queries only
 
 # ===========================
 # Environment Configuration
@@ -179,4 +274,32 @@ DEV_MODE = THINKRAG_ENV == "development"
 # Index Manager Configuration
 # ===========================
 
-DEFAULT_INDEX_NAME = "knowledge_base"
\ No newline at end of file
+DEFAULT_INDEX_NAME = "knowledge_base"
+# Every knowledge base has its own stores: a directory under STORAGE_DIR/KB_STORAGE_SUBDIR in development
+# environment (the default knowledge base uses STORAGE_DIR itself), a Redis namespace and a vector collection in production
+KB_STORAGE_SUBDIR = "kb"
+KB_MAX_LOADED = 4  # Knowledge bases kept in memory, the least recently used one is unloaded beyond this
+KB_IDLE_TIMEOUT = None  # Seconds; unload a knowledge base unused for this long. None to keep it until evicted
+# ===========================
+# Startup Configuration
+# ===========================
+
+IMPORT_TIME_BUDGET = 2.0  # Seconds allowed for `import server.engine` in a fresh interpreter, checked by benchmarks/import_time.py and tests/test_import_time.py
+# Modules that must not be imported by `import server.engine` (or server.models.embedding), they are loaded on first use
+DEFERRED_IMPORTS = ["torch", "sentence_transformers", "transformers", "langchain", "langchain_openai", "spacy", "chromadb", "redis", "jieba"]
+
+# ===========================
+# Web Reader Configuration
+# ===========================
+
+# Web pages are fetched concurrently by server/utils/web_fetch.py, with one keep-alive session per process
+WEB_FETCH_WORKERS = 16  # Pages fetched at the same time
+WEB_FETCH_PER_HOST = 4  # Pages fetched at the same time from one host, for pages read through Jina Reader the host of the page
+WEB_FETCH_TIMEOUT = (5, 20)  # Seconds; (connect, read) timeouts of a request
+WEB_FETCH_TOTAL_TIMEOUT = 60  # Seconds; a page whose download takes longer fails, even if data keeps arriving
+WEB_FETCH_MAX_BYTES = 20 * 1024 * 1024  # Larger pages fail
+WEB_FETCH_RETRIES = 3  # Retries of a request that failed to connect, timed out or got status 429 or 5xx
+WEB_FETCH_BACKOFF = 0.5  # Seconds; the n-th retry waits about WEB_FETCH_BACKOFF * 2 ** n, or the Retry-After of the response
+WEB_FETCH_MAX_BACKOFF = 30  # Seconds; upper bound of the wait before a retry
+WEB_FETCH_USER_AGENT = "Mozilla/5.0 (compatible; ThinkRAG)"
+JINA_READER_URL = "https://r.jina.ai/"  # Jina Reader endpoint, the page URL is appended
@@ -3,10 +3,12 @@ import time
 import re
 import streamlit as st
 import pandas as pd
-from server.stores.chat_store import CHAT_MEMORY
+from server.stores.chat_store import get_chat_memory
 from llama_index.core.llms import ChatMessage, MessageRole
-from server.engine import create_query_engine
+from llama_index.core.base.response.schema import AsyncStreamingResponse
+from server.engine import get_query_engine
 from server.stores.config_store import CONFIG_STORE
+from server.utils.async_loop import iterate_async, run_coroutine
 
 def perform_query(prompt):
     if not st.session_state.query_engine:
@@ -14,7 +16,8 @@ def perform_query(prompt):
     if (not prompt) or prompt.strip() == "":
         print("Query text is required")
     try:
-        query_response = st.session_state.query_engine.query(prompt)
+        # Query through the async path on the shared event loop, the answer is streamed from it
+        query_response = run_coroutine(st.session_state.query_engine.aquery(prompt))
         return query_response
     except Exception as e:
         # print(f"An error occurred while processing the query: {e}")
@@ -44,11 +47,11 @@ def simple_format_response_and_sources(response):
 def chatbox():
 
     # Load Q&A history
-    messages = CHAT_MEMORY.get() 
+    messages = get_chat_memory().get() 
     if len(messages) == 0:
         # Initialize Q&A record
-        CHAT_MEMORY.put(ChatMessage(role=MessageRole.ASSISTANT, content="Feel free to ask about anything in the knowledge base"))
-        messages = CHAT_MEMORY.get()
+        get_chat_memory().put(ChatMessage(role=MessageRole.ASSISTANT, content="Feel free to ask about anything in the knowledge base"))
+        messages = get_chat_memory().get()
 
     # Show Q&A records
     for message in messages: 
@@ -58,7 +61,7 @@ def chatbox():
     if prompt := st.chat_input("Input your question"): # Prompt the user to input the question then add it to the message history
         with st.chat_message(MessageRole.USER):
             st.write(prompt)
-            CHAT_MEMORY.put(ChatMessage(role=MessageRole.USER, content=prompt))
+            get_chat_memory().put(ChatMessage(role=MessageRole.USER, content=prompt))
         with st.chat_message(MessageRole.ASSISTANT):
             with st.spinner("Thinking..."):
                 start_time = time.time()
@@ -68,7 +71,10 @@ def chatbox():
                 if response is None:
                     st.write("Couldn't come up with an answer.")
                 else:
-                    response_text = st.write_stream(response.response_gen)
+                    response_gen = response.response_gen
+                    if isinstance(response, AsyncStreamingResponse):
+                        response_gen = iterate_async(response_gen)
+                    response_text = st.write_stream(response_gen)
                     st.write(f"Took {query_time} second(s)")
                     details_title = f"Found {len(response.source_nodes)} document(s)"
                     with st.expander(
@@ -90,7 +96,7 @@ def chatbox():
                         df = pd.DataFrame(source_nodes)
                         st.table(df)
                     # store the answer in the chat history
-                    CHAT_MEMORY.put(ChatMessage(role=MessageRole.ASSISTANT, content=response_text))
+                    get_chat_memory().put(ChatMessage(role=MessageRole.ASSISTANT, content=response_text))
 def main():
     st.header("Query")
     if st.session_state.llm is not None:
@@ -107,14 +113,15 @@ def main():
         if st.session_state.index_manager is not None:
             if st.session_state.index_manager.check_index_exists():
                 st.session_state.index_manager.load_index()
-                st.session_state.query_engine = create_query_engine(
+                st.session_state.query_engine = get_query_engine(
                     index=st.session_state.index_manager.index, 
                     use_reranker=current_llm_settings["use_reranker"], 
                     response_mode=current_llm_settings["response_mode"], 
                     top_k=current_llm_settings["top_k"],
                     top_n=current_llm_settings["top_n"],
-                    reranker=current_llm_settings["reranker_model"])
-                print("Index loaded and query engine created")
+                    reranker=current_llm_settings["reranker_model"],
+                    bm25_index=st.session_state.index_manager.bm25_index)
+                print("Index loaded and query engine ready")
                 chatbox()
             else:
                 print("Index does not exist yet")
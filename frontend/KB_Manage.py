@@ -42,13 +42,22 @@ def get_unique_files_info(ref_doc_info):
 
     return docs
 
+# Map each file path or url to its ref docs, a file may have multiple documents (e.g. one per PDF page)
+def get_ref_doc_ids_by_path(ref_doc_info):
+    ref_doc_ids_by_path = {}
+    for ref_doc_id, ref_doc in ref_doc_info.items():
+        metadata = ref_doc.metadata
+        path = metadata.get('file_path', None) or metadata.get('url_source', None)
+        if path:
+            ref_doc_ids_by_path.setdefault(path, []).append(ref_doc_id)
+    return ref_doc_ids_by_path
+
 
 def handle_knowledgebase():
     st.header("Manage Knowledge Base")
     st.caption("Manage documents and web urls in your knowledge base.")
         
-    from server.stores.strage_context import STORAGE_CONTEXT
-    doc_store = STORAGE_CONTEXT.docstore
+    doc_store = st.session_state.index_manager.storage_context.docstore
     if len(doc_store.docs) > 0:
         ref_doc_info = doc_store.get_all_ref_doc_info()
         unique_files= get_unique_files_info(ref_doc_info)
@@ -109,16 +118,12 @@ def handle_knowledgebase():
             if delete_button:
                 print("Deleting documents...")
                 with st.spinner(text="Deleting documents and related index. It may take several minutes."):
+                    ref_doc_ids_by_path = get_ref_doc_ids_by_path(ref_doc_info)
+                    ref_doc_ids = []
                     for item in selected_docs:
                         path = df_paginated.iloc[item]['path']
-                        for ref_doc_id, ref_doc in ref_doc_info.items(): # a file may have multiple documents
-                            metadata = ref_doc.metadata
-                            file_path = metadata.get('file_path', None)
-                            if file_path: 
-                                if file_path == path:
-                                    st.session_state.index_manager.delete_ref_doc(ref_doc_id)
-                            elif metadata.get('url_source', None) == path:
-                                st.session_state.index_manager.delete_ref_doc(ref_doc_id)
+                        ref_doc_ids.extend(ref_doc_ids_by_path.get(path, []))
+                    st.session_state.index_manager.delete_ref_docs(ref_doc_ids)
                     st.toast('✔️ The selected documents are deleted.', icon='🎉')
                     time.sleep(4)
                     st.rerun()
@@ -1,8 +1,7 @@
 import streamlit as st
 from config import EMBEDDING_MODEL_PATH
 from server.stores.config_store import CONFIG_STORE
-from server.stores.strage_context import STORAGE_CONTEXT
-from server.models.embedding import create_embedding_model
+from server.models.embedding import create_embedding_model, get_query_embedding_cache_stats
 
 st.header("Embedding Model")
 st.caption("Configure embedding models",
@@ -14,7 +13,7 @@ def change_embedding_model():
     CONFIG_STORE.put(key="current_llm_settings", val=st.session_state["current_llm_settings"])
     create_embedding_model(st.session_state["current_llm_settings"]["embedding_model"])
 
-doc_store = STORAGE_CONTEXT.docstore
+doc_store = st.session_state.index_manager.storage_context.docstore
 if len(doc_store.docs) > 0:
     disabled = True
 else:
@@ -32,5 +31,7 @@ with embedding_settings:
     )
     if disabled:
         st.info("You cannot change embedding model once you add documents in the knowledge base.")
+    stats = get_query_embedding_cache_stats()
+    st.caption(f"Query embedding cache: `{stats['hits']}` hits, `{stats['misses']}` misses, hit rate `{stats['hit_rate']:.0%}`")
     st.caption("ThinkRAG supports most reranking models from `Hugging Face`. You may specify the models you want to use in the `config.py` file.")
     st.caption("It is recommended to download the models to the `localmodels` directory, in case you need run the system without an Internet connection. Plase refer to the instructions in `docs` directory.")
\ No newline at end of file
@@ -4,7 +4,7 @@ from server.models import ollama
 from server.models.llm_api import create_openai_llm, check_openai_llm
 from server.models.ollama import create_ollama_llm
 from server.models.embedding import create_embedding_model
-from server.index import IndexManager
+from server.index import IndexManager, KB_REGISTRY
 from server.stores.config_store import CONFIG_STORE
 
 def find_api_by_model(model_name):
@@ -31,9 +31,11 @@ def init_keys():
     if "llm" not in st.session_state:
         st.session_state.llm = None
 
-    # Initialize index manager
+    # Initialize the knowledge base of the session and its index manager
+    if "current_kb" not in st.session_state:
+        st.session_state.current_kb = config.DEFAULT_INDEX_NAME
     if "index_manager" not in st.session_state:
-        st.session_state.index_manager = IndexManager(config.DEFAULT_INDEX_NAME)
+        st.session_state.index_manager = IndexManager(st.session_state.current_kb)
 
     # Initialize Ollama API URL
     if "ollama_api_url" not in st.session_state:
@@ -296,6 +298,40 @@ def create_llm_instance():
         print("No current LLM information found.")
         st.session_state.llm = None
 
+# Switch the knowledge base of the session, a new name creates an empty knowledge base
+def change_knowledge_base(kb_name):
+    """
+    Points the session's index manager to another knowledge base.
+    """
+    try:
+        index_manager = IndexManager(kb_name)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    st.session_state.index_manager = index_manager
+    st.session_state.current_kb = kb_name
+
+def select_knowledge_base():
+    """
+    Renders the knowledge base selector in the sidebar.
+    """
+    def on_select():
+        change_knowledge_base(st.session_state.kb_selected)
+
+    def on_create():
+        kb_name = st.session_state.kb_new.strip()
+        if kb_name:
+            change_knowledge_base(kb_name)
+        st.session_state.kb_new = ""
+
+    with st.sidebar:
+        kb_names = KB_REGISTRY.names()
+        if st.session_state.current_kb not in kb_names: # created but not loaded yet
+            kb_names.append(st.session_state.current_kb)
+        st.session_state.kb_selected = st.session_state.current_kb
+        st.selectbox("Knowledge base", kb_names, key="kb_selected", on_change=on_select)
+        st.text_input("New knowledge base", key="kb_new", on_change=on_create, placeholder="Name, e.g. team_docs")
+
 # Initialize the entire session state
 def init_state():
     """
@@ -0,0 +1,233 @@
+# Headless HTTP query service
+# An ASGI application exposing the query engine and the ingestion pipeline without Streamlit,
+# so that it can be load-balanced and benchmarked. Every worker process creates the models and
+# loads the default knowledge base once at startup and serves all requests with them. Other
+# knowledge bases, selected by the knowledge_base field of a request, are loaded on first use.
+#
+# Run (from the project root):
+#   uvicorn server.api:app --host 0.0.0.0 --port 8000 --workers 4
+#
+# The development environment keeps the stores in local files, run a single worker there.
+# With several workers, send /ingest to one of them: other workers see the new nodes through
+# the shared Redis/vector stores, but their BM25 index is updated on restart.
+
+# Install FastAPI, Uvicorn and python-multipart (file uploads)
+""" pip install fastapi uvicorn python-multipart """
+
+import os
+import json
+import shutil
+import asyncio
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from llama_index.core import Settings
+from llama_index.core.base.response.schema import AsyncStreamingResponse
+import config
+from server.engine import get_query_engine
+from server.index import IndexManager, KB_REGISTRY
+from server.models.embedding import create_embedding_model, warm_up_embedding_model
+from server.models.llm_api import create_openai_llm
+from server.models.ollama import create_ollama_llm
+from server.stores.config_store import CONFIG_STORE
+from server.stores.metadata_index import build_metadata_filters
+from server.utils.file import get_save_dir
+
+class QueryFilters(BaseModel):
+    # Restrict the retrieved nodes, all given restrictions must match
+    file_types: Optional[List[str]] = None # file extensions, e.g. ["pdf", "docx"]
+    file_path_prefix: Optional[str] = None
+    created_after: Optional[str] = None # inclusive ISO dates, e.g. "2024-01-31"
+    created_before: Optional[str] = None
+    url_hosts: Optional[List[str]] = None # hosts of web pages, e.g. ["docs.python.org"]
+
+class QueryRequest(BaseModel):
+    query: str
+    stream: bool = True
+    knowledge_base: str = config.DEFAULT_INDEX_NAME
+    filters: Optional[QueryFilters] = None
+
+def current_llm_settings() -> dict:
+    # Settings saved by the Streamlit pages, or the defaults of config.py
+    return CONFIG_STORE.get(key="current_llm_settings") or {
+        "temperature": config.TEMPERATURE,
+        "system_prompt": config.SYSTEM_PROMPT,
+        "top_k": config.TOP_K,
+        "response_mode": config.DEFAULT_RESPONSE_MODE,
+        "use_reranker": config.USE_RERANKER,
+        "top_n": config.RERANKER_MODEL_TOP_N,
+        "embedding_model": config.DEFAULT_EMBEDDING_MODEL,
+        "reranker_model": config.DEFAULT_RERANKER_MODEL,
+    }
+
+def create_llm():
+    """Create the LLM selected in the Streamlit LLM page (current_llm_info in CONFIG_STORE)."""
+    current_llm_info = CONFIG_STORE.get(key="current_llm_info")
+    if current_llm_info is None:
+        print("No current LLM information found.")
+        return None
+    settings = current_llm_settings()
+    if current_llm_info["service_provider"] == "Ollama":
+        ollama_api_url = CONFIG_STORE.get(key="Ollama_api_url")
+        return create_ollama_llm(
+            model=current_llm_info["model"],
+            temperature=settings["temperature"],
+            system_prompt=settings["system_prompt"],
+            base_url=ollama_api_url["Ollama_api_url"] if ollama_api_url else config.OLLAMA_API_URL,
+        )
+    if not current_llm_info.get("api_key_valid", False):
+        print("API key is invalid when creating LLM instance")
+        return None
+    return create_openai_llm(
+        model_name=current_llm_info["model"],
+        api_base=current_llm_info["api_base"],
+        api_key=current_llm_info["api_key"],
+        temperature=settings["temperature"],
+        system_prompt=settings["system_prompt"],
+    )
+
+_INGEST_LOCK = asyncio.Lock() # IndexManager mutations run one at a time
+
+def get_index_manager(kb_name: str) -> IndexManager:
+    # Knowledge bases are loaded by KB_REGISTRY on first use and shared by all requests of the worker
+    try:
+        return IndexManager(kb_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def get_engine(kb_name: str = config.DEFAULT_INDEX_NAME, filters: Optional[QueryFilters] = None):
+    if Settings.llm is None:
+        raise HTTPException(status_code=503, detail="LLM is not configured")
+    index_manager = get_index_manager(kb_name)
+    if not index_manager.check_index_exists():
+        raise HTTPException(status_code=404, detail=f"The knowledge base {kb_name} is empty")
+    index_manager.load_index()
+    try:
+        metadata_filters = build_metadata_filters(**filters.model_dump()) if filters is not None else None
+    except ValueError as e: # invalid date
+        raise HTTPException(status_code=400, detail=f"Invalid filters: {e}")
+    settings = current_llm_settings()
+    return get_query_engine(
+        index=index_manager.index,
+        bm25_index=index_manager.bm25_index,
+        filters=metadata_filters,
+        use_reranker=settings["use_reranker"],
+        response_mode=settings["response_mode"],
+        top_k=settings["top_k"],
+        top_n=settings["top_n"],
+        reranker=settings["reranker_model"],
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up the worker: models, index and query engine are created before the first request
+    create_embedding_model(current_llm_settings()["embedding_model"])
+    warm_up_embedding_model(current_llm_settings()["embedding_model"])
+    create_llm()
+    # Only the default knowledge base is loaded up front, others are loaded by their first request
+    if Settings.llm is not None and IndexManager(config.DEFAULT_INDEX_NAME).check_index_exists():
+        get_engine()
+    yield
+
+app = FastAPI(title="ThinkRAG", lifespan=lifespan)
+
+def format_source_nodes(source_nodes) -> List[dict]:
+    sources = []
+    for item in source_nodes:
+        metadata = item.node.metadata
+        sources.append({
+            "node_id": item.node.node_id,
+            "score": item.score,
+            "file": metadata.get("file_name"),
+            "title": metadata.get("title"), # if the document is a webpage
+            "page": metadata.get("page_label"),
+            "text": item.node.get_content(),
+        })
+    return sources
+
+def sse_event(event: str, data) -> str:
+    # Data is JSON encoded, so newlines in tokens do not end the event
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/health")
+async def health():
+    return {
+        "llm": Settings.llm is not None,
+        "embed_model": Settings.embed_model is not None,
+        "knowledge_bases": KB_REGISTRY.loaded(),
+    }
+
+@app.get("/knowledge_bases")
+async def knowledge_bases():
+    return {"knowledge_bases": KB_REGISTRY.names(), "loaded": KB_REGISTRY.loaded()}
+
+@app.post("/query")
+async def query(request: QueryRequest):
+    """Answer a query. With stream (default), the answer is sent as server-sent events:
+    "sources" with the source nodes, then one "token" event per token and a final "done"."""
+    if request.query.strip() == "":
+        raise HTTPException(status_code=400, detail="Query text is required")
+    # Loading a knowledge base reads its stores, keep it off the event loop
+    query_engine = await asyncio.get_running_loop().run_in_executor(None, get_engine, request.knowledge_base, request.filters)
+    response = await query_engine.aquery(request.query)
+    sources = format_source_nodes(response.source_nodes)
+
+    async def tokens():
+        if isinstance(response, AsyncStreamingResponse):
+            async for token in response.response_gen:
+                yield token
+        elif hasattr(response, "response_gen"): # StreamingResponse
+            for token in response.response_gen:
+                yield token
+        else:
+            yield str(response)
+
+    if not request.stream:
+        answer = "".join([token async for token in tokens()])
+        return JSONResponse({"response": answer, "sources": sources})
+
+    async def events():
+        yield sse_event("sources", sources)
+        try:
+            async for token in tokens():
+                yield sse_event("token", token)
+        except Exception as e:
+            yield sse_event("error", f"{type(e).__name__}: {e}")
+            return
+        yield sse_event("done", None)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/ingest")
+async def ingest(
+    files: List[UploadFile] = File(default=[]),
+    websites: List[str] = Form(default=[]),
+    chunk_size: int = Form(default=config.DEFAULT_CHUNK_SIZE),
+    chunk_overlap: int = Form(default=config.DEFAULT_CHUNK_OVERLAP),
+    knowledge_base: str = Form(default=config.DEFAULT_INDEX_NAME),
+):
+    """Add uploaded files and web pages to a knowledge base (multipart form), a new name creates it."""
+    if len(files) == 0 and len(websites) == 0:
+        raise HTTPException(status_code=400, detail="No files or websites to ingest")
+    index_manager = get_index_manager(knowledge_base)
+    save_dir = get_save_dir()
+    os.makedirs(save_dir, exist_ok=True)
+    uploaded_files = []
+    for file in files:
+        name = os.path.basename(file.filename) # no directories from the client
+        with open(os.path.join(save_dir, name), "wb") as f:
+            shutil.copyfileobj(file.file, f)
+        uploaded_files.append({"name": name})
+    loop = asyncio.get_running_loop()
+    num_nodes = 0
+    async with _INGEST_LOCK:
+        # Ingestion is CPU bound, run it in a thread so queries are still served
+        if len(uploaded_files) > 0:
+            nodes = await loop.run_in_executor(None, index_manager.load_files, uploaded_files, chunk_size, chunk_overlap)
+            num_nodes += len(nodes)
+        if len(websites) > 0:
+            nodes = await loop.run_in_executor(None, index_manager.load_websites, websites, chunk_size, chunk_overlap)
+            num_nodes += len(nodes)
+    return {"knowledge_base": knowledge_base, "files": [file["name"] for file in uploaded_files], "websites": websites, "nodes": num_nodes}
@@ -1,22 +1,47 @@
 # Create and manage query/chat engine
+import asyncio
+import hashlib
+import functools
+import threading
 import config as config
+from llama_index.core import Settings
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import AsyncStreamingResponse, Response, StreamingResponse
+from llama_index.core.schema import NodeWithScore
 from server.models.reranker import create_reranker_model
 from server.prompt import text_qa_template, refine_template
-from server.retriever import SimpleFusionRetriever
+from server.retriever import RETRIEVAL_LATENCIES, SimpleFusionRetriever, get_existing_nodes, retrieval_degraded
+from server.stores.config_store import CONFIG_STORE
+from server.stores.answer_cache import ANSWER_CACHE, CachedAnswer
+from server.stores.metadata_index import filters_key
 from llama_index.core.query_engine import RetrieverQueryEngine
 
+# Retriever query engine whose async path keeps the node postprocessors off the event loop
+class SimpleRetrieverQueryEngine(RetrieverQueryEngine):
+    async def aretrieve(self, query_bundle):
+        nodes = await self._retriever.aretrieve(query_bundle)
+        if len(self._node_postprocessors) == 0:
+            return nodes
+        # Rerankers are synchronous models, run them in a thread so other queries proceed meanwhile
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self._apply_node_postprocessors, nodes, query_bundle=query_bundle)
+        )
+
 # Create a query engine
 def create_query_engine(index, 
                         top_k=config.TOP_K, 
                         response_mode=config.RESPONSE_MODE, 
                         use_reranker=config.USE_RERANKER, 
                         top_n=config.RERANKER_MODEL_TOP_N, 
-                        reranker=config.DEFAULT_RERANKER_MODEL):
+                        reranker=config.DEFAULT_RERANKER_MODEL,
+                        bm25_index=None,
+                        filters=None):
     # Customized query engine with hybrid search and reranker
+    # filters (MetadataFilters) restrict the nodes both retrievers search
     node_postprocessors = [create_reranker_model(model_name=reranker, top_n=top_n)] if use_reranker else []
-    retriever = SimpleFusionRetriever(vector_index=index, top_k=top_k)
+    retriever = SimpleFusionRetriever(vector_index=index, top_k=top_k, bm25_index=bm25_index, filters=filters)
 
-    query_engine = RetrieverQueryEngine.from_args(
+    query_engine = SimpleRetrieverQueryEngine.from_args(
         retriever=retriever,
         text_qa_template=text_qa_template,
         refine_template=refine_template,
@@ -27,3 +52,170 @@ def create_query_engine(index,
     )
 
     return query_engine
+
+# Query engine with an answer cache
+# A cached answer is returned as a StreamingResponse (AsyncStreamingResponse from aquery), like
+# the wrapped engine's answers, with its source nodes read back from the docstore.
+
+class CachedQueryEngine(BaseQueryEngine):
+    def __init__(self, query_engine, docstore, settings_key, answer_cache=ANSWER_CACHE):
+        self._query_engine = query_engine
+        self._docstore = docstore
+        self._settings_key = settings_key
+        self._answer_cache = answer_cache
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self):
+        return {"query_engine": self._query_engine}
+
+    def _query_embedding(self, query_str):
+        if self._answer_cache.similarity_threshold is None or Settings.embed_model is None:
+            return None
+        return Settings.embed_model.get_query_embedding(query_str) # served by the query embedding cache
+
+    async def _aquery_embedding(self, query_str):
+        if self._answer_cache.similarity_threshold is None or Settings.embed_model is None:
+            return None
+        return await Settings.embed_model.aget_query_embedding(query_str)
+
+    def _lookup(self, query_str, embedding, use_async=False):
+        entry = self._answer_cache.get(self._settings_key, query_str, embedding=embedding)
+        if entry is None:
+            return None
+        nodes = get_existing_nodes(self._docstore, [node_id for node_id, _ in entry.sources])
+        if any(node is None for node in nodes):
+            return None # a source node is gone, answer again
+        print(f"Answer cache hit: {query_str}")
+        source_nodes = [NodeWithScore(node=node, score=score) for node, (_, score) in zip(nodes, entry.sources)]
+        if use_async:
+            async def answer_gen():
+                yield entry.answer
+            return AsyncStreamingResponse(response_gen=answer_gen(), source_nodes=source_nodes)
+        return StreamingResponse(response_gen=iter([entry.answer]), source_nodes=source_nodes)
+
+    def _record(self, query_str, embedding, response):
+        # An answer from a retrieval that dropped a leg is returned but not cached, the next query retries
+        if retrieval_degraded():
+            print(f"Answer not cached, a retrieval leg was dropped: {query_str}")
+            return response
+        sources = [(n.node.node_id, n.score) for n in response.source_nodes]
+        ref_doc_ids = {n.node.ref_doc_id for n in response.source_nodes if n.node.ref_doc_id is not None}
+
+        def put(answer):
+            if answer:
+                self._answer_cache.put(CachedAnswer(
+                    query=query_str, answer=answer, sources=sources, ref_doc_ids=ref_doc_ids,
+                    settings_key=self._settings_key, embedding=embedding,
+                ))
+
+        if isinstance(response, StreamingResponse):
+            # Store the answer once it has been streamed completely
+            response_gen = response.response_gen
+            def recording_gen():
+                tokens = []
+                for token in response_gen:
+                    tokens.append(token)
+                    yield token
+                put("".join(tokens))
+            response.response_gen = recording_gen()
+        elif isinstance(response, AsyncStreamingResponse):
+            async_response_gen = response.response_gen
+            async def async_recording_gen():
+                tokens = []
+                async for token in async_response_gen:
+                    tokens.append(token)
+                    yield token
+                put("".join(tokens))
+            response.response_gen = async_recording_gen()
+        elif isinstance(response, Response):
+            put(response.response)
+        return response
+
+    def _query(self, query_bundle):
+        embedding = self._query_embedding(query_bundle.query_str)
+        response = self._lookup(query_bundle.query_str, embedding)
+        if response is None:
+            RETRIEVAL_LATENCIES.set(None) # set by the retrieval of this query
+            response = self._query_engine.query(query_bundle)
+            response = self._record(query_bundle.query_str, embedding, response)
+        return response
+
+    async def _aquery(self, query_bundle):
+        embedding = await self._aquery_embedding(query_bundle.query_str)
+        response = self._lookup(query_bundle.query_str, embedding, use_async=True)
+        if response is None:
+            RETRIEVAL_LATENCIES.set(None)
+            response = await self._query_engine.aquery(query_bundle)
+            response = self._record(query_bundle.query_str, embedding, response)
+        return response
+
+# Process-wide registry of warm query engines
+# An engine is reused across sessions and Streamlit reruns as long as the index and the
+# retrieval settings are the same. IndexManager invalidates the engines of an index when
+# it is mutated, and any change in CONFIG_STORE drops all engines.
+
+_ENGINE_CACHE = {}
+_ENGINE_LOCK = threading.Lock()
+_config_version = CONFIG_STORE.version
+
+def _llm_identity(llm):
+    # Identify the LLM by its settings, since a new but equivalent LLM object is created on every rerun
+    if llm is None:
+        return None
+    inner = getattr(llm, "_llm", None) # LangChainLLM wraps a LangChain chat model
+    return (
+        llm.class_name(),
+        llm.metadata.model_name,
+        getattr(llm, "base_url", None) or getattr(inner, "openai_api_base", None),
+        getattr(llm, "temperature", getattr(inner, "temperature", None)),
+        llm.system_prompt,
+    )
+
+def get_query_engine(index,
+                     top_k=config.TOP_K,
+                     response_mode=config.DEFAULT_RESPONSE_MODE,
+                     use_reranker=config.USE_RERANKER,
+                     top_n=config.RERANKER_MODEL_TOP_N,
+                     reranker=config.DEFAULT_RERANKER_MODEL,
+                     bm25_index=None,
+                     filters=None):
+    # bm25_index is the BM25 index of the index's knowledge base
+    # Engines with different metadata filters are cached separately, and so are their answers
+    global _config_version
+    key = (
+        index.index_id,
+        top_k,
+        response_mode,
+        reranker if use_reranker else None,
+        top_n if use_reranker else None,
+        _llm_identity(Settings.llm),
+        filters_key(filters),
+    )
+    with _ENGINE_LOCK:
+        if _config_version != CONFIG_STORE.version:
+            _ENGINE_CACHE.clear()
+            ANSWER_CACHE.clear() # e.g. the system prompt changed
+            _config_version = CONFIG_STORE.version
+        query_engine = _ENGINE_CACHE.get(key)
+        if query_engine is None:
+            query_engine = create_query_engine(index,
+                                               top_k=top_k,
+                                               response_mode=response_mode,
+                                               use_reranker=use_reranker,
+                                               top_n=top_n,
+                                               reranker=reranker,
+                                               bm25_index=bm25_index,
+                                               filters=filters)
+            if config.USE_ANSWER_CACHE:
+                settings_key = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+                query_engine = CachedQueryEngine(query_engine, docstore=index.docstore, settings_key=settings_key)
+            _ENGINE_CACHE[key] = query_engine
+            print(f"Created query engine for index {index.index_id}")
+        return query_engine
+
+def invalidate_query_engines(index_id=None):
+    # Drop the cached engines of an index, or all engines if index_id is None
+    with _ENGINE_LOCK:
+        for key in list(_ENGINE_CACHE.keys()):
+            if index_id is None or key[0] == index_id:
+                del _ENGINE_CACHE[key]
@@ -1,55 +1,267 @@
 # Index management - create, load and insert
 import os
+import gc
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
 from llama_index.core import Settings, StorageContext, VectorStoreIndex
-from llama_index.core import load_index_from_storage, load_indices_from_storage
+from llama_index.core import load_index_from_storage
 from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
 from server.utils.file import get_save_dir
-from server.stores.strage_context import STORAGE_CONTEXT
+from server.stores.strage_context import check_kb_name, create_storage, kb_persist_dir, list_kb_names
+from server.stores.storage_log import remove_ref_docs
+from server.stores.bm25_store import BM25Index
+from server.stores.answer_cache import ANSWER_CACHE
 from server.ingestion import AdvancedIngestionPipeline
-from config import DEV_MODE
+from server.engine import invalidate_query_engines
+from config import DEV_MODE, BM25_STORE_FILE, KB_MAX_LOADED, KB_IDLE_TIMEOUT
+
+def list_index_ids(storage_context: StorageContext) -> List[str]:
+    # Index manifest: read the index ids from the index store without deserializing the index structs
+    index_store = storage_context.index_store
+    kvstore = index_store._kvstore
+    redis_client = getattr(kvstore, "_redis_client", None)
+    if redis_client is not None: # RedisIndexStore: only fetch the hash keys
+        return [key.decode() if isinstance(key, bytes) else key for key in redis_client.hkeys(index_store._collection)]
+    return list(kvstore.get_all(collection=index_store._collection).keys())
+
+class KnowledgeBase:
+    """Storage context, storage log, BM25 index and loaded index of one knowledge base.
+
+    lock is held while the knowledge base is changed or its index is loaded. A knowledge
+    base is only unloaded when its lock is free, and is marked unloaded so that a manager
+    holding it loads it again instead of changing stores that are no longer used.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.storage_context, self.storage_log = create_storage(name)
+        self.bm25_index = BM25Index.from_persist_path(os.path.join(kb_persist_dir(name), BM25_STORE_FILE))
+        self.index: Optional[VectorStoreIndex] = None
+        self.lock = threading.RLock()
+        self.unloaded = False
+        self._index_metadata()
+
+    def _index_metadata(self) -> None:
+        # Stores persisted before they kept metadata cannot filter, index the metadata of the docstore nodes once
+        vector_store = self.storage_context.vector_store
+        # Vector databases are not indexed, the vector leg filters their results instead
+        vector_store_complete = getattr(vector_store, "metadata_complete", True)
+        if vector_store_complete and self.bm25_index.metadata_complete:
+            return
+        nodes = list(self.storage_context.docstore.docs.values())
+        if not self.bm25_index.metadata_complete:
+            self.bm25_index.index_metadata(nodes)
+            self.bm25_index.persist()
+        if not vector_store_complete:
+            vector_store.index_metadata(nodes)
+            if self.storage_log is not None:
+                self.storage_log.compact() # writes the snapshot with the metadata
+        print(f"Indexed the metadata of knowledge base {self.name} for filtering")
+
+class KnowledgeBaseRegistry:
+    """Knowledge bases of the process, loaded on first use and shared by all sessions.
+
+    At most max_loaded knowledge bases are kept in memory, beyond that the least recently used
+    one is unloaded. With idle_timeout (seconds), a knowledge base unused for that long is
+    unloaded by a background thread. Unloading only drops memory: the data stays in the
+    storage directory (storage log included) or in Redis and the vector database.
+    """
+
+    def __init__(self, max_loaded: int = KB_MAX_LOADED, idle_timeout: Optional[float] = KB_IDLE_TIMEOUT) -> None:
+        self.max_loaded = max_loaded
+        self.idle_timeout = idle_timeout
+        self._kbs: "OrderedDict[str, KnowledgeBase]" = OrderedDict() # least recently used first
+        self._last_used: Dict[str, float] = {}
+        self._lock = threading.Lock() # also held while loading, so a knowledge base is never loaded twice
+        self._reaper: Optional[threading.Thread] = None
+
+    def get(self, name: str) -> KnowledgeBase:
+        check_kb_name(name)
+        with self._lock:
+            kb = self._kbs.get(name)
+            if kb is None:
+                kb = KnowledgeBase(name)
+                self._kbs[name] = kb
+                print(f"Loaded knowledge base {name}")
+                self._start_reaper()
+            self._kbs.move_to_end(name)
+            self._last_used[name] = time.monotonic()
+            unloaded = self._evict([other for other in self._kbs if other != name][:max(0, len(self._kbs) - self.max_loaded)])
+        self._release(unloaded)
+        return kb
+
+    def names(self) -> List[str]:
+        # Loaded or not
+        return list_kb_names()
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._kbs.keys())
+
+    def _evict(self, names: List[str]) -> List[KnowledgeBase]:
+        # Called with _lock held, knowledge bases being changed are skipped
+        unloaded = []
+        for name in names:
+            kb = self._kbs[name]
+            if not kb.lock.acquire(blocking=False):
+                continue
+            try:
+                kb.unloaded = True
+                del self._kbs[name]
+                del self._last_used[name]
+                unloaded.append(kb)
+            finally:
+                kb.lock.release()
+        return unloaded
+
+    def _release(self, unloaded: List[KnowledgeBase]) -> None:
+        if len(unloaded) == 0:
+            return
+        for kb in unloaded:
+            if kb.index is not None:
+                invalidate_query_engines(kb.index.index_id)
+        # A query engine that is answering keeps its references until it is done
+        gc.collect()
+        print(f"Unloaded knowledge bases: {[kb.name for kb in unloaded]}")
+
+    def unload(self, name: str) -> bool:
+        with self._lock:
+            unloaded = self._evict([name]) if name in self._kbs else []
+        self._release(unloaded)
+        return len(unloaded) > 0
+
+    def unload_idle(self) -> List[str]:
+        """Unload the knowledge bases unused for idle_timeout seconds, return their names."""
+        if self.idle_timeout is None:
+            return []
+        now = time.monotonic()
+        with self._lock:
+            unloaded = self._evict([name for name, last_used in self._last_used.items() if now - last_used >= self.idle_timeout])
+        self._release(unloaded)
+        return [kb.name for kb in unloaded]
+
+    def _start_reaper(self) -> None:
+        if self.idle_timeout is None or self._reaper is not None:
+            return
+        interval = min(self.idle_timeout / 2, 60)
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.unload_idle()
+        self._reaper = threading.Thread(target=reap, name="knowledge-base-reaper", daemon=True)
+        self._reaper.start()
+
+KB_REGISTRY = KnowledgeBaseRegistry()
 
 class IndexManager:
+    # Manages the index of the knowledge base index_name, each knowledge base has its own stores
     def __init__(self, index_name):
+        check_kb_name(index_name)
         self.index_name: str = index_name
-        self.storage_context: StorageContext = STORAGE_CONTEXT
         self.index_id: str = None
         self.index: VectorStoreIndex = None
 
+    @property
+    def knowledge_base(self) -> KnowledgeBase:
+        # Loaded on first use, not when the manager is created
+        return KB_REGISTRY.get(self.index_name)
+
+    @property
+    def storage_context(self) -> StorageContext:
+        return self.knowledge_base.storage_context
+
+    @property
+    def bm25_index(self) -> BM25Index:
+        return self.knowledge_base.bm25_index
+
+    @contextmanager
+    def _locked_kb(self) -> Iterator[KnowledgeBase]:
+        # The knowledge base with its lock held, loaded again if it was unloaded meanwhile
+        while True:
+            kb = self.knowledge_base
+            kb.lock.acquire()
+            if not kb.unloaded:
+                break
+            kb.lock.release()
+        try:
+            yield kb
+        finally:
+            kb.lock.release()
+
+    def _load(self, kb: KnowledgeBase) -> Optional[VectorStoreIndex]:
+        # Called with kb.lock held. A knowledge base holds one index.
+        if kb.index is None:
+            index_ids = list_index_ids(kb.storage_context)
+            print(f"Found {len(index_ids)} indices in knowledge base {kb.name}")
+            if len(index_ids) == 0:
+                return None
+            kb.index = load_index_from_storage(kb.storage_context, index_id=index_ids[0])
+            if not DEV_MODE:
+                kb.index._store_nodes_override = True
+            print(f"Loaded index {kb.index.index_id}")
+        return kb.index
+
     def check_index_exists(self):
-        indices = load_indices_from_storage(self.storage_context)
-        print(f"Loaded {len(indices)} indices")
-        if len(indices) > 0:
-            self.index = indices[0]
-            self.index_id = indices[0].index_id
+        kb = self.knowledge_base
+        if kb.index is not None:
+            self.index = kb.index
+            self.index_id = kb.index.index_id
+            return True
+        self.index = None # the knowledge base was unloaded, load_index loads it again
+        index_ids = list_index_ids(kb.storage_context)
+        print(f"Found {len(index_ids)} indices")
+        if len(index_ids) > 0:
+            self.index_id = index_ids[0]
             return True
         else:
             return False
 
     def init_index(self, nodes):
-        self.index = VectorStoreIndex(nodes, 
-                                      storage_context=self.storage_context, 
-                                      store_nodes_override=True) # note: no nodes in doc store if using vector database, set store_nodes_override=True to add nodes to doc store
-        self.index_id = self.index.index_id
-        if DEV_MODE:
-            self.storage_context.persist()
+        with self._locked_kb() as kb:
+            kb.index = VectorStoreIndex(nodes, 
+                                        storage_context=kb.storage_context, 
+                                        store_nodes_override=True) # note: no nodes in doc store if using vector database, set store_nodes_override=True to add nodes to doc store
+            self.index = kb.index
+            self.index_id = self.index.index_id
+            if DEV_MODE:
+                kb.storage_log.compact() # write the first snapshot
+            kb.bm25_index.add_nodes(nodes)
+            kb.bm25_index.persist()
+        invalidate_query_engines()
         print(f"Created index {self.index.index_id}")
         return self.index
 
-    def load_index(self): # TODO: load index based on index_id
-        self.index = load_index_from_storage(self.storage_context)
-        if not DEV_MODE:
-            self.index._store_nodes_override = True
-        print(f"Loaded index {self.index.index_id}")
+    def load_index(self):
+        with self._locked_kb() as kb:
+            index = self._load(kb)
+        self.index = index
+        self.index_id = index.index_id
         return self.index
     
     def insert_nodes(self, nodes):
-        if self.index is not None:
-            self.index.insert_nodes(nodes=nodes)
-            if DEV_MODE:
-                self.storage_context.persist()                
-            print(f"Inserted {len(nodes)} nodes into index {self.index.index_id}")
-        else:
-            self.init_index(nodes=nodes)
+        with self._locked_kb() as kb:
+            self.index = self._load(kb) # insert into the existing index instead of creating another one
+            if self.index is not None:
+                # Like the storage log replay: the nodes of re-ingested documents replace their old nodes.
+                # The ingestion pipeline already removed them from the docstore and vector store but not
+                # from the index struct, the BM25 index still lists them.
+                ref_doc_ids = list(dict.fromkeys(node.ref_doc_id for node in nodes if node.ref_doc_id is not None))
+                node_ids = {node.node_id for node in nodes}
+                remove_ref_docs(kb.storage_context, self.index.index_struct, ref_doc_ids,
+                                keep_node_ids=node_ids, node_ids=kb.bm25_index.node_ids(ref_doc_ids))
+                self.index.insert_nodes(nodes=nodes)
+                if DEV_MODE:
+                    kb.storage_log.log_insert(self.index.index_id, nodes) # cost is proportional to the inserted nodes
+                kb.bm25_index.add_nodes(nodes, replace_ref_docs=True) # drops the old nodes of re-ingested documents
+                kb.bm25_index.persist()
+                invalidate_query_engines(self.index.index_id)
+                ANSWER_CACHE.invalidate_ref_docs({node.ref_doc_id for node in nodes}) # re-ingested documents
+                print(f"Inserted {len(nodes)} nodes into index {self.index.index_id}")
+            else:
+                self.init_index(nodes=nodes)
         return self.index
 
     # Build index based on documents under 'data' folder
@@ -58,9 +270,11 @@ class IndexManager:
         Settings.chunk_overlap = chunk_overlap
         documents = SimpleDirectoryReader(input_dir=input_dir, recursive=True).load_data()
         if len(documents) > 0:
-            pipeline = AdvancedIngestionPipeline()
-            nodes = pipeline.run(documents=documents)
-            index = self.insert_nodes(nodes)
+            # The knowledge base stays loaded until the nodes are inserted
+            with self._locked_kb() as kb:
+                pipeline = AdvancedIngestionPipeline(storage_context=kb.storage_context)
+                nodes = pipeline.run(documents=documents)
+                index = self.insert_nodes(nodes)
             return nodes
         else:
             print("No documents found")
@@ -75,9 +289,11 @@ class IndexManager:
         print(files)
         documents = SimpleDirectoryReader(input_files=files).load_data()
         if len(documents) > 0:
-            pipeline = AdvancedIngestionPipeline()
-            nodes = pipeline.run(documents=documents)
-            index = self.insert_nodes(nodes)
+            # The knowledge base stays loaded until the nodes are inserted
+            with self._locked_kb() as kb:
+                pipeline = AdvancedIngestionPipeline(storage_context=kb.storage_context)
+                nodes = pipeline.run(documents=documents)
+                index = self.insert_nodes(nodes)
             return nodes
         else:         
             print("No documents found")
@@ -92,9 +308,11 @@ class IndexManager:
         from server.readers.beautiful_soup_web import BeautifulSoupWebReader
         documents = BeautifulSoupWebReader().load_data(websites)        
         if len(documents) > 0:
-            pipeline = AdvancedIngestionPipeline()
-            nodes = pipeline.run(documents=documents)
-            index = self.insert_nodes(nodes)
+            # The knowledge base stays loaded until the nodes are inserted
+            with self._locked_kb() as kb:
+                pipeline = AdvancedIngestionPipeline(storage_context=kb.storage_context)
+                nodes = pipeline.run(documents=documents)
+                index = self.insert_nodes(nodes)
             return nodes
         else:
             print("No documents found")
@@ -102,6 +320,23 @@ class IndexManager:
     
     # Delete a document and all related nodes
     def delete_ref_doc(self, ref_doc_id):
-        self.index.delete_ref_doc(ref_doc_id=ref_doc_id, delete_from_docstore=True)
-        self.storage_context.persist()
-        print("Deleted document", ref_doc_id)
\ No newline at end of file
+        self.delete_ref_docs([ref_doc_id])
+
+    # Delete documents and all related nodes from the vector store, docstore and index struct, then persist once
+    def delete_ref_docs(self, ref_doc_ids):
+        with self._locked_kb() as kb:
+            self.index = self._load(kb)
+            if self.index is None:
+                return
+            ref_doc_ids = list(dict.fromkeys(ref_doc_ids)) # remove duplicates, keep order
+            node_ids = remove_ref_docs(kb.storage_context, self.index.index_struct, ref_doc_ids)
+            kb.storage_context.index_store.add_index_struct(self.index.index_struct)
+            if DEV_MODE:
+                kb.storage_log.log_delete(self.index.index_id, ref_doc_ids)
+            else:
+                kb.storage_context.persist()
+            kb.bm25_index.delete_ref_docs(ref_doc_ids)
+            kb.bm25_index.persist()
+        invalidate_query_engines(self.index.index_id)
+        ANSWER_CACHE.invalidate_ref_docs(ref_doc_ids)
+        print(f"Deleted {len(ref_doc_ids)} documents and {len(node_ids)} nodes")
@@ -2,36 +2,190 @@
 # https://docs.llamaindex.ai/en/stable/api_reference/ingestion/
 # https://docs.llamaindex.ai/en/stable/examples/ingestion/advanced_ingestion_pipeline/
 
-from llama_index.core import Settings
+import os
+import time
+import pickle
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
+from llama_index.core import Settings, StorageContext
+from llama_index.core.bridge.pydantic import Field
 from llama_index.core.ingestion import IngestionPipeline, DocstoreStrategy
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
 from server.splitters import ChineseTitleExtractor
-from server.stores.strage_context import STORAGE_CONTEXT
-from server.stores.ingestion_cache import INGESTION_CACHE
+from server.stores.ingestion_cache import get_ingestion_cache
+from server.stores.metadata_index import DERIVED_KEYS, derived_metadata
+from config import INGESTION_NUM_WORKERS, INGESTION_STAGES
+
+def _tiktoken_cache_dir() -> str:
+    # llama_index loads its tokenizer from the cl100k_base file bundled with it, but sets TIKTOKEN_CACHE_DIR
+    # only while loading. A worker unpickling a splitter loads the encoding again and, without the
+    # variable, would download it (and fail offline).
+    import llama_index.core.utils
+    return os.environ.get("TIKTOKEN_CACHE_DIR") or os.path.join(
+        os.path.dirname(os.path.abspath(llama_index.core.utils.__file__)), "_static", "tiktoken_cache"
+    )
+
+_worker_transformation: Optional[TransformComponent] = None
+
+def _init_worker(transformation: bytes, tiktoken_cache_dir: str) -> None:
+    # Runs once in each worker process: the transformation is unpickled here, after the tokenizer
+    # cache is set, instead of with every shard
+    global _worker_transformation
+    os.environ["TIKTOKEN_CACHE_DIR"] = tiktoken_cache_dir
+    _worker_transformation = pickle.loads(transformation)
+
+def _run_transformation(nodes: List[BaseNode]) -> List[BaseNode]:
+    # Runs in a worker process
+    return _worker_transformation(nodes)
+
+class ParallelTransformation(TransformComponent):
+    """Shard the nodes across a process pool and run a transformation on each shard.
+
+    Shards are contiguous and results are concatenated in input order, so for
+    transformations that work document by document (like text splitters) the
+    output is the same as running the transformation serially. If the pool breaks
+    (a worker fails to start or dies), the nodes are transformed serially.
+    """
+
+    transformation: TransformComponent = Field(description="Transformation to run in the workers.")
+    num_workers: int = Field(default=1, description="Number of worker processes.")
+
+    def __call__(self, nodes: List[BaseNode], **kwargs) -> List[BaseNode]:
+        num_workers = min(self.num_workers, len(nodes))
+        if num_workers <= 1:
+            return self.transformation(nodes, **kwargs)
+        shard_size = -(-len(nodes) // num_workers) # ceil
+        shards = [nodes[i:i + shard_size] for i in range(0, len(nodes), shard_size)]
+        try:
+            # spawn: do not fork a parent process that has already loaded torch
+            with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(pickle.dumps(self.transformation), _tiktoken_cache_dir()),
+            ) as pool:
+                results = pool.map(_run_transformation, shards)
+                return [node for result in results for node in result]
+        except BrokenProcessPool as e:
+            print(f"Worker processes failed ({e}), running {type(self.transformation).__name__} serially")
+            return self.transformation(nodes, **kwargs)
+
+class TimedTransformation(TransformComponent):
+    """Run a transformation and report its throughput."""
+
+    transformation: TransformComponent = Field(description="Transformation to time.")
+    name: str = Field(description="Stage name used in the report.")
+
+    def __call__(self, nodes: List[BaseNode], **kwargs) -> List[BaseNode]:
+        start_time = time.perf_counter()
+        num_in = len(nodes)
+        nodes = self.transformation(nodes, **kwargs)
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+        print(f"Stage {self.name}: {num_in} in, {len(nodes)} out, {elapsed:.2f}s, {num_in / elapsed:.1f} items/s")
+        return nodes
+
+# Hash of the text a node was embedded from, kept in metadata but hidden from the embedding and the LLM
+EMBEDDING_HASH_KEY = "embedding_text_hash"
+
+class HashedEmbedding(TransformComponent):
+    """Embed only the nodes whose final text changed since they were last embedded.
+
+    Nodes that already have an embedding computed from the same text (and model) are
+    skipped, and identical texts in one run are embedded once.
+    """
+
+    embed_model: BaseEmbedding = Field(description="Embedding model.")
+
+    def __call__(self, nodes: List[BaseNode], **kwargs) -> List[BaseNode]:
+        groups = {} # text hash -> nodes that need this embedding
+        for node in nodes:
+            for excluded_keys in (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys):
+                if EMBEDDING_HASH_KEY not in excluded_keys:
+                    excluded_keys.append(EMBEDDING_HASH_KEY)
+            text = node.get_content(metadata_mode=MetadataMode.EMBED)
+            text_hash = hashlib.sha256((self.embed_model.model_name + "\n" + text).encode("utf-8")).hexdigest()
+            if node.embedding is not None and node.metadata.get(EMBEDDING_HASH_KEY) == text_hash:
+                continue
+            node.metadata[EMBEDDING_HASH_KEY] = text_hash
+            groups.setdefault(text_hash, []).append(node)
+        if len(groups) == 0:
+            return nodes
+        texts = [group[0].get_content(metadata_mode=MetadataMode.EMBED) for group in groups.values()]
+        embeddings = self.embed_model.get_text_embedding_batch(texts)
+        for group, embedding in zip(groups.values(), embeddings):
+            for node in group:
+                node.embedding = embedding
+        print(f"Embedded {len(texts)} texts for {len(nodes)} nodes")
+        return nodes
+
+class FilterMetadataExtractor(TransformComponent):
+    """Add the derived metadata keys that queries filter on (file_ext, url_host, creation_day).
+
+    The keys are stored with the nodes, so the local vector stores and the BM25 index
+    can index them, but they are hidden from the embedding and the LLM.
+    """
+
+    def __call__(self, nodes: List[BaseNode], **kwargs) -> List[BaseNode]:
+        for node in nodes:
+            for excluded_keys in (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys):
+                excluded_keys.extend(key for key in DERIVED_KEYS if key not in excluded_keys)
+            node.metadata.update(derived_metadata(node.metadata))
+        return nodes
+
+# Stages that rewrite node text or metadata. They always run before embedding, so the
+# embeddings match the text that is stored and indexed.
+def _create_stage(name: str, num_workers: int) -> TransformComponent:
+    if name == "split":
+        return ParallelTransformation(transformation=Settings.text_splitter, num_workers=num_workers)
+    elif name == "zh_title_enhance":
+        return ChineseTitleExtractor() # modified Chinese title enhance: zh_title_enhance
+    else:
+        raise ValueError(f"Invalid ingestion stage: {name}")
+
+def create_transformations(stages: List[str] = INGESTION_STAGES, num_workers: int = INGESTION_NUM_WORKERS) -> List[TransformComponent]:
+    transformations = [
+        TimedTransformation(transformation=_create_stage(name, num_workers), name=name) for name in stages
+    ]
+    # Filterable metadata is derived after the other stages, which may rewrite metadata
+    transformations.append(FilterMetadataExtractor())
+    # Embedding is always the last stage
+    # The embedding model encodes nodes in batches of EMBEDDING_BATCH_SIZE, see server/models/embedding.py
+    transformations.append(
+        TimedTransformation(transformation=HashedEmbedding(embed_model=Settings.embed_model), name="embed")
+    )
+    return transformations
 
 class AdvancedIngestionPipeline(IngestionPipeline):
     def __init__(
-        self, 
+        self,
+        storage_context: StorageContext,
+        stages: Optional[List[str]] = None,
+        num_workers: Optional[int] = None,
     ):
-        # Initialize the embedding model, text splitter
-        embed_model = Settings.embed_model
-        text_splitter = Settings.text_splitter
+        # storage_context is the knowledge base's, documents are upserted into its docstore and vector store
+        # Build the transformations: text splitter, text rewriting stages, then embedding model
+        transformations = create_transformations(
+            stages=stages or INGESTION_STAGES,
+            num_workers=num_workers or INGESTION_NUM_WORKERS,
+        )
 
         # Call the super class's __init__ method with the necessary arguments
         super().__init__(
-            transformations=[
-                text_splitter,
-                embed_model,
-                ChineseTitleExtractor(), # modified Chinese title enhance: zh_title_enhance
-            ],
-            docstore=STORAGE_CONTEXT.docstore,
-            vector_store=STORAGE_CONTEXT.vector_store,
-            cache=INGESTION_CACHE,
+            transformations=transformations,
+            docstore=storage_context.docstore,
+            vector_store=storage_context.vector_store,
+            cache=get_ingestion_cache(),
             docstore_strategy=DocstoreStrategy.UPSERTS,  # UPSERTS: Update or insert
         )
 
     # If you need to override the run method or add new methods, you can do so here
     def run(self, documents):
         print(f"Load {len(documents)} Documents")
+        start_time = time.perf_counter()
         nodes = super().run(documents=documents)
-        print(f"Ingested {len(nodes)} Nodes")
-        return nodes
\ No newline at end of file
+        print(f"Ingested {len(nodes)} Nodes in {time.perf_counter() - start_time:.2f}s")
+        return nodes
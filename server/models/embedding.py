@@ -1,23 +1,147 @@
 # Create embedding models
 import os
+import asyncio
+import threading
+from typing import Callable, Dict, List, Optional, Set
 from llama_index.core import Settings
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from config import DEFAULT_EMBEDDING_MODEL, EMBEDDING_MODEL_PATH, MODEL_DIR
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from config import DEFAULT_EMBEDDING_MODEL, EMBEDDING_MODEL_PATH, EMBEDDING_BATCH_SIZE, MODEL_DIR, DEV_MODE, REDIS_URI
+from server.models.onnx_runtime import parse_model_entry
+from server.stores.embedding_cache import EmbeddingCache, QueryEmbeddingCache, create_embedding_cache, embedding_cache_key, normalize_query
 from server.utils.hf_mirror import use_hf_mirror
+from server.utils.lazy import lazy
 
-def create_embedding_model(model_name = DEFAULT_EMBEDDING_MODEL) -> HuggingFaceEmbedding:
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model wrapper that looks up embeddings in caches before computing them.
+
+    The EmbeddingCache (optional) is used for both documents (ingestion pipeline) and
+    queries (retrieval). Queries are first looked up in the QueryEmbeddingCache, keyed by
+    model and normalized query text.
+    """
+
+    embed_model: BaseEmbedding = Field(description="The embedding model whose results are cached.")
+    _cache: Optional[EmbeddingCache] = PrivateAttr()
+    _query_cache: QueryEmbeddingCache = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: Optional[EmbeddingCache], query_cache: QueryEmbeddingCache, **kwargs) -> None:
+        super().__init__(
+            embed_model=embed_model,
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs,
+        )
+        self._cache = cache
+        self._query_cache = query_cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _get_cached(self, kind: str, texts: List[str], embed_fn: Callable[[List[str]], List[Embedding]]) -> List[Embedding]:
+        if self._cache is None:
+            return embed_fn(texts)
+        keys = [embedding_cache_key(self.model_name, kind, text) for text in texts]
+        cached = self._cache.get_many(keys)
+        missing = {} # key -> text
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing[key] = text
+        if len(missing) > 0:
+            computed = dict(zip(missing.keys(), embed_fn(list(missing.values()))))
+            self._cache.put_many(computed)
+            cached.update(computed)
+        return [cached[key] for key in keys]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        query = normalize_query(query)
+        key = embedding_cache_key(self.model_name, "query", query)
+        embedding = self._query_cache.get(key)
+        if embedding is None:
+            embedding = self._get_cached("query", [query], lambda queries: [self.embed_model.get_query_embedding(queries[0])])[0]
+            self._query_cache.put(key, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        # The model runs on the CPU/GPU, keep it off the event loop of the async query path
+        return await asyncio.get_running_loop().run_in_executor(None, self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._get_cached("text", texts, self.embed_model.get_text_embedding_batch)
+
+# Shared by all embedding models created in this process, the keys include the model name
+_EMBEDDING_CACHE: Optional[EmbeddingCache] = None
+
+@lazy
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    # Built on first use: outside development it imports redis and connects to REDIS_URI
+    return QueryEmbeddingCache(redis_uri=None if DEV_MODE else REDIS_URI)
+
+def get_query_embedding_cache_stats():
+    return get_query_embedding_cache().stats()
+
+# Embedding models loaded in this process, keyed by model name, so that the weights are loaded
+# once and shared across sessions and Streamlit reruns
+_EMBEDDING_MODELS: Dict[str, BaseEmbedding] = {}
+_EMBEDDING_MODELS_LOCK = threading.Lock() # held while loading, so a model is never loaded twice
+_WARMED_UP: Set[str] = set()
+
+def _load_embedding_model(model_name: str) -> BaseEmbedding:
+    global _EMBEDDING_CACHE
+    use_hf_mirror()
+    model_path, backend = parse_model_entry(EMBEDDING_MODEL_PATH[model_name])
+    if MODEL_DIR is not None:
+        path = f"./{MODEL_DIR}/{model_path}"
+        if os.path.exists(path): # Use local models if the path exists
+            model_path = path
+    if backend == "torch":
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding # imports sentence-transformers and torch
+        embed_model = HuggingFaceEmbedding(model_name=model_path, embed_batch_size=EMBEDDING_BATCH_SIZE)
+    else:
+        from server.models.onnx_runtime import OnnxEmbedding
+        embed_model = OnnxEmbedding(model_path, quantize=backend == "onnx-int8", embed_batch_size=EMBEDDING_BATCH_SIZE)
+    if DEV_MODE and _EMBEDDING_CACHE is None: # Production environment uses the Redis ingestion cache instead
+        _EMBEDDING_CACHE = create_embedding_cache()
+    print(f"created embed model: {model_path}")
+    return CachedEmbedding(embed_model=embed_model, cache=_EMBEDDING_CACHE, query_cache=get_query_embedding_cache())
+
+def get_embedding_model(model_name = DEFAULT_EMBEDDING_MODEL) -> BaseEmbedding:
+    # Load the model on first use, then return the same instance
+    with _EMBEDDING_MODELS_LOCK:
+        embed_model = _EMBEDDING_MODELS.get(model_name)
+        if embed_model is None:
+            embed_model = _load_embedding_model(model_name)
+            _EMBEDDING_MODELS[model_name] = embed_model
+        return embed_model
+
+def create_embedding_model(model_name = DEFAULT_EMBEDDING_MODEL) -> BaseEmbedding:
     try:
-        use_hf_mirror()
-        model_path = EMBEDDING_MODEL_PATH[model_name]
-        if MODEL_DIR is not None:
-            path = f"./{MODEL_DIR}/{model_path}"
-            if os.path.exists(path): # Use local models if the path exists
-                model_path = path
-        embed_model = HuggingFaceEmbedding(model_name=model_path)
-        Settings.embed_model = embed_model
-        print(f"created embed model: {model_path}")
+        Settings.embed_model = get_embedding_model(model_name)
     except Exception as e:
         print(f"An error occurred while creating the embedding model: {type(e).__name__}: {e}")
         Settings.embed_model = None
 
-    return Settings.embed_model
\ No newline at end of file
+    return Settings.embed_model
+
+def warm_up_embedding_model(model_name = DEFAULT_EMBEDDING_MODEL) -> None:
+    """Load the model and run one embedding in a background thread, once per process.
+
+    The first query then pays neither the model load nor the first inference.
+    """
+    with _EMBEDDING_MODELS_LOCK:
+        if model_name in _WARMED_UP:
+            return
+        _WARMED_UP.add(model_name)
+
+    def warm_up():
+        try:
+            embed_model = get_embedding_model(model_name)
+            embed_model.embed_model.get_query_embedding("warm up") # the wrapped model, not cached
+            print(f"Warmed up embed model: {model_name}")
+        except Exception as e:
+            print(f"An error occurred while warming up the embedding model: {type(e).__name__}: {e}")
+
+    threading.Thread(target=warm_up, name="embedding-warm-up", daemon=True).start()
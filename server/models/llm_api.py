@@ -1,11 +1,54 @@
 # Create LLM with API compatible with OpenAI
+from typing import Any, Sequence
 from llama_index.core import Settings
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, ChatResponseAsyncGen
+from llama_index.core.llms.callbacks import llm_chat_callback
 from langchain_openai import ChatOpenAI
 from llama_index.llms.langchain import LangChainLLM
 
+class AsyncLangChainLLM(LangChainLLM):
+    """LangChainLLM with native async chat.
+
+    LangChainLLM implements achat and astream_chat with the synchronous methods, which block
+    the event loop for the whole answer. These use the async methods of the LangChain chat model.
+    The async query path (query engine aquery) calls them through LLM.apredict and LLM.astream.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AsyncLangChainLLM"
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        if not self.metadata.is_chat_model:
+            return await super().achat(messages, **kwargs)
+        from llama_index.llms.langchain.utils import from_lc_messages, to_lc_messages
+
+        lc_message = await self._llm.ainvoke(to_lc_messages(messages), **kwargs)
+        return ChatResponse(message=from_lc_messages([lc_message])[0])
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        if not self.metadata.is_chat_model:
+            return await super().astream_chat(messages, **kwargs)
+        from llama_index.llms.langchain.utils import from_lc_messages, to_lc_messages
+
+        async def gen() -> ChatResponseAsyncGen:
+            response_str = ""
+            async for lc_message in self._llm.astream(to_lc_messages(messages), **kwargs):
+                message = from_lc_messages([lc_message])[0]
+                delta = message.content
+                response_str += delta
+                yield ChatResponse(
+                    message=ChatMessage(role=message.role, content=response_str),
+                    delta=delta,
+                )
+
+        return gen()
+
 def create_openai_llm(model_name:str, api_base:str, api_key:str, temperature:float = 0.5, system_prompt:str = None) -> ChatOpenAI:
     try:
-        llm = LangChainLLM(
+        llm = AsyncLangChainLLM(
             llm=ChatOpenAI(
                 openai_api_base=api_base, 
                 openai_api_key=api_key,
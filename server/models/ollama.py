@@ -32,14 +32,15 @@ def get_model_list():
         print("Ollama is not alive")
         return None
 
-def create_ollama_llm(model: str, temperature: float = 0.5, system_prompt: str = None) -> Ollama:
+def create_ollama_llm(model: str, temperature: float = 0.5, system_prompt: str = None, base_url: str = None) -> Ollama:
     """
     Creates an Ollama LLM instance with the specified model and parameters.
+    base_url defaults to the Ollama API URL of the Streamlit session.
     """
     try:
         llm = Ollama(
             model=model, 
-            base_url=st.session_state.ollama_api_url, 
+            base_url=base_url or st.session_state.ollama_api_url, 
             request_timeout=600,
             temperature=temperature,
             system_prompt=system_prompt,
@@ -0,0 +1,161 @@
+# ONNX Runtime backend
+# Runs the embedding and reranker models with ONNX Runtime on CPU instead of PyTorch.
+# A model is exported to ONNX once, next to the local models, and optionally quantized to int8
+# (dynamic quantization of the weights). Select it per model in EMBEDDING_MODEL_PATH / RERANKER_MODEL_PATH
+# of config.py with {"path": ..., "backend": "onnx"} or "onnx-int8".
+# See benchmarks/onnx_models.py for latency and drift against the PyTorch models.
+
+# Install Optimum with ONNX Runtime
+""" pip install optimum[onnxruntime] """
+
+import os
+import json
+import platform
+from typing import Any, List, Optional, Tuple
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from config import MODEL_DIR
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+ONNX_FILE_NAME = "model.onnx"
+QUANTIZED_ONNX_FILE_NAME = "model_quantized.onnx" # written by ORTQuantizer
+
+def parse_model_entry(entry) -> Tuple[str, str]:
+    """Return (path, backend) of an EMBEDDING_MODEL_PATH / RERANKER_MODEL_PATH value.
+
+    A value is a model path, which uses PyTorch, or a dict with "path" and "backend".
+    """
+    if isinstance(entry, str):
+        return entry, "torch"
+    backend = entry.get("backend", "torch")
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid model backend: {backend}, options include {BACKENDS}")
+    return entry["path"], backend
+
+def onnx_model_dir(model_path: str) -> str:
+    # Exported models are kept next to the local models, e.g. localmodels/BAAI/bge-large-zh-v1.5-onnx
+    if not os.path.isdir(model_path):
+        model_path = f"./{MODEL_DIR or 'localmodels'}/{model_path}"
+    return model_path.rstrip("/") + "-onnx"
+
+def load_onnx_model(model_path: str, task: str, quantize: bool = False) -> Tuple[Any, Any]:
+    """Load the (ONNX Runtime model, tokenizer) of model_path, exporting and quantizing it on first use.
+
+    task is "feature-extraction" (embedding) or "text-classification" (cross-encoder).
+    """
+    from transformers import AutoTokenizer
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTModelForSequenceClassification
+
+    model_class = ORTModelForFeatureExtraction if task == "feature-extraction" else ORTModelForSequenceClassification
+    onnx_dir = onnx_model_dir(model_path)
+    if not os.path.exists(os.path.join(onnx_dir, ONNX_FILE_NAME)):
+        print(f"Exporting {model_path} to ONNX: {onnx_dir}")
+        model = model_class.from_pretrained(model_path, export=True)
+        model.save_pretrained(onnx_dir)
+        AutoTokenizer.from_pretrained(model_path).save_pretrained(onnx_dir)
+    file_name = ONNX_FILE_NAME
+    if quantize:
+        file_name = QUANTIZED_ONNX_FILE_NAME
+        if not os.path.exists(os.path.join(onnx_dir, file_name)):
+            from optimum.onnxruntime import ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+            print(f"Quantizing {onnx_dir} to int8")
+            if platform.machine().lower() in ("arm64", "aarch64"):
+                quantization_config = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+            else:
+                quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            quantizer = ORTQuantizer.from_pretrained(onnx_dir, file_name=ONNX_FILE_NAME)
+            quantizer.quantize(save_dir=onnx_dir, quantization_config=quantization_config)
+    model = model_class.from_pretrained(onnx_dir, file_name=file_name, provider="CPUExecutionProvider")
+    tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+    print(f"Loaded ONNX model: {os.path.join(onnx_dir, file_name)}")
+    return model, tokenizer
+
+def _pooling_mode(model_path: str) -> str:
+    # Pooling of a sentence-transformers model, bge models use the CLS token
+    config_path = os.path.join(model_path, "1_Pooling", "config.json")
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            if json.load(f).get("pooling_mode_mean_tokens", False):
+                return "mean"
+    return "cls"
+
+class OnnxEmbedding(BaseEmbedding):
+    """Embedding model running with ONNX Runtime, equivalent to HuggingFaceEmbedding on the same model.
+
+    Queries and texts get the same instructions as with HuggingFaceEmbedding, and the
+    embeddings are pooled like the sentence-transformers model and normalized.
+    """
+
+    model_path: str = Field(description="Path or Hugging Face name of the model.")
+    quantize: bool = Field(default=False, description="Use the int8 quantized model.")
+    max_length: int = Field(default=512, description="Maximum tokens of a text, longer texts are truncated.")
+    pooling: str = Field(default="cls", description="Pooling of the token embeddings, cls or mean.")
+    query_instruction: Optional[str] = Field(default=None, description="Instruction prepended to queries.")
+    text_instruction: Optional[str] = Field(default=None, description="Instruction prepended to texts.")
+    _model: Any = PrivateAttr()
+    _tokenizer: Any = PrivateAttr()
+
+    def __init__(self, model_path: str, quantize: bool = False, **kwargs: Any) -> None:
+        kwargs.setdefault("model_name", f"{model_path}#onnx{'-int8' if quantize else ''}") # keeps cached embeddings apart
+        kwargs.setdefault("pooling", _pooling_mode(model_path))
+        super().__init__(model_path=model_path, quantize=quantize, **kwargs)
+        self._model, self._tokenizer = load_onnx_model(model_path, "feature-extraction", quantize=quantize)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "OnnxEmbedding"
+
+    def _embed(self, texts: List[str]) -> List[Embedding]:
+        inputs = self._tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+        hidden = np.asarray(self._model(**inputs).last_hidden_state)
+        if self.pooling == "mean":
+            mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+            embeddings = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        else:
+            embeddings = hidden[:, 0]
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings.tolist()
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        from llama_index.embeddings.huggingface.utils import get_query_instruct_for_model_name
+        # Prepended without a separator, like the prompts of sentence-transformers
+        instruction = self.query_instruction or get_query_instruct_for_model_name(self.model_path) or ""
+        return self._embed([instruction + query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        from llama_index.embeddings.huggingface.utils import get_text_instruct_for_model_name
+        instruction = self.text_instruction or get_text_instruct_for_model_name(self.model_path) or ""
+        return self._embed([instruction + text for text in texts])
+
+class OnnxCrossEncoder:
+    """Cross-encoder running with ONNX Runtime, with the predict method of sentence-transformers' CrossEncoder.
+
+    Like CrossEncoder, a model with a single label returns sigmoid scores.
+    """
+
+    def __init__(self, model_path: str, max_length: int = 512, quantize: bool = False) -> None:
+        self.model_path = model_path
+        self.model, self.tokenizer = load_onnx_model(model_path, "text-classification", quantize=quantize)
+        self.max_length = min(max_length, self.tokenizer.model_max_length)
+
+    def predict(self, sentences: List[Tuple[str, str]], batch_size: int = 32, show_progress_bar: bool = None) -> np.ndarray:
+        scores = []
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start:start + batch_size]
+            inputs = self.tokenizer(
+                [query for query, _ in batch], [passage for _, passage in batch],
+                padding=True, truncation=True, max_length=self.max_length, return_tensors="np",
+            )
+            logits = np.asarray(self.model(**inputs).logits)
+            scores.append(1 / (1 + np.exp(-logits[:, 0])) if logits.shape[1] == 1 else logits)
+        return np.concatenate(scores) if len(scores) > 0 else np.empty(0, dtype=np.float32)
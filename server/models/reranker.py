@@ -1,20 +1,256 @@
 # Create Rerank model
 # https://docs.llamaindex.ai/en/stable/examples/node_postprocessor/SentenceTransformerRerank/
 import os
+import gc
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from llama_index.core.callbacks import CBEventType, EventPayload
 from llama_index.core.postprocessor import SentenceTransformerRerank
-from config import DEFAULT_RERANKER_MODEL, RERANKER_MODEL_TOP_N, RERANKER_MODEL_PATH, MODEL_DIR
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.utils import infer_torch_device
+from config import DEFAULT_RERANKER_MODEL, RERANKER_MODEL_TOP_N, RERANKER_MODEL_PATH, RERANKER_IDLE_TIMEOUT, MODEL_DIR
+from config import RERANKER_MAX_LENGTH, RERANKER_BATCH_SIZE, RERANKER_BATCH_TOKENS, RERANKER_SCORE_CACHE_SIZE
+from server.models.onnx_runtime import parse_model_entry
+from server.stores.embedding_cache import normalize_query
 from server.utils.hf_mirror import use_hf_mirror
 
+class RerankerRegistry:
+    """Cross-encoder models of the process, loaded once per model path, device, max length and backend.
+
+    Query engines of all sessions share the models. With idle_timeout (seconds), a model
+    unused for that long is unloaded by a background thread and loaded again when needed.
+    """
+
+    def __init__(self, idle_timeout: Optional[float] = RERANKER_IDLE_TIMEOUT) -> None:
+        self.idle_timeout = idle_timeout
+        self._models: Dict[tuple, Any] = {}
+        self._last_used: Dict[tuple, float] = {}
+        self._lock = threading.Lock() # guards the dicts, never held while a model loads
+        self._load_locks: Dict[tuple, threading.Lock] = {} # held while loading a key, so a model is never loaded twice
+        self._reaper: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _load(model_path: str, device: str, max_length: int, backend: str) -> Any:
+        if backend == "torch":
+            from sentence_transformers import CrossEncoder
+            model = CrossEncoder(model_path, max_length=max_length, device=device)
+            # bge-reranker-base/large have 512 positions, truncate to what the model supports
+            model.max_length = min(max_length, model.tokenizer.model_max_length)
+            return model
+        from server.models.onnx_runtime import OnnxCrossEncoder
+        return OnnxCrossEncoder(model_path, max_length=max_length, quantize=backend == "onnx-int8")
+
+    def get(self, model_path: str, device: str, max_length: int = RERANKER_MAX_LENGTH, backend: str = "torch") -> Any:
+        key = (model_path, device, max_length, backend)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._last_used[key] = time.monotonic()
+                return model
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        # Loading one model does not block queries using, or loading, the others
+        with load_lock:
+            with self._lock:
+                model = self._models.get(key) # loaded by another thread meanwhile
+            if model is None:
+                model = self._load(model_path, device, max_length, backend)
+                print(f"Loaded rerank model: {model_path}")
+            with self._lock:
+                self._models[key] = model
+                self._last_used[key] = time.monotonic()
+                self._start_reaper()
+            return model
+
+    def loaded_models(self) -> List[str]:
+        with self._lock:
+            return [key[0] for key in self._models.keys()]
+
+    def unload_idle(self) -> List[str]:
+        """Unload the models unused for idle_timeout seconds, return their paths."""
+        if self.idle_timeout is None:
+            return []
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, last_used in self._last_used.items() if now - last_used >= self.idle_timeout]
+            for key in idle:
+                del self._models[key]
+                del self._last_used[key]
+        if len(idle) > 0:
+            # A query engine that is reranking keeps its reference until it is done
+            gc.collect()
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+            print(f"Unloaded idle rerank models: {[key[0] for key in idle]}")
+        return [key[0] for key in idle]
+
+    def _start_reaper(self) -> None:
+        if self.idle_timeout is None or self._reaper is not None:
+            return
+        interval = min(self.idle_timeout / 2, 60)
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.unload_idle()
+        self._reaper = threading.Thread(target=reap, name="reranker-reaper", daemon=True)
+        self._reaper.start()
+
+RERANKER_REGISTRY = RerankerRegistry()
+
+class PairScoreCache:
+    """LRU cache of cross-encoder scores keyed by model, query hash and node id.
+
+    A refine step or a repeated question reranks the same nodes for the same query,
+    their scores are taken from here instead of the model.
+    """
+
+    def __init__(self, max_size: int = RERANKER_SCORE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._scores: "OrderedDict[Tuple[str, str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def query_hash(query: str) -> str:
+        return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[Tuple[str, str, str]]) -> Dict[Tuple[str, str, str], float]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                score = self._scores.get(key)
+                if score is not None:
+                    self._scores.move_to_end(key)
+                    found[key] = score
+        return found
+
+    def put_many(self, scores: Dict[Tuple[str, str, str], float]) -> None:
+        with self._lock:
+            for key, score in scores.items():
+                self._scores[key] = score
+                self._scores.move_to_end(key)
+            while len(self._scores) > self.max_size:
+                self._scores.popitem(last=False)
+
+PAIR_SCORE_CACHE = PairScoreCache()
+
+def length_bucketed_batches(lengths: List[int], batch_size: int, batch_tokens: int) -> List[List[int]]:
+    """Group item indices into batches of similar length.
+
+    Items are sorted by length, so little padding is added in a batch, and a batch is closed
+    when it has batch_size items or its padded size (items x longest item) would exceed batch_tokens.
+    """
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # Sorted ascending, so the current item is the longest of the batch
+        if len(batch) > 0 and (len(batch) >= batch_size or (len(batch) + 1) * lengths[i] > batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+class SharedSentenceTransformerRerank(SentenceTransformerRerank):
+    """SentenceTransformerRerank whose cross-encoder comes from RERANKER_REGISTRY.
+
+    Creating it does not load the model again, so a query engine can be created per
+    chat turn or per session with any top_n. Pairs are truncated to max_length tokens,
+    scored in length-bucketed batches, and their scores are cached in PAIR_SCORE_CACHE.
+    """
+
+    max_length: int = Field(default=RERANKER_MAX_LENGTH, description="Maximum tokens of a (query, passage) pair.")
+    batch_size: int = Field(default=RERANKER_BATCH_SIZE, description="Maximum pairs per batch.")
+    batch_tokens: int = Field(default=RERANKER_BATCH_TOKENS, description="Maximum padded tokens per batch.")
+    backend: str = Field(default="torch", description="torch, onnx or onnx-int8 (ONNX Runtime).")
+
+    def __init__(
+        self,
+        top_n: int = 2,
+        model: str = "cross-encoder/stsb-distilroberta-base",
+        device: Optional[str] = None,
+        keep_retrieval_score: Optional[bool] = False,
+        **kwargs: Any,
+    ):
+        device = infer_torch_device() if device is None else device
+        # Skip SentenceTransformerRerank.__init__, which loads its own model
+        super(SentenceTransformerRerank, self).__init__(top_n=top_n, model=model, device=device, keep_retrieval_score=keep_retrieval_score, **kwargs)
+        self._model = None
+
+    def _score(self, cross_encoder: Any, query: str, passages: List[str]) -> List[float]:
+        # Lengths in characters stand in for tokens (about one token per Chinese character), capped by truncation
+        lengths = [min(len(query) + len(passage), self.max_length) for passage in passages]
+        scores = [0.0] * len(passages)
+        for batch in length_bucketed_batches(lengths, self.batch_size, self.batch_tokens):
+            batch_scores = cross_encoder.predict(
+                [(query, passages[i]) for i in batch], batch_size=len(batch), show_progress_bar=False,
+            )
+            for i, score in zip(batch, batch_scores):
+                scores[i] = float(score)
+        return scores
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SharedSentenceTransformerRerank"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if len(nodes) == 0:
+            return []
+        query_hash = PAIR_SCORE_CACHE.query_hash(query_bundle.query_str)
+        keys = [(f"{self.model}:{self.max_length}:{self.backend}", query_hash, node.node.node_id) for node in nodes]
+        cached = PAIR_SCORE_CACHE.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+
+        with self.callback_manager.event(
+            CBEventType.RERANKING,
+            payload={
+                EventPayload.NODES: nodes,
+                EventPayload.MODEL_NAME: self.model,
+                EventPayload.QUERY_STR: query_bundle.query_str,
+                EventPayload.TOP_K: self.top_n,
+            },
+        ) as event:
+            if len(missing) > 0:
+                # Looked up on every call, the model may have been unloaded while idle
+                cross_encoder = RERANKER_REGISTRY.get(self.model, self.device, self.max_length, self.backend)
+                passages = [nodes[i].node.get_content(metadata_mode=MetadataMode.EMBED) for i in missing]
+                computed = self._score(cross_encoder, query_bundle.query_str, passages)
+                computed = {keys[i]: score for i, score in zip(missing, computed)}
+                PAIR_SCORE_CACHE.put_many(computed)
+                cached.update(computed)
+            scores = [cached[key] for key in keys]
+            for node, score in zip(nodes, scores):
+                if self.keep_retrieval_score:
+                    # keep the retrieval score in metadata
+                    node.node.metadata["retrieval_score"] = node.score
+                node.score = score
+            new_nodes = sorted(nodes, key=lambda x: -x.score if x.score else 0)[:self.top_n]
+            event.on_end(payload={EventPayload.NODES: new_nodes})
+        return new_nodes
+
 def create_reranker_model(model_name = DEFAULT_RERANKER_MODEL, top_n = RERANKER_MODEL_TOP_N) -> SentenceTransformerRerank:
     try:
         use_hf_mirror()
-        model_path = RERANKER_MODEL_PATH[model_name]
+        model_path, backend = parse_model_entry(RERANKER_MODEL_PATH[model_name])
         if MODEL_DIR is not None:
             path = f"./{MODEL_DIR}/{model_path}"
             if os.path.exists(path): # Use local models if the path exists
                 model_path = path
-        rerank_model = SentenceTransformerRerank(model=model_path, top_n=top_n)
+        # ONNX Runtime runs on the CPU, so the torch device is not inferred
+        device = "cpu" if backend != "torch" else None
+        rerank_model = SharedSentenceTransformerRerank(model=model_path, top_n=top_n, device=device, backend=backend)
+        RERANKER_REGISTRY.get(rerank_model.model, rerank_model.device, rerank_model.max_length, rerank_model.backend) # load now, so that a missing model is reported here
         print(f"created rerank model: {model_name}")
         return rerank_model
     except Exception as e:
-        return None
\ No newline at end of file
+        print(f"An error occurred while creating the rerank model: {type(e).__name__}: {e}")
+        return None
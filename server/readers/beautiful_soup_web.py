@@ -60,14 +60,19 @@ class BeautifulSoupWebReader(BasePydanticReader):
         urls: List[str],
         custom_hostname: Optional[str] = None,
         include_url_in_text: Optional[bool] = True,
+        skip_failed: bool = False,
     ) -> List[Document]:
         """Load data from the urls.
 
+        The pages are fetched concurrently, see server/utils/web_fetch.py.
+
         Args:
             urls (List[str]): List of URLs to scrape.
             custom_hostname (Optional[str]): Force a certain hostname in the case
                 a website is displayed under custom URLs (e.g. Substack blogs)
             include_url_in_text (Optional[bool]): Include the reference url in the text of the document
+            skip_failed (bool): Skip the pages that could not be fetched or scraped instead of
+                raising a ValueError once all pages are fetched
 
         Returns:
             List[Document]: List of documents.
@@ -75,13 +80,17 @@ class BeautifulSoupWebReader(BasePydanticReader):
         """
         from urllib.parse import urlparse
 
-        import requests
         from bs4 import BeautifulSoup
+        from server.utils.web_fetch import get_web_fetcher
 
         documents = []
-        for url in urls:
+        failed_urls = []
+        for result in get_web_fetcher().fetch_all(urls):
+            url = result.url
             try:
-                page = requests.get(url)
+                if not result.ok:
+                    raise result.error
+                page = result.response
                 hostname = custom_hostname or urlparse(url).hostname or ""
 
                 soup = BeautifulSoup(page.content, "html.parser")
@@ -102,8 +111,10 @@ class BeautifulSoupWebReader(BasePydanticReader):
                     data = soup.getText()
 
                 documents.append(Document(text=data, id_=url, extra_info=extra_info))
-            except Exception:
-                print(f"Could not scrape {url}")
-                raise ValueError(f"One of the inputs is not a valid url: {url}")
+            except Exception as e:
+                print(f"Could not scrape {url}: {e}")
+                failed_urls.append(url)
 
+        if len(failed_urls) > 0 and not skip_failed:
+            raise ValueError(f"Some of the inputs could not be scraped: {failed_urls}")
         return documents
@@ -1,9 +1,11 @@
 from typing import List, Optional, Dict, Callable
 from datetime import datetime
 
-import requests, re
+import re
 from llama_index.core.readers.base import BasePydanticReader
 from llama_index.core.schema import Document
+from server.utils.web_fetch import get_web_fetcher
+from config import JINA_READER_URL
 
 
 class JinaWebReader(BasePydanticReader):
@@ -16,11 +18,15 @@ class JinaWebReader(BasePydanticReader):
     def __init__(self) -> None:
         """Initialize with parameters."""
 
-    def load_data(self, urls: List[str]) -> List[Document]:
+    def load_data(self, urls: List[str], skip_failed: bool = False) -> List[Document]:
         """Load data from the input directory.
 
+        The pages are fetched concurrently through Jina Reader, see server/utils/web_fetch.py.
+
         Args:
             urls (List[str]): List of URLs to scrape.
+            skip_failed (bool): Skip the pages that could not be fetched instead of
+                raising a ValueError once all pages are fetched
 
         Returns:
             List[Document]: List of documents.
@@ -30,10 +36,14 @@ class JinaWebReader(BasePydanticReader):
             raise ValueError("urls must be a list of strings.")
 
         documents = []
-        for url in urls:
-            new_url = "https://r.jina.ai/" + url
-            response = requests.get(new_url)
-            text = response.text
+        failed_urls = []
+        results = get_web_fetcher().fetch_all([JINA_READER_URL + url for url in urls])
+        for url, result in zip(urls, results):
+            if not result.ok:
+                print(f"Could not fetch {url}: {result.error}")
+                failed_urls.append(url)
+                continue
+            text = result.response.text
 
             # Extract Title
             title_match = re.search(r"Title:\s*(.*)", text)
@@ -56,4 +66,6 @@ class JinaWebReader(BasePydanticReader):
 
             documents.append(Document(text=markdown_content, id_=url, metadata=metadata or {}))
 
+        if len(failed_urls) > 0 and not skip_failed:
+            raise ValueError(f"Some of the inputs could not be fetched: {failed_urls}")
         return documents
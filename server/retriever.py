@@ -1,85 +1,127 @@
 # Retriever method
 
+import time
+import heapq
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from enum import Enum
+from typing import Dict, List, Optional, Sequence
+import numpy as np
 from llama_index.core.retrievers import BaseRetriever
 from llama_index.core.retrievers import VectorIndexRetriever
-from llama_index.retrievers.bm25 import BM25Retriever
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import MetadataFilters
+from server.stores.bm25_store import BM25Index, chinese_tokenizer
+from server.stores.metadata_index import filter_nodes
+from config import HYBRID_RETRIEVAL_TIMEOUT, HYBRID_RETRIEVAL_WORKERS, HYBRID_FUSION_MODE, HYBRID_RETRIEVER_WEIGHTS, RRF_K
+from config import VECTOR_POST_FILTER_FACTOR, VECTOR_POST_FILTER_MAX_K
+
+def get_existing_nodes(docstore, node_ids: List[str]) -> List[Optional[BaseNode]]:
+    """The nodes of node_ids in the docstore, None for the ids it does not hold.
+
+    docstore.get_nodes(raise_error=False) still raises ValueError for a missing id.
+    """
+    nodes = [docstore.get_document(node_id, raise_error=False) for node_id in node_ids]
+    return [node if isinstance(node, BaseNode) else None for node in nodes]
 
 # A simple BM25 retrieval method, customized for document storage and tokenization
 
-# BM25Retriever's default tokenizer does not support Chinese
-# Reference：https://github.com/run-llama/llama_index/issues/13866
+# Scores come from the persisted inverted index in server/stores/bm25_store.py,
+# which IndexManager keeps up to date, so creating the retriever does not
+# re-tokenize the whole docstore. Only the top-k nodes are read from the docstore.
+# Metadata filters restrict the scored nodes in the index, before the top-k are taken.
 
-import jieba
-from typing import List
-def chinese_tokenizer(text: str) -> List[str]:
-    return list(jieba.cut(text))
+class SimpleBM25Retriever(BaseRetriever):
+    def __init__(
+        self,
+        docstore,
+        bm25_index: Optional[BM25Index] = None,
+        similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
+        filters: Optional[MetadataFilters] = None,
+        verbose: bool = False,
+    ) -> None:
+        self.docstore = docstore
+        self.bm25_index = bm25_index if bm25_index is not None else BM25Index(persist_path=None)
+        self.similarity_top_k = similarity_top_k
+        self.filters = filters
+        super().__init__(verbose=verbose)
 
-class SimpleBM25Retriever(BM25Retriever):
     @classmethod
-    def from_defaults(cls, index, similarity_top_k, **kwargs) -> "BM25Retriever":
+    def from_defaults(cls, index, similarity_top_k, bm25_index: Optional[BM25Index] = None, filters: Optional[MetadataFilters] = None, **kwargs) -> "SimpleBM25Retriever":
         docstore = index.docstore
-        return BM25Retriever.from_defaults(
-            docstore=docstore, similarity_top_k=similarity_top_k, verbose=True,
-            tokenizer=chinese_tokenizer, **kwargs
+        if bm25_index is None: # the knowledge base's index, see KnowledgeBase in server/index.py
+            bm25_index = BM25Index(persist_path=None) # kept in memory, built from the docstore below
+        if len(bm25_index) == 0:
+            # Build the inverted index once for a knowledge base created before the BM25 store existed
+            nodes = list(docstore.docs.values())
+            if len(nodes) > 0:
+                bm25_index.add_nodes(nodes)
+                bm25_index.persist()
+                print(f"Built BM25 index with {len(nodes)} nodes")
+        return cls(
+            docstore=docstore, bm25_index=bm25_index, similarity_top_k=similarity_top_k, filters=filters, verbose=True,
         )
 
-# A simple hybrid retriever method
-# Reference：https://docs.llamaindex.ai/en/stable/examples/retrievers/bm25_retriever/
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        query_tokens = chinese_tokenizer(query_bundle.query_str)
+        scores = self.bm25_index.get_scores(query_tokens, filters=self.filters)
+        # Take more candidates than needed in case some nodes are missing from the docstore
+        top_ids = heapq.nlargest(self.similarity_top_k * 2, scores, key=scores.get)
+        results = [
+            NodeWithScore(node=node, score=scores[node_id])
+            for node_id, node in zip(top_ids, get_existing_nodes(self.docstore, top_ids)) if node is not None
+        ]
+        return results[:self.similarity_top_k]
 
-class SimpleHybridRetriever(BaseRetriever):
-    def __init__(self, vector_index, top_k=2):
-        self.top_k = top_k
+# Vector retrieval with metadata filters
+# The local vector stores (MmapVectorStore, HnswVectorStore) index the filterable metadata and apply
+# the filters before scoring. Other vector stores get a larger top_k and their results are filtered here.
 
-        # Build vector retriever from vector index
-        self.vector_retriever = VectorIndexRetriever(
-            index=vector_index, similarity_top_k=top_k, verbose=True,
-        )
+class PostFilteredVectorRetriever(BaseRetriever):
+    """Vector retriever for stores that cannot apply the metadata filters themselves.
 
-        # Build BM25 retriever from document storage
-        self.bm25_retriever = SimpleBM25Retriever.from_defaults(
-            index=vector_index, similarity_top_k=top_k,
-        )
+    top_k * fetch_factor candidates are retrieved without filters and filtered with
+    filter_nodes. While fewer than top_k match and the store had more candidates, the
+    number of candidates is doubled, up to max_k.
+    """
 
-        super().__init__()
+    def __init__(
+        self,
+        index,
+        filters: MetadataFilters,
+        similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
+        fetch_factor: int = VECTOR_POST_FILTER_FACTOR,
+        max_k: int = VECTOR_POST_FILTER_MAX_K,
+        verbose: bool = False,
+    ) -> None:
+        self._index = index
+        self.filters = filters
+        self.similarity_top_k = similarity_top_k
+        self.fetch_factor = fetch_factor
+        self.max_k = max(max_k, similarity_top_k)
+        super().__init__(verbose=verbose)
 
-    def _retrieve(self, query, **kwargs):
-        bm25_nodes = self.bm25_retriever.retrieve(query, **kwargs)
-
-        # the score is related to the query and may exceed 1, thus normalization is required
-        # calculate min and max value
-        min_score = min(item.score for item in bm25_nodes)
-        max_score = max(item.score for item in bm25_nodes)
-
-        # normalize score
-        normalized_data = [(item.score - min_score) / (max_score - min_score) for item in bm25_nodes]
-
-        # Assign normalized score back to the original object
-        for item, normalized_score in zip(bm25_nodes, normalized_data):
-            item.score = normalized_score
-
-        vector_nodes = self.vector_retriever.retrieve(query, **kwargs)
-
-        # Merge two retrieval results, remove duplicates, and return only the Top_K results
-        all_nodes = []
-        node_ids = set()
-        count = 0
-        for n in vector_nodes + bm25_nodes:
-            if n.node.node_id not in node_ids:
-                all_nodes.append(n)
-                node_ids.add(n.node.node_id)
-                count += 1
-            if count >= self.top_k:
-                break
-        for node in all_nodes:
-            print(f"Hybrid Retrieved Node: {node.node_id} - Score: {node.score:.2f} - {node.text[:10]}...\n-----")
-        return all_nodes
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        fetch_k = min(self.similarity_top_k * self.fetch_factor, self.max_k)
+        while True:
+            # A retriever per size, the query embedding is computed once and kept in query_bundle
+            nodes = VectorIndexRetriever(index=self._index, similarity_top_k=fetch_k).retrieve(query_bundle)
+            matches = filter_nodes(nodes, self.filters)
+            if len(matches) >= self.similarity_top_k or len(nodes) < fetch_k or fetch_k >= self.max_k:
+                return matches[:self.similarity_top_k]
+            fetch_k = min(2 * fetch_k, self.max_k)
 
-# Fusion retriever method
+def create_vector_retriever(index, similarity_top_k: int, filters: Optional[MetadataFilters] = None, verbose: bool = False) -> BaseRetriever:
+    # Stores with a complete metadata index apply the filters, see server/stores/metadata_index.py
+    if filters is None or getattr(index.vector_store, "metadata_complete", False):
+        return VectorIndexRetriever(index=index, similarity_top_k=similarity_top_k, filters=filters, verbose=verbose)
+    return PostFilteredVectorRetriever(index=index, filters=filters, similarity_top_k=similarity_top_k, verbose=verbose)
+
+# Score fusion
 # Reference: https://docs.llamaindex.ai/en/stable/examples/retrievers/relative_score_dist_fusion/
 #            https://medium.com/plain-simple-software/distribution-based-score-fusion-dbsf-a-new-approach-to-vector-search-ranking-f87c37488b18
-#            https://docs.llamaindex.ai/en/stable/examples/low_level/fusion_retriever/?h=retrieverqueryengine
-from llama_index.core.retrievers import QueryFusionRetriever
-from enum import Enum
 
 # Three different modes, from LlamaIndex's source code
 class FUSION_MODES(str, Enum):
@@ -88,27 +130,207 @@ class FUSION_MODES(str, Enum):
     DIST_BASED_SCORE = "dist_based_score"  # apply distance-based score fusion
     SIMPLE = "simple"  # simple re-ordering of results based on original scores
 
-class SimpleFusionRetriever(QueryFusionRetriever):
-    def __init__(self, vector_index, top_k=2, mode=FUSION_MODES.DIST_BASED_SCORE):
+def check_fusion_weights(weights: Sequence[float]) -> np.ndarray:
+    """The weights as an array, raises ValueError unless they are finite, >= 0 and their sum is > 0."""
+    weights = np.asarray(weights, dtype=np.float64)
+    if not np.all(np.isfinite(weights)) or np.any(weights < 0) or not weights.sum() > 0:
+        raise ValueError(f"Fusion weights must be finite and >= 0 with a sum > 0, got {list(weights)}")
+    return weights
+
+def fuse_scores(scores: np.ndarray, mode: str, weights: Optional[Sequence[float]] = None, rrf_k: int = RRF_K) -> np.ndarray:
+    """Fuse a (retrievers, nodes) score matrix into one score per node.
+
+    NaN marks a node missing from the results of a retriever. Scores are normalized per
+    retriever, a retriever whose scores are all equal (e.g. a single result) gets 1.0 for
+    all its nodes. Normalized scores are weighted and summed, missing scores count as 0.
+    The ranks for reciprocal rank fusion are the positions in the score order of each retriever.
+    """
+    mode = FUSION_MODES(mode)
+    num_retrievers = scores.shape[0]
+    weights = np.ones(num_retrievers) if weights is None else check_fusion_weights(weights)
+    if len(weights) != num_retrievers:
+        raise ValueError(f"Got {len(weights)} weights for {num_retrievers} retrievers")
+    weights = weights / weights.sum()
+    present = ~np.isnan(scores)
+    if mode == FUSION_MODES.SIMPLE:
+        return np.where(present, scores, -np.inf).max(axis=0)
+    if mode == FUSION_MODES.RECIPROCAL_RANK:
+        # Missing nodes sort last, their ranks are masked below
+        ranks = np.argsort(np.argsort(-np.where(present, scores, -np.inf), axis=1, kind="stable"), axis=1, kind="stable")
+        normalized = 1.0 / (rrf_k + ranks + 1)
+    else:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if mode == FUSION_MODES.RELATIVE_SCORE:
+                lower = np.where(present, scores, np.inf).min(axis=1, keepdims=True)
+                upper = np.where(present, scores, -np.inf).max(axis=1, keepdims=True)
+            else:
+                # Distribution-based: the range is mean +/- 3 standard deviations
+                counts = np.maximum(present.sum(axis=1, keepdims=True), 1)
+                mean = np.where(present, scores, 0.0).sum(axis=1, keepdims=True) / counts
+                std = np.sqrt(np.where(present, (scores - mean) ** 2, 0.0).sum(axis=1, keepdims=True) / counts)
+                lower, upper = mean - 3 * std, mean + 3 * std
+            span = upper - lower
+            normalized = np.where(span > 0, (scores - lower) / span, 1.0)
+    return (weights[:, None] * np.where(present, normalized, 0.0)).sum(axis=0)
+
+def fuse_results(
+    results: Sequence[List[NodeWithScore]],
+    mode: str = HYBRID_FUSION_MODE,
+    weights: Optional[Sequence[float]] = None,
+    top_k: Optional[int] = None,
+    rrf_k: int = RRF_K,
+) -> List[NodeWithScore]:
+    """Fuse the results of several retrievers, a node found by several retrievers is returned once."""
+    columns: Dict[str, int] = {} # node id -> column of the score matrix
+    fused_nodes = []
+    entries = [] # (row, column, score)
+    for row, nodes in enumerate(results):
+        seen = set()
+        for node_with_score in nodes:
+            node_id = node_with_score.node.node_id
+            if node_id in seen:
+                continue
+            seen.add(node_id)
+            if node_id not in columns:
+                columns[node_id] = len(columns)
+                fused_nodes.append(node_with_score.node)
+            entries.append((row, columns[node_id], node_with_score.score or 0.0))
+    if len(fused_nodes) == 0:
+        return []
+    scores = np.full((len(results), len(fused_nodes)), np.nan)
+    rows, cols, values = zip(*entries)
+    scores[list(rows), list(cols)] = values
+    fused_scores = fuse_scores(scores, mode, weights, rrf_k)
+    order = np.argsort(-fused_scores, kind="stable")[:top_k]
+    return [NodeWithScore(node=fused_nodes[i], score=float(fused_scores[i])) for i in order]
+
+# A simple hybrid retriever method
+# Reference：https://docs.llamaindex.ai/en/stable/examples/retrievers/bm25_retriever/
+
+# Threads running the retrieval legs, shared by all hybrid retrievers of the process, see HYBRID_RETRIEVAL_WORKERS
+_RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=HYBRID_RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+# Latencies of the legs of the last hybrid retrieval in the current context (thread or task), None for a
+# dropped leg. Unlike last_latencies of the shared retriever, concurrent queries do not overwrite each other.
+RETRIEVAL_LATENCIES: contextvars.ContextVar[Optional[Dict[str, Optional[float]]]] = contextvars.ContextVar("retrieval_latencies", default=None)
+
+def retrieval_degraded() -> bool:
+    """Whether a leg of the last hybrid retrieval in the current context was dropped."""
+    latencies = RETRIEVAL_LATENCIES.get()
+    return latencies is not None and None in latencies.values()
+
+class SimpleHybridRetriever(BaseRetriever):
+    """Runs the vector and BM25 retrievers concurrently and fuses their results.
+
+    Each leg has timeout seconds from the start of the retrieval. A leg that times out or
+    fails is dropped, so the answer degrades to the results of the other leg. The latency
+    of each leg in milliseconds is kept in last_latencies and in RETRIEVAL_LATENCIES (None
+    for a dropped leg). A leg still queued in the executor at the deadline does not run.
+    Results are fused with fuse_results, weights are for the vector and BM25 legs.
+    Both legs apply the metadata filters before ranking, so the top_k are taken among matching nodes.
+    """
+
+    def __init__(
+        self,
+        vector_index,
+        top_k=2,
+        timeout: float = HYBRID_RETRIEVAL_TIMEOUT,
+        mode: str = HYBRID_FUSION_MODE,
+        weights: Sequence[float] = HYBRID_RETRIEVER_WEIGHTS,
+        bm25_index: Optional[BM25Index] = None,
+        filters: Optional[MetadataFilters] = None,
+    ):
         self.top_k = top_k
+        self.timeout = timeout
         self.mode = mode
+        check_fusion_weights(weights) # fail here rather than on the first query
+        self.weights = weights
+        self.last_latencies: Dict[str, Optional[float]] = {}
 
         # Build vector retriever from vector index
-        self.vector_retriever = VectorIndexRetriever(
-            index=vector_index, similarity_top_k=top_k, verbose=True,
+        self.vector_retriever = create_vector_retriever(
+            vector_index, similarity_top_k=top_k, filters=filters, verbose=True,
         )
 
         # Build BM25 retriever from document storage
         self.bm25_retriever = SimpleBM25Retriever.from_defaults(
-            index=vector_index, similarity_top_k=top_k,
+            index=vector_index, similarity_top_k=top_k, bm25_index=bm25_index, filters=filters,
         )
 
-        super().__init__(
-            [self.vector_retriever, self.bm25_retriever],
-            retriever_weights=[0.6, 0.4],
-            similarity_top_k=top_k,
-            num_queries=1,  # set this to 1 to disable query generation
-            mode=mode,
-            use_async=True,
-            verbose=True,
-        )
\ No newline at end of file
+        super().__init__()
+
+    def _legs(self) -> Dict[str, BaseRetriever]:
+        return {"vector": self.vector_retriever, "bm25": self.bm25_retriever}
+
+    @staticmethod
+    def _timed_retrieve(retriever: BaseRetriever, query, deadline: float, **kwargs):
+        if time.monotonic() >= deadline: # waited in the queue for the whole timeout
+            raise FutureTimeoutError("queued until the deadline")
+        start = time.perf_counter()
+        nodes = retriever.retrieve(query, **kwargs)
+        return nodes, (time.perf_counter() - start) * 1000
+
+    def _collect(self, results: Dict[str, object]) -> Dict[str, List[NodeWithScore]]:
+        # results maps each leg to (nodes, latency), or to the exception that dropped it
+        nodes = {}
+        self.last_latencies = {}
+        for name, result in results.items():
+            if isinstance(result, BaseException):
+                reason = "timed out" if isinstance(result, (FutureTimeoutError, asyncio.TimeoutError)) else f"failed: {type(result).__name__}: {result}"
+                print(f"Hybrid retrieval: {name} leg {reason}, using the other leg only")
+                nodes[name] = []
+                self.last_latencies[name] = None
+            else:
+                nodes[name], self.last_latencies[name] = result
+        RETRIEVAL_LATENCIES.set(dict(self.last_latencies))
+        print("Hybrid retrieval latency: " + ", ".join(
+            f"{name} {'dropped' if latency is None else f'{latency:.1f} ms'}" for name, latency in self.last_latencies.items()
+        ))
+        return nodes
+
+    def _retrieve(self, query_bundle, **kwargs):
+        deadline = time.monotonic() + self.timeout
+        futures = {
+            # Copy the context, so the legs are traced under the span of this retrieval
+            name: _RETRIEVAL_EXECUTOR.submit(contextvars.copy_context().run, self._timed_retrieve, retriever, query_bundle, deadline, **kwargs)
+            for name, retriever in self._legs().items()
+        }
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except Exception as e:
+                future.cancel() # only stops a leg that has not started
+                results[name] = e
+        return self._merge(**self._collect(results))
+
+    async def _aretrieve(self, query_bundle, **kwargs):
+        loop = asyncio.get_running_loop()
+        names = list(self._legs().keys())
+        deadline = time.monotonic() + self.timeout
+        # BM25 scoring is synchronous CPU work, so both legs run in the executor instead of the event loop.
+        # wait_for cancels the executor future of a leg that times out, which stops it if it is still queued
+        tasks = [
+            asyncio.wait_for(
+                loop.run_in_executor(_RETRIEVAL_EXECUTOR, contextvars.copy_context().run, lambda retriever=retriever: self._timed_retrieve(retriever, query_bundle, deadline, **kwargs)),
+                timeout=self.timeout,
+            )
+            for retriever in self._legs().values()
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        return self._merge(**self._collect(dict(zip(names, results))))
+
+    def _merge(self, vector: List[NodeWithScore], bm25: List[NodeWithScore]) -> List[NodeWithScore]:
+        # BM25 scores are related to the query and may exceed 1, fusion normalizes them
+        all_nodes = fuse_results([vector, bm25], mode=self.mode, weights=self.weights, top_k=self.top_k)
+        for node in all_nodes:
+            print(f"Hybrid Retrieved Node: {node.node_id} - Score: {node.score:.2f} - {node.text[:10]}...\n-----")
+        return all_nodes
+
+# Fusion retriever method
+# Reference: https://docs.llamaindex.ai/en/stable/examples/low_level/fusion_retriever/?h=retrieverqueryengine
+
+# The hybrid retriever with distribution-based score fusion by default, used by the query engine
+class SimpleFusionRetriever(SimpleHybridRetriever):
+    def __init__(self, vector_index, top_k=2, mode=FUSION_MODES.DIST_BASED_SCORE, weights: Sequence[float] = HYBRID_RETRIEVER_WEIGHTS, bm25_index: Optional[BM25Index] = None, filters: Optional[MetadataFilters] = None):
+        super().__init__(vector_index, top_k=top_k, mode=mode, weights=weights, bm25_index=bm25_index, filters=filters)
@@ -1,3 +1,15 @@
-from .chinese_text_splitter import ChineseTextSplitter
-from .zh_title_enhance import ChineseTitleExtractor
-from .chinese_recursive_text_splitter import ChineseRecursiveTextSplitter
\ No newline at end of file
+# Splitters are imported on first access: the Chinese text splitters import langchain
+import importlib
+
+_MODULES = {
+    "ChineseTextSplitter": ".chinese_text_splitter",
+    "ChineseTitleExtractor": ".zh_title_enhance",
+    "ChineseRecursiveTextSplitter": ".chinese_recursive_text_splitter",
+}
+
+__all__ = list(_MODULES)
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_MODULES[name], __name__), name)
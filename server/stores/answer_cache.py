@@ -0,0 +1,140 @@
+# Answer Cache
+# Final answers of the query engine with their source node ids, matched by exact query hash and
+# optionally by query embedding similarity. Entries are invalidated when a cited ref doc is
+# deleted or re-ingested through IndexManager.
+# An answer depends on the query alone: the query engine answers one question at a time and the
+# chat history is never passed to it (see frontend/Document_QA.py and server/api.py). A caller that
+# conditions answers on the history must fold it into the query or the settings_key.
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+from server.stores.embedding_cache import normalize_query
+from config import ANSWER_CACHE_SIZE, ANSWER_CACHE_SIMILARITY_THRESHOLD
+
+class CachedAnswer:
+    def __init__(
+        self,
+        query: str,
+        answer: str,
+        sources: List[Tuple[str, Optional[float]]],
+        ref_doc_ids: Set[str],
+        settings_key: str,
+        embedding: Optional[List[float]] = None,
+    ) -> None:
+        self.query = query
+        self.answer = answer
+        self.sources = sources # (node_id, score)
+        self.ref_doc_ids = ref_doc_ids
+        self.settings_key = settings_key
+        self.embedding = embedding
+
+def _unit_vector(embedding: List[float]) -> Optional[np.ndarray]:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+class AnswerCache:
+    """LRU cache of answers keyed by query engine settings and normalized query.
+
+    settings_key identifies the query engine (index, retrieval settings and LLM), so
+    an answer is only reused by an engine configured the same way. With a similarity
+    threshold, the unit embeddings of a settings_key are stacked into a matrix on the
+    first lookup after a change, and a lookup is one matrix-vector product.
+    """
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, similarity_threshold: Optional[float] = ANSWER_CACHE_SIMILARITY_THRESHOLD) -> None:
+        self.max_size = max_size
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self._ref_docs: Dict[str, Set[str]] = {} # ref_doc_id -> keys of the answers citing it
+        self._vectors: Dict[str, np.ndarray] = {} # key -> unit embedding of the query
+        self._matrices: Dict[str, Tuple[List[str], np.ndarray]] = {} # settings_key -> (keys, embeddings), built on use
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(settings_key: str, query: str) -> str:
+        return hashlib.sha256(f"{settings_key}\n{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    def get(self, settings_key: str, query: str, embedding: Optional[List[float]] = None) -> Optional[CachedAnswer]:
+        """Find an answer by exact query, or by the most similar query embedding above the threshold."""
+        key = self._key(settings_key, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            if embedding is None or self.similarity_threshold is None:
+                return None
+            keys, matrix = self._matrix(settings_key)
+        vector = _unit_vector(embedding)
+        if len(keys) == 0 or vector is None or matrix.shape[1] != vector.shape[0]:
+            return None
+        # Outside the lock: the matrix is never modified, a change builds a new one
+        similarities = matrix @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        with self._lock:
+            entry = self._entries.get(keys[best])
+            if entry is not None: # unless it was evicted meanwhile
+                self._entries.move_to_end(keys[best])
+            return entry
+
+    def _matrix(self, settings_key: str) -> Tuple[List[str], np.ndarray]:
+        matrix = self._matrices.get(settings_key)
+        if matrix is None:
+            keys = [
+                key for key, entry in self._entries.items()
+                if entry.settings_key == settings_key and key in self._vectors
+            ]
+            vectors = [self._vectors[key] for key in keys]
+            matrix = (keys, np.stack(vectors) if len(vectors) > 0 else np.empty((0, 0), dtype=np.float32))
+            self._matrices[settings_key] = matrix
+        return matrix
+
+    def put(self, entry: CachedAnswer) -> None:
+        key = self._key(entry.settings_key, entry.query)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            if entry.embedding is not None and self.similarity_threshold is not None:
+                vector = _unit_vector(entry.embedding)
+                if vector is not None:
+                    self._vectors[key] = vector
+                    self._matrices.pop(entry.settings_key, None)
+            for ref_doc_id in entry.ref_doc_ids:
+                self._ref_docs.setdefault(ref_doc_id, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        if self._vectors.pop(key, None) is not None:
+            self._matrices.pop(entry.settings_key, None)
+        for ref_doc_id in entry.ref_doc_ids:
+            keys = self._ref_docs.get(ref_doc_id)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._ref_docs[ref_doc_id]
+
+    def invalidate_ref_docs(self, ref_doc_ids) -> None:
+        """Drop the answers that cite any of the ref docs."""
+        with self._lock:
+            for ref_doc_id in ref_doc_ids:
+                for key in list(self._ref_docs.get(ref_doc_id, ())):
+                    self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._ref_docs.clear()
+            self._vectors.clear()
+            self._matrices.clear()
+
+ANSWER_CACHE = AnswerCache()
@@ -0,0 +1,313 @@
+# BM25 Store
+# A persisted inverted index (term postings + document lengths) for BM25 retrieval.
+# It is stored next to the storage context and updated incrementally by IndexManager,
+# so that the BM25 corpus is not rebuilt from the docstore every time a query engine is created.
+# persist() appends the changes since the last call to a log next to the index file (tokenized
+# nodes added, ref docs deleted), so an insert costs the size of the inserted nodes. The log is
+# replayed when the index is loaded, and compacted into a new index file once it is larger than
+# BM25_LOG_COMPACT_RATIO of it.
+# Metadata filters restrict the nodes that are scored with a metadata index.
+
+import os
+import json
+import math
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import MetadataFilters
+from config import STORAGE_DIR, BM25_STORE_FILE, BM25_LOG_COMPACT_RATIO, BM25_K1, BM25_B
+from server.stores.metadata_index import MetadataIndex
+
+# BM25Retriever's default tokenizer does not support Chinese
+# Reference：https://github.com/run-llama/llama_index/issues/13866
+def chinese_tokenizer(text: str) -> List[str]:
+    import jieba # imported on first use, loading its dictionary is slow
+    return [token.lower() for token in jieba.cut(text) if token.strip()]
+
+PERSIST_PATH = "./" + STORAGE_DIR + "/" + BM25_STORE_FILE
+
+class BM25Index:
+    """Inverted index with BM25 scoring.
+
+    Postings map a term to {node_id: term frequency}, doc_lens maps a node_id to its
+    token count and ref_docs maps a ref_doc_id to the ids of its nodes, so that a
+    document can be removed without scanning the whole index.
+
+    The filterable metadata of the nodes is kept in a metadata index, whose positions
+    are assigned to node ids as they are added.
+
+    Changes not persisted yet are kept as log records. The index file has a generation,
+    and only the log records of the same generation are replayed over it: a crash after
+    a compaction replaced the file but before it removed the log cannot apply old records.
+    """
+
+    def __init__(
+        self,
+        postings: Optional[Dict[str, Dict[str, int]]] = None,
+        doc_lens: Optional[Dict[str, int]] = None,
+        ref_docs: Optional[Dict[str, List[str]]] = None,
+        metadata: Optional[Dict[str, Dict[str, Any]]] = None,
+        tokenizer: Callable[[str], List[str]] = chinese_tokenizer,
+        persist_path: Optional[str] = PERSIST_PATH, # None for an index kept in memory only
+    ) -> None:
+        self.postings: Dict[str, Dict[str, int]] = postings or {}
+        self.doc_lens: Dict[str, int] = doc_lens or {}
+        self.ref_docs: Dict[str, List[str]] = ref_docs or {}
+        self.total_len: int = sum(self.doc_lens.values())
+        self.tokenizer = tokenizer
+        self.persist_path = persist_path
+        self._lock = threading.RLock()
+        self._metadata_index = MetadataIndex()
+        self._position_by_node_id: Dict[str, int] = {}
+        self._node_by_position: List[Optional[str]] = []
+        self._generation = 0 # of the index file at persist_path
+        self._pending: List[Dict[str, Any]] = [] # log records of the changes not persisted yet
+        self._snapshot_needed = False # a change the log cannot record, e.g. the metadata of all nodes
+        # Nodes loaded without their metadata cannot be filtered until index_metadata is called
+        self.metadata_complete = metadata is not None or len(self.doc_lens) == 0
+        for node_id, node_metadata in (metadata or {}).items():
+            if node_id in self.doc_lens:
+                self._index_node_metadata(node_id, node_metadata)
+
+    def __len__(self) -> int:
+        return len(self.doc_lens)
+
+    def _add_node(self, node_id: str, ref_doc_id: Optional[str], term_counts: Dict[str, int], metadata: Dict[str, Any]) -> None:
+        for term, tf in term_counts.items():
+            self.postings.setdefault(term, {})[node_id] = tf
+        length = sum(term_counts.values())
+        self.doc_lens[node_id] = length
+        self.total_len += length
+        self._index_node_metadata(node_id, metadata)
+        if ref_doc_id is not None:
+            node_ids = self.ref_docs.setdefault(ref_doc_id, [])
+            if node_id not in node_ids:
+                node_ids.append(node_id)
+
+    def _index_node_metadata(self, node_id: str, metadata: Dict[str, Any]) -> None:
+        position = self._position_by_node_id.get(node_id)
+        if position is None:
+            position = len(self._node_by_position)
+            self._position_by_node_id[node_id] = position
+            self._node_by_position.append(node_id)
+        self._metadata_index.add(position, metadata)
+
+    def index_metadata(self, nodes: Iterable[BaseNode]) -> None:
+        """Index the metadata of nodes in the index, e.g. of nodes persisted before metadata was kept."""
+        with self._lock:
+            for node in nodes:
+                if node.node_id in self.doc_lens:
+                    self._index_node_metadata(node.node_id, node.metadata)
+            self.metadata_complete = True
+            self._snapshot_needed = True
+
+    def _remove_nodes(self, node_ids: Iterable[str]) -> None:
+        node_ids = {node_id for node_id in node_ids if node_id in self.doc_lens}
+        if len(node_ids) == 0:
+            return
+        for node_id in node_ids:
+            self.total_len -= self.doc_lens.pop(node_id)
+            position = self._position_by_node_id.pop(node_id, None)
+            if position is not None:
+                self._metadata_index.remove(position)
+                self._node_by_position[position] = None
+        # One pass over the vocabulary for the whole batch
+        empty_terms = []
+        for term, docs in self.postings.items():
+            for node_id in node_ids.intersection(docs):
+                del docs[node_id]
+            if len(docs) == 0:
+                empty_terms.append(term)
+        for term in empty_terms:
+            del self.postings[term]
+
+    def add_nodes(self, nodes: Iterable[BaseNode], replace_ref_docs: bool = False) -> None:
+        """Tokenize and add nodes; nodes already in the index are replaced.
+
+        With replace_ref_docs, the nodes of their ref docs are removed first, like the upserts of
+        the ingestion pipeline: a re-ingested document gets new node ids, its old nodes must go.
+        The removal and the insert are one log record.
+        """
+        nodes = list(nodes)
+        ref_doc_ids = list(dict.fromkeys(node.ref_doc_id for node in nodes if node.ref_doc_id is not None)) if replace_ref_docs else []
+        with self._lock:
+            self._remove_ref_docs(ref_doc_ids)
+            self._remove_nodes(node.node_id for node in nodes)
+            records = []
+            for node in nodes:
+                term_counts = dict(Counter(self.tokenizer(node.get_content())))
+                self._add_node(node.node_id, node.ref_doc_id, term_counts, node.metadata)
+                records.append({
+                    "node_id": node.node_id,
+                    "ref_doc_id": node.ref_doc_id,
+                    "terms": term_counts,
+                    "metadata": self._metadata_index.get(self._position_by_node_id[node.node_id]),
+                })
+            self._log({"op": "add", "ref_doc_ids": ref_doc_ids, "nodes": records})
+
+    def delete_ref_doc(self, ref_doc_id: str) -> None:
+        """Remove all nodes that belong to a ref doc."""
+        self.delete_ref_docs([ref_doc_id])
+
+    def delete_ref_docs(self, ref_doc_ids: Iterable[str]) -> None:
+        """Remove all nodes that belong to the ref docs, in one pass over the vocabulary."""
+        ref_doc_ids = list(ref_doc_ids)
+        with self._lock:
+            self._remove_ref_docs(ref_doc_ids)
+            self._log({"op": "delete", "ref_doc_ids": ref_doc_ids})
+
+    def node_ids(self, ref_doc_ids: Iterable[str]) -> List[str]:
+        """The ids of the nodes of the ref docs."""
+        with self._lock:
+            return [node_id for ref_doc_id in ref_doc_ids for node_id in self.ref_docs.get(ref_doc_id, [])]
+
+    def _remove_ref_docs(self, ref_doc_ids: Iterable[str]) -> None:
+        node_ids = []
+        for ref_doc_id in ref_doc_ids:
+            node_ids.extend(self.ref_docs.pop(ref_doc_id, []))
+        self._remove_nodes(node_ids)
+
+    def _log(self, record: Dict[str, Any]) -> None:
+        if self.persist_path is not None: # an index in memory has no log
+            self._pending.append(record)
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        # Replay a log record, like add_nodes or delete_ref_docs without tokenizing again
+        if record["op"] == "add":
+            self._remove_ref_docs(record.get("ref_doc_ids", []))
+            self._remove_nodes(node["node_id"] for node in record["nodes"])
+            for node in record["nodes"]:
+                self._add_node(node["node_id"], node["ref_doc_id"], node["terms"], node["metadata"])
+        elif record["op"] == "delete":
+            self._remove_ref_docs(record["ref_doc_ids"])
+
+    def _allowed_node_ids(self, filters: MetadataFilters) -> set:
+        mask = self._metadata_index.mask(filters, len(self._node_by_position))
+        return {self._node_by_position[position] for position in mask.nonzero()[0]} - {None}
+
+    def get_scores(self, query_tokens: List[str], filters: Optional[MetadataFilters] = None) -> Dict[str, float]:
+        """Compute Okapi BM25 scores for all nodes that share a term with the query.
+
+        With filters, only the nodes matching them are scored. IDF and the average
+        length are still those of the whole corpus, so scores do not depend on filters.
+        """
+        with self._lock:
+            n_docs = len(self.doc_lens)
+            if n_docs == 0:
+                return {}
+            allowed = self._allowed_node_ids(filters) if filters is not None else None
+            if allowed is not None and len(allowed) == 0:
+                return {}
+            avgdl = self.total_len / n_docs
+            scores: Dict[str, float] = {}
+            for term in query_tokens:
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                if allowed is None:
+                    matches = docs.items()
+                elif len(allowed) < len(docs): # walk the smaller side
+                    matches = [(node_id, docs[node_id]) for node_id in allowed if node_id in docs]
+                else:
+                    matches = [(node_id, tf) for node_id, tf in docs.items() if node_id in allowed]
+                for node_id, tf in matches:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lens[node_id] / avgdl)
+                    scores[node_id] = scores.get(node_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+            return scores
+
+    def persist(self, persist_path: Optional[str] = None) -> None:
+        """Append the changes since the last call to the log, compacting it when it grows too large.
+
+        The index file is written in full when it does not exist yet, for a persist_path other
+        than the index's own, and after index_metadata.
+        """
+        persist_path = persist_path or self.persist_path
+        if persist_path is None:
+            return
+        with self._lock:
+            if persist_path != self.persist_path:
+                self._write_snapshot(persist_path, generation=0)
+                return
+            if self._snapshot_needed or not os.path.exists(persist_path):
+                self.compact()
+                return
+            if len(self._pending) == 0:
+                return
+            log_path = persist_path + ".log"
+            lines = "".join(json.dumps({"generation": self._generation, **record}, ensure_ascii=False) + "\n" for record in self._pending)
+            with open(log_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending.clear()
+            if os.path.getsize(log_path) > BM25_LOG_COMPACT_RATIO * os.path.getsize(persist_path):
+                self.compact()
+
+    def compact(self) -> None:
+        """Write the whole index to a new index file of the next generation and remove the log."""
+        if self.persist_path is None:
+            return
+        with self._lock:
+            self._write_snapshot(self.persist_path, generation=self._generation + 1)
+            self._generation += 1
+            self._pending.clear()
+            self._snapshot_needed = False
+            log_path = self.persist_path + ".log"
+            if os.path.exists(log_path):
+                os.remove(log_path)
+
+    def _write_snapshot(self, persist_path: str, generation: int) -> None:
+        # Written atomically, so a crash mid-write cannot corrupt the previous file
+        dirpath = os.path.dirname(persist_path)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        data = {"generation": generation, "postings": self.postings, "doc_lens": self.doc_lens, "ref_docs": self.ref_docs}
+        if self.metadata_complete:
+            data["metadata"] = {node_id: self._metadata_index.get(position) for node_id, position in self._position_by_node_id.items()}
+        tmp_path = persist_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, persist_path)
+
+    def _replay(self, log_path: str) -> int:
+        # Apply the log records of this generation, dropping a trailing record cut short by a crash
+        num_records = 0
+        with open(log_path, "rb+") as f:
+            offset = 0
+            for line in f:
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    print(f"Dropped an incomplete record at byte {offset} of {log_path}")
+                    f.truncate(offset)
+                    break
+                if record["generation"] == self._generation:
+                    self._apply(record)
+                    num_records += 1
+                offset += len(line)
+        return num_records
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str = PERSIST_PATH) -> "BM25Index":
+        """Load the index from a persist path and replay its log, or create an empty one."""
+        if os.path.exists(persist_path):
+            with open(persist_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            index = cls(
+                postings=data["postings"],
+                doc_lens=data["doc_lens"],
+                ref_docs=data["ref_docs"],
+                metadata=data.get("metadata"),
+                persist_path=persist_path,
+            )
+            index._generation = data.get("generation", 0)
+            num_records = index._replay(persist_path + ".log") if os.path.exists(persist_path + ".log") else 0
+            print(f"Loaded BM25 index with {len(index)} nodes from {persist_path}, replayed {num_records} changes")
+            return index
+        else:
+            return cls(persist_path=persist_path)
@@ -1,6 +1,7 @@
 # Chat Store
 
 from config import DEV_MODE, REDIS_URI, CHAT_STORE_KEY
+from server.utils.lazy import lazy
 
 def create_chat_memory():
 
@@ -37,4 +38,5 @@ def create_chat_memory():
         )
         return redis_chat_memory
 
-CHAT_MEMORY = create_chat_memory()
\ No newline at end of file
+# Created on first use, so importing this module does not connect to Redis
+get_chat_memory = lazy(create_chat_memory)
@@ -19,16 +19,19 @@ class LocalKVStore(SimpleKVStore):
     ) -> None:
         """Init a SimpleKVStore."""
         super().__init__(data)
+        self.version = 0 # Incremented on every change, so caches can tell when settings are stale
 
     def put(self, key: str, val: dict) -> None:
         """Put a key-value pair into the store."""
         super().put(key=key, val=val)
+        self.version += 1
         super().persist(persist_path=self.persist_path)
 
     def delete(self, key: str) -> bool:
         """Delete a value from the store."""
         try:
             super().delete(key)
+            self.version += 1
             super().persist(persist_path=self.persist_path)
             return True
         except KeyError:
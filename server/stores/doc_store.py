@@ -3,11 +3,13 @@
 # https://docs.llamaindex.ai/en/stable/examples/docstore/RedisDocstoreIndexStoreDemo/
 import config
 
-if config.THINKRAG_ENV == "production":
-    from llama_index.storage.docstore.redis import RedisDocumentStore
-    DOC_STORE = RedisDocumentStore.from_host_and_port(
-        host=config.REDIS_HOST, port=config.REDIS_PORT, namespace="think"
-    )
-elif config.THINKRAG_ENV == "development":
-    from llama_index.core.storage.docstore import SimpleDocumentStore
-    DOC_STORE = SimpleDocumentStore()
\ No newline at end of file
+# Created by the storage context of a knowledge base, namespace keeps the Redis keys of knowledge bases apart
+def create_doc_store(namespace: str = "think"):
+    if config.THINKRAG_ENV == "production":
+        from llama_index.storage.docstore.redis import RedisDocumentStore
+        return RedisDocumentStore.from_host_and_port(
+            host=config.REDIS_HOST, port=config.REDIS_PORT, namespace=namespace
+        )
+    elif config.THINKRAG_ENV == "development":
+        from llama_index.core.storage.docstore import SimpleDocumentStore
+        return SimpleDocumentStore()
@@ -0,0 +1,191 @@
+# Embedding Cache
+# A local on-disk cache of embeddings keyed by model name + text hash, backed by SQLite so it works without Redis.
+# It is shared by the ingestion pipeline and query-time embedding, see server/models/embedding.py
+# Query embeddings are also kept in an in-process LRU (QueryEmbeddingCache), backed by Redis in production
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from config import STORAGE_DIR, EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_BYTES, QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL
+
+PERSIST_PATH = "./" + STORAGE_DIR + "/" + EMBEDDING_CACHE_FILE
+SQL_BATCH_SIZE = 500 # stay below SQLite's limit of query parameters
+
+def embedding_cache_key(model_name: str, kind: str, text: str) -> str:
+    # kind is "text" or "query", since models like bge add an instruction to queries
+    return hashlib.sha256(f"{model_name}\n{kind}\n{text}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """SQLite embedding cache with size-based LRU eviction.
+
+    Embeddings are stored as float32 blobs. When the total size of the blobs exceeds
+    max_bytes, the least recently used entries are deleted.
+    """
+
+    def __init__(self, persist_path: str = PERSIST_PATH, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES) -> None:
+        dirpath = os.path.dirname(persist_path)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        self.persist_path = persist_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(persist_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL") # readers do not block the writer, and a crash cannot corrupt the file
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        self.total_bytes: int = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Return the cached embeddings found for the keys."""
+        if len(keys) == 0:
+            return {}
+        results = {}
+        with self._lock:
+            unique_keys = list(set(keys))
+            for i in range(0, len(unique_keys), SQL_BATCH_SIZE):
+                batch = unique_keys[i:i + SQL_BATCH_SIZE]
+                rows = self._conn.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    results[key] = array("f", blob).tolist()
+            if len(results) > 0:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key in results]
+                )
+                self._conn.commit()
+        return results
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """Store embeddings and evict the least recently used entries if the cache is too large."""
+        if len(items) == 0:
+            return
+        now = time.time()
+        rows = []
+        for key, embedding in items.items():
+            blob = array("f", embedding).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            # Size of the entries that are replaced
+            existing = 0
+            for i in range(0, len(rows), SQL_BATCH_SIZE):
+                batch = [row[0] for row in rows[i:i + SQL_BATCH_SIZE]]
+                existing += self._conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchone()[0]
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self.total_bytes += sum(row[2] for row in rows) - existing
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # Evict down to 90% of max_bytes, so that eviction does not run on every insert
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while self.total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if len(rows) == 0:
+                break
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self.total_bytes -= size
+                evicted += 1
+        print(f"Evicted {evicted} embeddings from the embedding cache")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+def create_embedding_cache() -> Optional[EmbeddingCache]:
+    try:
+        return EmbeddingCache()
+    except sqlite3.Error as e:
+        print(f"An error occurred while creating the embedding cache: {type(e).__name__}: {e}")
+        return None
+
+def normalize_query(query: str) -> str:
+    # Queries that only differ by full-width characters or whitespace share a cache entry
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+class QueryEmbeddingCache:
+    """In-process LRU cache of query embeddings, optionally backed by Redis.
+
+    With Redis, embeddings computed by other processes are found on a local miss.
+    Hits and misses are counted, see stats().
+    """
+
+    def __init__(self, max_size: int = QUERY_EMBEDDING_CACHE_SIZE, redis_uri: Optional[str] = None, ttl: int = QUERY_EMBEDDING_CACHE_TTL) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        if redis_uri is not None:
+            import redis
+            self._redis = redis.Redis.from_url(redis_uri)
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            embedding = self._data.get(key)
+            if embedding is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return embedding
+        if self._redis is not None:
+            try:
+                blob = self._redis.get("query_embedding:" + key)
+            except Exception as e:
+                print(f"An error occurred while reading the query embedding cache: {type(e).__name__}: {e}")
+                blob = None
+            if blob is not None:
+                embedding = array("f", blob).tolist()
+                self._put_local(key, embedding)
+                with self._lock:
+                    self.hits += 1
+                return embedding
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _put_local(self, key: str, embedding: List[float]) -> None:
+        with self._lock:
+            self._data[key] = embedding
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def put(self, key: str, embedding: List[float]) -> None:
+        self._put_local(key, embedding)
+        if self._redis is not None:
+            try:
+                self._redis.set("query_embedding:" + key, array("f", embedding).tobytes(), ex=self.ttl)
+            except Exception as e:
+                print(f"An error occurred while writing the query embedding cache: {type(e).__name__}: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+            }
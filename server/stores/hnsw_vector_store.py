@@ -0,0 +1,293 @@
+# HNSW vector store
+# An in-process approximate nearest neighbour index for large local knowledge bases, based on hnswlib.
+# Recall and latency are tuned with HNSW_M, HNSW_EF_CONSTRUCTION and HNSW_EF_SEARCH in config.py.
+# Metadata filters select the candidate labels with a metadata index, the graph search only visits
+# them, and small candidate sets (HNSW_FILTER_BRUTE_FORCE) are scored exactly instead.
+
+# Install hnswlib
+""" pip install hnswlib """
+
+import os
+import json
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from config import STORAGE_DIR, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH, HNSW_FILTER_BRUTE_FORCE
+from server.stores.metadata_index import MetadataIndex
+
+PERSIST_PATH = "./" + STORAGE_DIR + "/default__vector_store.json" # the path StorageContext.persist passes
+
+class HnswVectorStore(BasePydanticVectorStore):
+    """Vector store backed by an HNSW graph (cosine similarity).
+
+    hnswlib labels are integers, so node ids are kept in a list indexed by label.
+    Deleted nodes are marked deleted in the graph and skipped by searches, and their
+    labels are given to the next nodes added, so the graph and the id list do not grow
+    with updates. The graph is persisted next to the ids as a .hnsw file. Nodes are
+    kept in the docstore (stores_text is False).
+
+    ef is set once to ef_search: hnswlib searches with max(ef, k), so a query never
+    changes the shared index state.
+
+    The filterable metadata of the nodes (METADATA_FILTER_KEYS) is kept in a metadata index
+    by label. Filtered queries with at most filter_brute_force candidates compare the query
+    with each of them, larger ones search the graph with a label filter.
+    """
+
+    stores_text: bool = False
+    is_embedding_query: bool = True
+
+    m: int = HNSW_M
+    ef_construction: int = HNSW_EF_CONSTRUCTION
+    ef_search: int = HNSW_EF_SEARCH
+    filter_brute_force: int = HNSW_FILTER_BRUTE_FORCE
+
+    _index: Any = PrivateAttr(default=None)
+    _node_ids: List[Optional[str]] = PrivateAttr(default_factory=list) # label -> node id, None if deleted
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr(default_factory=list)
+    _label_by_node_id: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _labels_by_ref_doc_id: Dict[str, List[int]] = PrivateAttr(default_factory=dict)
+    _free_labels: List[int] = PrivateAttr(default_factory=list) # labels of deleted nodes, reused by add
+    _metadata_index: MetadataIndex = PrivateAttr(default_factory=MetadataIndex) # positions are labels
+    _metadata_complete: bool = PrivateAttr(default=True)
+
+    def __init__(
+        self,
+        index: Any = None,
+        node_ids: Optional[List[Optional[str]]] = None,
+        ref_doc_ids: Optional[List[Optional[str]]] = None,
+        metadata: Optional[List[Optional[Dict[str, Any]]]] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self._index = index
+        for label, (node_id, ref_doc_id) in enumerate(zip(node_ids or [], ref_doc_ids or [])):
+            self._node_ids.append(node_id)
+            self._ref_doc_ids.append(ref_doc_id)
+            if node_id is None:
+                self._free_labels.append(label)
+            else:
+                self._label_by_node_id[node_id] = label
+                if ref_doc_id is not None:
+                    self._labels_by_ref_doc_id.setdefault(ref_doc_id, []).append(label)
+        # Labels loaded without their metadata cannot be filtered until index_metadata is called
+        self._metadata_complete = metadata is not None or len(self._label_by_node_id) == 0
+        for label, label_metadata in enumerate(metadata or []):
+            if label_metadata is not None and self._node_ids[label] is not None:
+                self._metadata_index.add(label, label_metadata)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HnswVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return self._index
+
+    @property
+    def metadata_complete(self) -> bool:
+        """Whether the metadata of every node is indexed, so filtered queries are exact."""
+        return self._metadata_complete
+
+    def index_metadata(self, nodes: List[BaseNode]) -> None:
+        """Index the metadata of stored nodes, e.g. of nodes persisted before metadata was kept."""
+        for node in nodes:
+            label = self._label_by_node_id.get(node.node_id)
+            if label is not None:
+                self._metadata_index.add(label, node.metadata)
+        self._metadata_complete = True
+
+    def _create_index(self, dim: int, max_elements: int) -> None:
+        import hnswlib
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        # Deleted labels are reused by add_items with the same label, which allow_replace_deleted forbids
+        self._index.init_index(max_elements=max_elements, ef_construction=self.ef_construction, M=self.m, allow_replace_deleted=False)
+        self._index.set_ef(self.ef_search)
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if len(nodes) == 0:
+            return []
+        embeddings = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        if self._index is None:
+            self._create_index(dim=embeddings.shape[1], max_elements=max(1024, 2 * len(embeddings)))
+        # A re-added node replaces the old one
+        self.delete_nodes([node.node_id for node in nodes if node.node_id in self._label_by_node_id])
+        # Reuse the labels of deleted nodes first: adding an item with a deleted label updates it in place
+        num_reused = min(len(self._free_labels), len(nodes))
+        reused = self._free_labels[len(self._free_labels) - num_reused:]
+        del self._free_labels[len(self._free_labels) - num_reused:]
+        labels = reused + list(range(len(self._node_ids), len(self._node_ids) + len(nodes) - num_reused))
+        needed = len(self._node_ids) + len(nodes) - num_reused
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(max(needed, 2 * self._index.get_max_elements()))
+        self._index.add_items(embeddings, np.asarray(labels))
+        self._node_ids.extend([None] * (needed - len(self._node_ids)))
+        self._ref_doc_ids.extend([None] * (needed - len(self._ref_doc_ids)))
+        for label, node in zip(labels, nodes):
+            self._node_ids[label] = node.node_id
+            self._ref_doc_ids[label] = node.ref_doc_id
+            self._label_by_node_id[node.node_id] = int(label)
+            self._metadata_index.add(int(label), node.metadata)
+            if node.ref_doc_id is not None:
+                self._labels_by_ref_doc_id.setdefault(node.ref_doc_id, []).append(int(label))
+        return [node.node_id for node in nodes]
+
+    def _delete_label(self, label: int) -> None:
+        node_id = self._node_ids[label]
+        if node_id is None:
+            return
+        self._index.mark_deleted(label)
+        self._node_ids[label] = None
+        del self._label_by_node_id[node_id]
+        self._metadata_index.remove(label)
+        # The label will be reused, so it must not stay with its ref doc
+        labels = self._labels_by_ref_doc_id.get(self._ref_doc_ids[label])
+        if labels is not None:
+            labels.remove(label)
+            if len(labels) == 0:
+                del self._labels_by_ref_doc_id[self._ref_doc_ids[label]]
+        self._ref_doc_ids[label] = None
+        self._free_labels.append(label)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        for label in self._labels_by_ref_doc_id.pop(ref_doc_id, []):
+            self._delete_label(label)
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Optional[MetadataFilters] = None, **delete_kwargs: Any) -> None:
+        """Delete the nodes of node_ids, or with filters, the nodes of node_ids (all nodes if None) matching filters."""
+        if filters is None:
+            for node_id in node_ids or []:
+                label = self._label_by_node_id.get(node_id)
+                if label is not None:
+                    self._delete_label(label)
+            return
+        for label in self._candidate_labels(VectorStoreQuery(node_ids=node_ids, filters=filters)):
+            self._delete_label(int(label))
+
+    def get(self, text_id: str) -> List[float]:
+        return self._index.get_items([self._label_by_node_id[text_id]])[0].tolist()
+
+    def _candidate_labels(self, query: VectorStoreQuery) -> np.ndarray:
+        # Labels of the nodes that are not deleted and match query.filters, query.node_ids and query.doc_ids
+        mask = np.fromiter((node_id is not None for node_id in self._node_ids), dtype=bool, count=len(self._node_ids))
+        if query.filters is not None:
+            mask &= self._metadata_index.mask(query.filters, len(self._node_ids))
+        if query.node_ids or query.doc_ids:
+            ids_mask = np.zeros(len(self._node_ids), dtype=bool)
+            ids_mask[[self._label_by_node_id[node_id] for node_id in query.node_ids or [] if node_id in self._label_by_node_id]] = True
+            for doc_id in query.doc_ids or []:
+                ids_mask[self._labels_by_ref_doc_id.get(doc_id, [])] = True
+            mask &= ids_mask
+        return np.flatnonzero(mask)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Query mode {query.mode} is not supported by HnswVectorStore")
+        if self._index is None or len(self._label_by_node_id) == 0 or query.query_embedding is None:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        label_filter = None
+        candidates = None
+        num_candidates = len(self._label_by_node_id)
+        if query.filters is not None or query.node_ids or query.doc_ids:
+            candidates = self._candidate_labels(query)
+            num_candidates = len(candidates)
+            if 0 < num_candidates <= self.filter_brute_force:
+                return self._exact_query(query, candidates)
+            allowed = set(candidates.tolist())
+            label_filter = allowed.__contains__
+        top_k = min(query.similarity_top_k, num_candidates)
+        if top_k <= 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        try:
+            labels, distances = self._index.knn_query(
+                np.asarray([query.query_embedding], dtype=np.float32), k=top_k, filter=label_filter,
+            )
+        except RuntimeError:
+            # The search reached fewer than top_k candidates (a sparse filter, or a graph thinned by
+            # deletions), hnswlib then refuses to return any: score the candidates exactly
+            if candidates is None:
+                candidates = self._candidate_labels(query)
+            return self._exact_query(query, candidates)
+        return VectorStoreQueryResult(
+            similarities=[1.0 - float(distance) for distance in distances[0]], # cosine distance to similarity
+            ids=[self._node_ids[int(label)] for label in labels[0]],
+        )
+
+    def _exact_query(self, query: VectorStoreQuery, labels: np.ndarray) -> VectorStoreQueryResult:
+        # Few candidates: a graph search restricted to them would visit many other nodes to reach
+        # them, comparing the query with each candidate is cheaper and exact
+        embeddings = np.asarray(self._index.get_items(labels), dtype=np.float32)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        query_embedding /= max(float(np.linalg.norm(query_embedding)), 1e-12)
+        scores = embeddings @ query_embedding
+        order = np.argsort(-scores, kind="stable")[:query.similarity_top_k]
+        return VectorStoreQueryResult(
+            similarities=scores[order].tolist(),
+            ids=[self._node_ids[int(label)] for label in labels[order]],
+        )
+
+    def persist(self, persist_path: str = PERSIST_PATH, fs=None) -> None:
+        """Write the graph to a .hnsw file and the ids to persist_path, through temporary files."""
+        dirpath = os.path.dirname(persist_path)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        index_path = os.path.splitext(persist_path)[0] + ".hnsw"
+        if self._index is not None:
+            self._index.save_index(index_path + ".tmp")
+            os.replace(index_path + ".tmp", index_path)
+        data = {
+            "index_file": os.path.basename(index_path) if self._index is not None else None,
+            "dim": self._index.dim if self._index is not None else None,
+            "node_ids": self._node_ids,
+            "ref_doc_ids": self._ref_doc_ids,
+        }
+        if self._metadata_complete:
+            data["metadata"] = [self._metadata_index.get(label) if node_id is not None else None for label, node_id in enumerate(self._node_ids)]
+        with open(persist_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(persist_path + ".tmp", persist_path)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str = PERSIST_PATH, fs=None) -> "HnswVectorStore":
+        """Load the store from persist_path, or create an empty one.
+
+        A file written by SimpleVectorStore is converted, so an existing knowledge base can switch to this store.
+        """
+        if not os.path.exists(persist_path):
+            return cls()
+        with open(persist_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if "embedding_dict" in data: # SimpleVectorStore format
+            from llama_index.core.schema import TextNode, NodeRelationship, RelatedNodeInfo
+            vector_store = cls()
+            nodes = []
+            metadata_dict = data.get("metadata_dict") or {}
+            for node_id, embedding in data["embedding_dict"].items():
+                node = TextNode(id_=node_id, embedding=embedding, metadata=metadata_dict.get(node_id) or {})
+                ref_doc_id = data["text_id_to_ref_doc_id"].get(node_id)
+                if ref_doc_id is not None:
+                    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id)
+                nodes.append(node)
+            vector_store.add(nodes)
+            # SimpleVectorStore keeps the metadata only of nodes added with it
+            vector_store._metadata_complete = all(node_id in metadata_dict for node_id in data["embedding_dict"])
+            print(f"Converted {len(nodes)} embeddings from SimpleVectorStore format")
+            return vector_store
+        index = None
+        if data["index_file"] is not None:
+            import hnswlib
+            index = hnswlib.Index(space="cosine", dim=data["dim"])
+            index.load_index(os.path.join(os.path.dirname(persist_path), data["index_file"]))
+            index.set_ef(HNSW_EF_SEARCH)
+        print(f"Loaded HNSW index with {sum(node_id is not None for node_id in data['node_ids'])} embeddings")
+        return cls(index=index, node_ids=data["node_ids"], ref_doc_ids=data["ref_doc_ids"], metadata=data.get("metadata"))
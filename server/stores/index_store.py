@@ -1,11 +1,13 @@
 # Index Store
 import config
 
-if config.THINKRAG_ENV == "production":
-    from llama_index.storage.index_store.redis import RedisIndexStore
-    INDEX_STORE = RedisIndexStore.from_host_and_port(
-        host=config.REDIS_HOST, port=config.REDIS_PORT, namespace="think"
-    )
-elif config.THINKRAG_ENV == "development":
-    from llama_index.core.storage.index_store import SimpleIndexStore
-    INDEX_STORE = SimpleIndexStore()
\ No newline at end of file
+# Created by the storage context of a knowledge base, namespace keeps the Redis keys of knowledge bases apart
+def create_index_store(namespace: str = "think"):
+    if config.THINKRAG_ENV == "production":
+        from llama_index.storage.index_store.redis import RedisIndexStore
+        return RedisIndexStore.from_host_and_port(
+            host=config.REDIS_HOST, port=config.REDIS_PORT, namespace=namespace
+        )
+    elif config.THINKRAG_ENV == "development":
+        from llama_index.core.storage.index_store import SimpleIndexStore
+        return SimpleIndexStore()
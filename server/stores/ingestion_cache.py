@@ -1,10 +1,16 @@
-from llama_index.core.ingestion import IngestionCache
-from llama_index.storage.kvstore.redis import RedisKVStore as RedisCache
+# Ingestion Cache
+# Redis cache of the ingestion pipeline's transformations, production environment only
 from config import REDIS_URI, DEV_MODE
+from server.utils.lazy import lazy
 
-redis_cache=IngestionCache(
-    cache=RedisCache(redis_uri=REDIS_URI),
-    collection="redis_pipeline_cache",
-)
-
-INGESTION_CACHE = redis_cache if not DEV_MODE else None
\ No newline at end of file
+# Created on first use, development environment uses no ingestion cache and never imports the Redis client
+@lazy
+def get_ingestion_cache():
+    if DEV_MODE:
+        return None
+    from llama_index.core.ingestion import IngestionCache
+    from llama_index.storage.kvstore.redis import RedisKVStore as RedisCache
+    return IngestionCache(
+        cache=RedisCache(redis_uri=REDIS_URI),
+        collection="redis_pipeline_cache",
+    )
@@ -0,0 +1,206 @@
+# Metadata Index
+# Maps the metadata values of nodes to their positions (rows of the mmap vector store, labels of the
+# HNSW graph, positions of the BM25 index), so that metadata filters select the candidate nodes before
+# a search instead of post-filtering its results. A query turns llama_index MetadataFilters into a
+# boolean mask over positions (a bitmap), which the store applies before scoring.
+
+import os
+import bisect
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Set
+from urllib.parse import urlparse
+
+import numpy as np
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.vector_stores.types import FilterCondition, FilterOperator, MetadataFilter, MetadataFilters
+from config import METADATA_FILTER_KEYS
+
+# Derived keys, computed from other metadata at ingestion and when indexing older nodes
+DERIVED_KEYS = ("file_ext", "url_host", "creation_day")
+
+# Greater than every character, "prefix" <= value < "prefix" + MAX_CHAR selects the values starting with prefix
+MAX_CHAR = "\U0010ffff"
+
+def derived_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Derived keys of a node's metadata: file_ext, url_host and creation_day."""
+    derived = {}
+    file_name = metadata.get("file_name") or metadata.get("file_path")
+    if isinstance(file_name, str) and file_name:
+        ext = os.path.splitext(file_name)[1].lower().lstrip(".")
+        if ext:
+            derived["file_ext"] = ext
+    url = metadata.get("url_source")
+    if isinstance(url, str) and url:
+        host = urlparse(url).hostname
+        if host:
+            derived["url_host"] = host.lower()
+    creation_date = metadata.get("creation_date")
+    if isinstance(creation_date, str) and len(creation_date) >= 10:
+        try:
+            derived["creation_day"] = int(date.fromisoformat(creation_date[:10]).strftime("%Y%m%d"))
+        except ValueError:
+            pass
+    return derived
+
+def filterable_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """The values of METADATA_FILTER_KEYS in metadata, derived keys included.
+
+    Only scalar values are kept, empty values are dropped (they match IS_EMPTY).
+    """
+    values = {**metadata, **derived_metadata(metadata)}
+    return {
+        key: values[key] for key in METADATA_FILTER_KEYS
+        if isinstance(values.get(key), (str, int, float)) and values[key] != ""
+    }
+
+def build_metadata_filters(
+    file_types: Optional[List[str]] = None,
+    file_path_prefix: Optional[str] = None,
+    created_after: Optional[str] = None,
+    created_before: Optional[str] = None,
+    url_hosts: Optional[List[str]] = None,
+) -> Optional[MetadataFilters]:
+    """MetadataFilters for the common restrictions of a query, all of them must match.
+
+    file_types are file extensions ("pdf", "docx"), created_after and created_before are
+    inclusive ISO dates. Returns None without restrictions.
+    """
+    filters: List[MetadataFilter] = []
+    if file_types:
+        filters.append(MetadataFilter(key="file_ext", value=[ext.lower().lstrip(".") for ext in file_types], operator=FilterOperator.IN))
+    if file_path_prefix:
+        filters.append(MetadataFilter(key="file_path", value=file_path_prefix, operator=FilterOperator.GTE))
+        filters.append(MetadataFilter(key="file_path", value=file_path_prefix + MAX_CHAR, operator=FilterOperator.LT))
+    if created_after:
+        filters.append(MetadataFilter(key="creation_day", value=int(date.fromisoformat(created_after).strftime("%Y%m%d")), operator=FilterOperator.GTE))
+    if created_before:
+        filters.append(MetadataFilter(key="creation_day", value=int(date.fromisoformat(created_before).strftime("%Y%m%d")), operator=FilterOperator.LTE))
+    if url_hosts:
+        filters.append(MetadataFilter(key="url_host", value=[host.lower() for host in url_hosts], operator=FilterOperator.IN))
+    if len(filters) == 0:
+        return None
+    return MetadataFilters(filters=filters, condition=FilterCondition.AND)
+
+def filter_nodes(nodes: List[NodeWithScore], filters: MetadataFilters) -> List[NodeWithScore]:
+    """The nodes whose metadata matches filters, in their order.
+
+    The derived keys are computed from the metadata, so nodes stored before they existed match too.
+    """
+    index = MetadataIndex()
+    for position, node in enumerate(nodes):
+        index.add(position, node.node.metadata)
+    mask = index.mask(filters, len(nodes))
+    return [node for node, matches in zip(nodes, mask) if matches]
+
+def filters_key(filters: Optional[MetadataFilters]) -> Optional[str]:
+    # Hashable identity of filters, e.g. for the query engine cache
+    return filters.model_dump_json() if filters is not None else None
+
+class MetadataIndex:
+    """Inverted index from (key, value) to the set of positions with that value.
+
+    Positions are assigned by the owner (row, label), every position has at most one
+    value per key. Range filters use the sorted distinct values of a key.
+    """
+
+    def __init__(self) -> None:
+        self._postings: Dict[str, Dict[Any, Set[int]]] = {}
+        self._metadata: Dict[int, Dict[str, Any]] = {} # position -> filterable metadata
+        self._sorted_values: Dict[str, Dict[type, list]] = {} # key -> sorted numbers and strings, built on use
+
+    def __len__(self) -> int:
+        return len(self._metadata)
+
+    def add(self, position: int, metadata: Dict[str, Any]) -> None:
+        """Index the metadata of position, replacing what it had."""
+        self.remove(position)
+        values = filterable_metadata(metadata)
+        if len(values) == 0:
+            return
+        self._metadata[position] = values
+        for key, value in values.items():
+            postings = self._postings.setdefault(key, {})
+            if value not in postings:
+                postings[value] = set()
+                self._sorted_values.pop(key, None)
+            postings[value].add(position)
+
+    def remove(self, position: int) -> None:
+        values = self._metadata.pop(position, None)
+        if values is None:
+            return
+        for key, value in values.items():
+            postings = self._postings[key]
+            positions = postings[value]
+            positions.discard(position)
+            if len(positions) == 0:
+                del postings[value]
+                self._sorted_values.pop(key, None)
+
+    def get(self, position: int) -> Dict[str, Any]:
+        return self._metadata.get(position, {})
+
+    def _sorted(self, key: str, value_type: type) -> list:
+        sorted_values = self._sorted_values.get(key)
+        if sorted_values is None:
+            values = self._postings.get(key, {}).keys()
+            sorted_values = {
+                float: sorted(value for value in values if isinstance(value, (int, float))),
+                str: sorted(value for value in values if isinstance(value, str)),
+            }
+            self._sorted_values[key] = sorted_values
+        return sorted_values[value_type]
+
+    def _values_mask(self, key: str, values: Iterable[Any], size: int) -> np.ndarray:
+        mask = np.zeros(size, dtype=bool)
+        postings = self._postings.get(key, {})
+        for value in values:
+            positions = postings.get(value)
+            if positions:
+                mask[np.fromiter(positions, dtype=np.int64, count=len(positions))] = True
+        return mask
+
+    def _filter_mask(self, metadata_filter: MetadataFilter, size: int) -> np.ndarray:
+        key, value, operator = metadata_filter.key, metadata_filter.value, metadata_filter.operator
+        if key not in METADATA_FILTER_KEYS:
+            raise ValueError(f"Metadata key {key} cannot be filtered on, options include {METADATA_FILTER_KEYS}")
+        postings = self._postings.get(key, {})
+        if operator == FilterOperator.EQ:
+            return self._values_mask(key, [value], size)
+        if operator == FilterOperator.IN:
+            return self._values_mask(key, value, size)
+        if operator in (FilterOperator.NE, FilterOperator.NIN, FilterOperator.IS_EMPTY):
+            # Like SimpleVectorStore, nodes without the key do not match NE and NIN
+            present = self._values_mask(key, postings.keys(), size)
+            if operator == FilterOperator.IS_EMPTY:
+                return ~present
+            excluded = self._values_mask(key, [value] if operator == FilterOperator.NE else value, size)
+            return present & ~excluded
+        if operator in (FilterOperator.GT, FilterOperator.GTE, FilterOperator.LT, FilterOperator.LTE):
+            sorted_values = self._sorted(key, str if isinstance(value, str) else float)
+            if operator == FilterOperator.GT:
+                selected = sorted_values[bisect.bisect_right(sorted_values, value):]
+            elif operator == FilterOperator.GTE:
+                selected = sorted_values[bisect.bisect_left(sorted_values, value):]
+            elif operator == FilterOperator.LT:
+                selected = sorted_values[:bisect.bisect_left(sorted_values, value)]
+            else:
+                selected = sorted_values[:bisect.bisect_right(sorted_values, value)]
+            return self._values_mask(key, selected, size)
+        if operator == FilterOperator.CONTAINS:
+            return self._values_mask(key, [v for v in postings if isinstance(v, str) and value in v], size)
+        if operator == FilterOperator.TEXT_MATCH:
+            return self._values_mask(key, [v for v in postings if isinstance(v, str) and value.lower() in v.lower()], size)
+        raise ValueError(f"Filter operator {operator} is not supported by the metadata index")
+
+    def mask(self, filters: MetadataFilters, size: int) -> np.ndarray:
+        """Boolean mask over positions 0..size-1 of the nodes that match filters."""
+        masks = [
+            self.mask(metadata_filter, size) if isinstance(metadata_filter, MetadataFilters) else self._filter_mask(metadata_filter, size)
+            for metadata_filter in filters.filters
+        ]
+        if len(masks) == 0:
+            return np.ones(size, dtype=bool)
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
@@ -0,0 +1,384 @@
+# Memory-mapped vector store
+# A local vector store that keeps embeddings in a contiguous float32 NumPy matrix instead of
+# Python lists of floats in a dict (SimpleVectorStore). The persisted matrix is opened with mmap,
+# so loading costs no parsing, and top-k search is a matrix multiply followed by argpartition.
+# Optionally the first pass of a search runs on int8 or binary codes kept in memory, and only the
+# top candidates are re-scored with the memory-mapped float32 embeddings.
+# Metadata filters select the candidate rows with a metadata index before scoring.
+
+import os
+import glob
+import json
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from config import STORAGE_DIR, VS_RESCORE_FACTOR
+from server.stores.quantization import approximate_scores, check_quantization, int8_scale, quantize
+from server.stores.metadata_index import MetadataIndex
+
+PERSIST_PATH = "./" + STORAGE_DIR + "/default__vector_store.json" # the path StorageContext.persist passes
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _append_rows(buffer: Optional[np.ndarray], length: int, rows: np.ndarray) -> np.ndarray:
+    # Grow the buffer by doubling its capacity, so appends are amortized O(appended rows)
+    needed = length + len(rows)
+    if buffer is None or needed > len(buffer):
+        capacity = max(needed, 2 * (len(buffer) if buffer is not None else 0), 1024)
+        grown = np.empty((capacity, rows.shape[1]), dtype=rows.dtype)
+        if length > 0:
+            grown[:length] = buffer[:length]
+        buffer = grown
+    buffer[length:needed] = rows
+    return buffer
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """Vector store with a memory-mapped float32 embedding matrix.
+
+    Rows loaded from disk stay in the read-only memory-mapped base matrix, rows added
+    afterwards go to an in-memory delta buffer, and deleted rows are masked until the
+    next persist. Embeddings are normalized, so the dot product is the cosine similarity.
+    Nodes are kept in the docstore (stores_text is False).
+
+    With quantization "int8" or "binary", codes of all rows are kept in memory and searched
+    first, then top_k * rescore_factor candidates are re-scored with the float32 rows.
+
+    The filterable metadata of the rows (METADATA_FILTER_KEYS) is kept in a metadata index,
+    query.filters restrict the rows before they are scored.
+
+    Adds and deletes hold a lock, and a query takes the rows and the mask it scores under it:
+    add grows the matrix, the codes and the id lists in several steps, a query in between
+    would see a matrix and a mask of different lengths.
+    """
+
+    stores_text: bool = False
+    is_embedding_query: bool = True
+
+    quantization: Optional[str] = None
+    rescore_factor: int = VS_RESCORE_FACTOR
+
+    _base: Optional[np.ndarray] = PrivateAttr(default=None)
+    _delta: Optional[np.ndarray] = PrivateAttr(default=None)
+    _delta_len: int = PrivateAttr(default=0)
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr(default_factory=list)
+    _row_by_node_id: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _rows_by_ref_doc_id: Dict[str, List[int]] = PrivateAttr(default_factory=dict)
+    _deleted: set = PrivateAttr(default_factory=set)
+    _codes: Optional[np.ndarray] = PrivateAttr(default=None)
+    _codes_len: int = PrivateAttr(default=0)
+    _scale: Optional[np.ndarray] = PrivateAttr(default=None) # int8 scale per dimension
+    _metadata_index: MetadataIndex = PrivateAttr(default_factory=MetadataIndex) # positions are rows
+    _metadata_complete: bool = PrivateAttr(default=True)
+    _lock: Any = PrivateAttr(default_factory=threading.RLock)
+
+    def __init__(
+        self,
+        base: Optional[np.ndarray] = None,
+        node_ids: Optional[List[str]] = None,
+        ref_doc_ids: Optional[List[Optional[str]]] = None,
+        codes: Optional[np.ndarray] = None,
+        scale: Optional[np.ndarray] = None,
+        metadata: Optional[List[Dict[str, Any]]] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        check_quantization(self.quantization)
+        self._base = base
+        for node_id, ref_doc_id in zip(node_ids or [], ref_doc_ids or []):
+            self._append_id(node_id, ref_doc_id)
+        # Rows loaded without their metadata cannot be filtered until index_metadata is called
+        self._metadata_complete = metadata is not None or len(self._node_ids) == 0
+        for row, row_metadata in enumerate(metadata or []):
+            self._metadata_index.add(row, row_metadata)
+        if self.quantization is not None and base is not None and len(base) > 0:
+            if codes is None or len(codes) != len(base):
+                print(f"Quantizing {len(base)} embeddings to {self.quantization}")
+                scale = int8_scale(base) if self.quantization == "int8" else None
+                codes = quantize(base, self.quantization, scale)
+            self._scale = scale
+            self._codes = codes
+            self._codes_len = len(codes)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def num_vectors(self) -> int:
+        # Not __len__: StorageContext tests the vector store with "or", an empty store must not be falsy
+        return len(self._node_ids) - len(self._deleted)
+
+    @property
+    def metadata_complete(self) -> bool:
+        """Whether the metadata of every row is indexed, so filtered queries are exact."""
+        return self._metadata_complete
+
+    def index_metadata(self, nodes: List[BaseNode]) -> None:
+        """Index the metadata of stored nodes, e.g. of rows persisted before metadata was kept."""
+        with self._lock:
+            for node in nodes:
+                row = self._row_by_node_id.get(node.node_id)
+                if row is not None:
+                    self._metadata_index.add(row, node.metadata)
+            self._metadata_complete = True
+
+    def _append_id(self, node_id: str, ref_doc_id: Optional[str]) -> None:
+        if node_id in self._row_by_node_id: # re-added node replaces the old row
+            self._delete_row(self._row_by_node_id[node_id])
+        row = len(self._node_ids)
+        self._node_ids.append(node_id)
+        self._ref_doc_ids.append(ref_doc_id)
+        self._row_by_node_id[node_id] = row
+        if ref_doc_id is not None:
+            self._rows_by_ref_doc_id.setdefault(ref_doc_id, []).append(row)
+
+    def _dim(self) -> Optional[int]:
+        if self._base is not None:
+            return self._base.shape[1]
+        if self._delta is not None:
+            return self._delta.shape[1]
+        return None
+
+    def _matrices(self) -> List[np.ndarray]:
+        matrices = []
+        if self._base is not None and len(self._base) > 0:
+            matrices.append(self._base)
+        if self._delta_len > 0:
+            matrices.append(self._delta[:self._delta_len])
+        return matrices
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if len(nodes) == 0:
+            return []
+        embeddings = _normalize(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        with self._lock:
+            dim = self._dim()
+            if dim is not None and embeddings.shape[1] != dim:
+                raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match the vector store dimension {dim}")
+            self._delta = _append_rows(self._delta, self._delta_len, embeddings)
+            self._delta_len += len(embeddings)
+            if self.quantization is not None:
+                if self.quantization == "int8" and self._scale is None:
+                    # The scale is taken from the first rows and recomputed from all rows on persist
+                    self._scale = int8_scale(embeddings)
+                self._codes = _append_rows(self._codes, self._codes_len, quantize(embeddings, self.quantization, self._scale))
+                self._codes_len += len(embeddings)
+            for node in nodes:
+                self._append_id(node.node_id, node.ref_doc_id)
+                self._metadata_index.add(len(self._node_ids) - 1, node.metadata)
+            return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            for row in self._rows_by_ref_doc_id.pop(ref_doc_id, []):
+                self._delete_row(row)
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Optional[MetadataFilters] = None, **delete_kwargs: Any) -> None:
+        """Delete the nodes of node_ids, or with filters, the nodes of node_ids (all nodes if None) matching filters."""
+        with self._lock:
+            if filters is None:
+                for node_id in node_ids or []:
+                    row = self._row_by_node_id.get(node_id)
+                    if row is not None:
+                        self._delete_row(row)
+                return
+            mask = self._candidate_mask(VectorStoreQuery(node_ids=node_ids, filters=filters))
+            rows = np.flatnonzero(mask) if mask is not None else range(len(self._node_ids))
+            for row in rows:
+                self._delete_row(int(row))
+
+    def _delete_row(self, row: int) -> None:
+        self._deleted.add(row)
+        self._metadata_index.remove(row)
+        node_id = self._node_ids[row]
+        if self._row_by_node_id.get(node_id) == row:
+            del self._row_by_node_id[node_id]
+
+    def get(self, text_id: str) -> List[float]:
+        with self._lock:
+            row = self._row_by_node_id[text_id]
+            base_len = len(self._base) if self._base is not None else 0
+            if row < base_len:
+                return self._base[row].tolist()
+            return self._delta[row - base_len].tolist()
+
+    def _gather(self, rows: np.ndarray, matrices: List[np.ndarray]) -> np.ndarray:
+        # Float32 embeddings of rows of matrices (from _matrices), only these rows of the memory-mapped matrix are read
+        base_len = len(self._base) if self._base is not None else 0
+        matrix = np.empty((len(rows), matrices[0].shape[1]), dtype=np.float32)
+        in_base = rows < base_len
+        if in_base.any():
+            matrix[in_base] = self._base[rows[in_base]]
+        if not in_base.all():
+            matrix[~in_base] = matrices[-1][rows[~in_base] - base_len]
+        return matrix
+
+    def _candidate_mask(self, query: VectorStoreQuery) -> Optional[np.ndarray]:
+        # Rows that may be returned, None if all rows that are not deleted
+        if len(self._deleted) == 0 and not query.node_ids and not query.doc_ids and query.filters is None:
+            return None
+        if query.filters is not None:
+            mask = self._metadata_index.mask(query.filters, len(self._node_ids))
+        else:
+            mask = np.ones(len(self._node_ids), dtype=bool)
+        if query.node_ids or query.doc_ids:
+            mask &= self._ids_mask(query)
+        if len(self._deleted) > 0:
+            mask[list(self._deleted)] = False
+        return mask
+
+    def _ids_mask(self, query: VectorStoreQuery) -> np.ndarray:
+        # Rows of query.node_ids and query.doc_ids
+        mask = np.zeros(len(self._node_ids), dtype=bool)
+        for node_id in query.node_ids or []:
+            row = self._row_by_node_id.get(node_id)
+            if row is not None:
+                mask[row] = True
+        for doc_id in query.doc_ids or []:
+            mask[self._rows_by_ref_doc_id.get(doc_id, [])] = True
+        return mask
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Query mode {query.mode} is not supported by MmapVectorStore")
+        # Rows, codes and mask of one state are taken under the lock and scored outside it:
+        # an add only writes rows past the snapshot (or to a grown copy) and the mask is a new array
+        with self._lock:
+            matrices = self._matrices()
+            codes = self._codes[:self._codes_len] if self._codes is not None else None
+            scale = self._scale
+            mask = self._candidate_mask(query)
+            node_ids = self._node_ids
+        if len(matrices) == 0 or query.query_embedding is None:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        query_embedding = _normalize(np.asarray(query.query_embedding, dtype=np.float32))
+        if self.quantization is not None:
+            scores = approximate_scores(codes, query_embedding, self.quantization, scale)
+        else:
+            scores = np.concatenate([matrix @ query_embedding for matrix in matrices])
+        if mask is not None:
+            scores[~mask] = -np.inf
+            num_candidates = int(mask.sum())
+        else:
+            num_candidates = len(scores)
+        top_k = min(query.similarity_top_k, num_candidates)
+        if top_k <= 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        if self.quantization is not None:
+            # Re-score the best candidates of the first pass with full precision
+            num_rescored = min(top_k * self.rescore_factor, num_candidates)
+            candidate_rows = np.argpartition(-scores, num_rescored - 1)[:num_rescored]
+            scores = self._gather(candidate_rows, matrices) @ query_embedding
+            order = np.argsort(-scores, kind="stable")[:top_k]
+            top_rows, scores = candidate_rows[order], scores[order]
+            return VectorStoreQueryResult(
+                similarities=scores.tolist(),
+                ids=[node_ids[row] for row in top_rows],
+            )
+        top_rows = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_rows = top_rows[np.argsort(-scores[top_rows], kind="stable")]
+        return VectorStoreQueryResult(
+            similarities=scores[top_rows].tolist(),
+            ids=[node_ids[row] for row in top_rows],
+        )
+
+    def persist(self, persist_path: str = PERSIST_PATH, fs=None) -> None:
+        """Write the rows that are not deleted to a new .npy file and the ids to persist_path.
+
+        The matrix file name carries a timestamp, so the file that is currently memory-mapped
+        is never overwritten. Files are written to temporary paths and renamed. With quantization,
+        the codes are recomputed from all rows and written to a second .npy file.
+        """
+        with self._lock: # a consistent set of rows, ids and metadata
+            dirpath = os.path.dirname(persist_path)
+            if dirpath and not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+            rows = [row for row in range(len(self._node_ids)) if row not in self._deleted]
+            matrices = self._matrices()
+            if len(matrices) > 0:
+                matrix = np.concatenate(matrices)[rows] if len(self._deleted) > 0 else np.concatenate(matrices)
+            else:
+                matrix = np.empty((0, 0), dtype=np.float32)
+            base_name = os.path.splitext(persist_path)[0]
+            matrix_path = f"{base_name}.{int(time.time() * 1000)}.npy"
+            with open(matrix_path + ".tmp", "wb") as f:
+                np.save(f, matrix)
+            os.replace(matrix_path + ".tmp", matrix_path)
+            data = {
+                "matrix_file": os.path.basename(matrix_path),
+                "node_ids": [self._node_ids[row] for row in rows],
+                "ref_doc_ids": [self._ref_doc_ids[row] for row in rows],
+            }
+            if self._metadata_complete:
+                data["metadata"] = [self._metadata_index.get(row) for row in rows]
+            if self.quantization is not None and len(rows) > 0:
+                scale = int8_scale(matrix) if self.quantization == "int8" else None
+                codes_path = f"{os.path.splitext(matrix_path)[0]}.{self.quantization}.npy"
+                with open(codes_path + ".tmp", "wb") as f:
+                    np.save(f, quantize(matrix, self.quantization, scale))
+                os.replace(codes_path + ".tmp", codes_path)
+                data["quantization"] = self.quantization
+                data["codes_file"] = os.path.basename(codes_path)
+                data["int8_scale"] = scale.tolist() if scale is not None else None
+            with open(persist_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(persist_path + ".tmp", persist_path)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str = PERSIST_PATH, fs=None, **kwargs: Any) -> "MmapVectorStore":
+        """Load the store from persist_path, or create an empty one.
+
+        A file written by SimpleVectorStore is converted, so an existing knowledge base can switch to this store.
+        kwargs (quantization, rescore_factor) are passed to the store, codes persisted with another
+        quantization are recomputed.
+        """
+        if not os.path.exists(persist_path):
+            return cls(**kwargs)
+        with open(persist_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if "embedding_dict" in data: # SimpleVectorStore format
+            node_ids = list(data["embedding_dict"].keys())
+            ref_doc_ids = [data["text_id_to_ref_doc_id"].get(node_id) for node_id in node_ids]
+            base = _normalize(np.asarray([data["embedding_dict"][node_id] for node_id in node_ids], dtype=np.float32)) if node_ids else None
+            # SimpleVectorStore keeps the metadata only of nodes added with it
+            metadata_dict = data.get("metadata_dict") or {}
+            metadata = [metadata_dict[node_id] for node_id in node_ids] if all(node_id in metadata_dict for node_id in node_ids) else None
+            print(f"Converted {len(node_ids)} embeddings from SimpleVectorStore format")
+            return cls(base=base, node_ids=node_ids, ref_doc_ids=ref_doc_ids, metadata=metadata, **kwargs)
+        dirpath = os.path.dirname(persist_path)
+        matrix_path = os.path.join(dirpath, data["matrix_file"])
+        base = np.load(matrix_path, mmap_mode="r") if len(data["node_ids"]) > 0 else None
+        codes, scale, codes_path = None, None, None
+        if kwargs.get("quantization") is not None and data.get("quantization") == kwargs["quantization"]:
+            codes_path = os.path.join(dirpath, data["codes_file"])
+            codes = np.load(codes_path) # in memory, the first pass of every search reads all codes
+            scale = np.asarray(data["int8_scale"], dtype=np.float32) if data["int8_scale"] is not None else None
+        # Remove matrix and codes files of older snapshots
+        keep_paths = {os.path.abspath(path) for path in (matrix_path, codes_path) if path is not None}
+        for path in glob.glob(os.path.splitext(persist_path)[0] + ".*.npy"):
+            if os.path.abspath(path) not in keep_paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        print(f"Loaded {len(data['node_ids'])} embeddings from {matrix_path}")
+        return cls(base=base, node_ids=data["node_ids"], ref_doc_ids=data["ref_doc_ids"], codes=codes, scale=scale, metadata=data.get("metadata"), **kwargs)
@@ -0,0 +1,58 @@
+# Embedding quantization
+# Compressed codes of normalized float32 embeddings for a first-pass search, whose top candidates
+# are then re-scored with the full precision embeddings.
+# "int8": scalar quantization with a scale per dimension, 4x smaller than float32
+# "binary": one sign bit per dimension, 32x smaller than float32, scored by Hamming distance
+
+from typing import Optional
+import numpy as np
+
+QUANTIZATION_TYPES = ("int8", "binary")
+
+SCORE_CHUNK_ROWS = 65536 # rows decoded at a time, bounds the temporary memory of a search
+
+# Number of set bits of every byte value, numpy 1.26 has no bitwise_count
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint16)
+
+def check_quantization(quantization: Optional[str]) -> None:
+    if quantization is not None and quantization not in QUANTIZATION_TYPES:
+        raise ValueError(f"Invalid quantization: {quantization}, options include {QUANTIZATION_TYPES} and None")
+
+def int8_scale(matrix: np.ndarray) -> np.ndarray:
+    """Scale per dimension mapping the largest absolute value of the dimension to 127."""
+    max_abs = np.abs(matrix).max(axis=0) if len(matrix) > 0 else np.zeros(matrix.shape[1], dtype=np.float32)
+    max_abs[max_abs == 0] = 1.0
+    return (127.0 / max_abs).astype(np.float32)
+
+def quantize(matrix: np.ndarray, quantization: str, scale: Optional[np.ndarray] = None) -> np.ndarray:
+    """Encode the rows of matrix, values out of the int8 range of scale are clipped."""
+    codes = []
+    for start in range(0, len(matrix), SCORE_CHUNK_ROWS):
+        chunk = np.asarray(matrix[start:start + SCORE_CHUNK_ROWS], dtype=np.float32)
+        if quantization == "int8":
+            codes.append(np.clip(np.rint(chunk * scale), -127, 127).astype(np.int8))
+        else:
+            codes.append(np.packbits(chunk > 0, axis=-1))
+    if len(codes) == 0:
+        width = matrix.shape[1] if quantization == "int8" else (matrix.shape[1] + 7) // 8
+        return np.empty((0, width), dtype=np.int8 if quantization == "int8" else np.uint8)
+    return np.concatenate(codes)
+
+def approximate_scores(codes: np.ndarray, query: np.ndarray, quantization: str, scale: Optional[np.ndarray] = None) -> np.ndarray:
+    """Scores of the codes for a normalized query, higher is more similar.
+
+    int8 scores approximate the cosine similarity, binary scores are the negative Hamming distance.
+    """
+    scores = np.empty(len(codes), dtype=np.float32)
+    if quantization == "int8":
+        scaled_query = (query / scale).astype(np.float32)
+    else:
+        query_code = np.packbits(query > 0)
+    for start in range(0, len(codes), SCORE_CHUNK_ROWS):
+        chunk = codes[start:start + SCORE_CHUNK_ROWS]
+        if quantization == "int8":
+            scores[start:start + len(chunk)] = chunk.astype(np.float32) @ scaled_query
+        else:
+            # Cast before negating, the bit counts are unsigned
+            scores[start:start + len(chunk)] = -_POPCOUNT[np.bitwise_xor(chunk, query_code)].sum(axis=1).astype(np.float32)
+    return scores
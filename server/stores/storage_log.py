@@ -0,0 +1,165 @@
+# Storage Log
+# Append-only log of knowledge base changes for the local stores of development environment
+# (SimpleDocumentStore, SimpleIndexStore and SimpleVectorStore).
+# Instead of re-serializing every store on each change, IndexManager appends the inserted nodes (with
+# the source documents the ingestion pipeline stored for them) or deleted ref docs to the log, which is replayed over the last snapshot when the storage context
+# is loaded. The log is compacted into a new snapshot once it grows past a threshold.
+
+import os
+import json
+import threading
+from typing import Iterable, List
+from llama_index.core import StorageContext
+from llama_index.core.schema import BaseNode
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from config import STORAGE_DIR, STORAGE_LOG_FILE, STORAGE_LOG_COMPACT_RECORDS, STORAGE_LOG_COMPACT_BYTES
+
+PERSIST_DIR = "./" + STORAGE_DIR
+LOG_PATH = PERSIST_DIR + "/" + STORAGE_LOG_FILE
+
+def remove_ref_docs(storage_context: StorageContext, index_struct, ref_doc_ids: Iterable[str], keep_node_ids=(), node_ids=()) -> List[str]:
+    """Remove the nodes of ref docs from the vector store, index struct and docstore.
+
+    node_ids are more nodes of the ref docs, e.g. nodes the ingestion pipeline already removed
+    from the docstore, that the index struct still holds. Nodes in keep_node_ids are not
+    removed. Returns the ids of the removed nodes.
+    """
+    docstore = storage_context.docstore
+    vector_store = storage_context.vector_store
+    keep_node_ids = set(keep_node_ids)
+    ref_doc_ids = list(ref_doc_ids)
+    node_ids = [node_id for node_id in node_ids if node_id not in keep_node_ids]
+    for ref_doc_id in ref_doc_ids:
+        ref_doc_info = docstore.get_ref_doc_info(ref_doc_id)
+        if ref_doc_info is not None:
+            node_ids.extend(node_id for node_id in ref_doc_info.node_ids if node_id not in keep_node_ids)
+    node_ids = list(dict.fromkeys(node_ids))
+    if len(node_ids) == 0:
+        return node_ids
+    try:
+        vector_store.delete_nodes(node_ids=node_ids)
+    except NotImplementedError:
+        if len(keep_node_ids) > 0:
+            # Deleting by ref doc would delete the kept nodes too. The ingestion pipeline deletes the
+            # old nodes of a re-ingested document by ref doc before adding the new ones.
+            print(f"{type(vector_store).__name__} cannot delete nodes by id, kept {len(node_ids)} old nodes in it")
+        else:
+            for ref_doc_id in ref_doc_ids:
+                vector_store.delete(ref_doc_id)
+    for node_id in node_ids:
+        index_struct.delete(node_id)
+    if len(keep_node_ids) > 0:
+        for node_id in node_ids:
+            docstore.delete_document(node_id, raise_error=False)
+    else:
+        for ref_doc_id in ref_doc_ids:
+            docstore.delete_ref_doc(ref_doc_id, raise_error=False)
+    return node_ids
+
+class StorageLog:
+    """Append-only log of inserts and deletes, replayed over the persisted snapshot.
+
+    Every record is one JSON line, flushed and fsynced before the change is reported as
+    done. Replaying a record is idempotent, so the whole log can be replayed over any
+    snapshot taken while it was written, and a record cut short by a crash is dropped.
+    """
+
+    def __init__(self, storage_context: StorageContext, persist_dir: str = PERSIST_DIR, log_path: str = LOG_PATH) -> None:
+        self.storage_context = storage_context
+        self.persist_dir = persist_dir
+        self.log_path = log_path
+        self.num_records = 0
+        self._lock = threading.Lock()
+
+    def _append(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.num_records += 1
+            log_size = os.path.getsize(self.log_path)
+        if self.num_records >= STORAGE_LOG_COMPACT_RECORDS or log_size >= STORAGE_LOG_COMPACT_BYTES:
+            self.compact()
+
+    def log_insert(self, index_id: str, nodes: List[BaseNode]) -> None:
+        docstore = self.storage_context.docstore
+        ref_doc_ids = list(dict.fromkeys(node.ref_doc_id for node in nodes if node.ref_doc_id is not None))
+        # The ingestion pipeline upserts the source documents into the docstore next to their nodes
+        documents = [docstore.get_document(ref_doc_id, raise_error=False) for ref_doc_id in ref_doc_ids]
+        self._append({
+            "op": "insert",
+            "index_id": index_id,
+            "documents": [doc_to_json(document) for document in documents if document is not None],
+            "nodes": [doc_to_json(node) for node in nodes],
+            # Document hashes are set by the ingestion pipeline to detect changed documents
+            "hashes": {ref_doc_id: docstore.get_document_hash(ref_doc_id) for ref_doc_id in ref_doc_ids},
+        })
+
+    def log_delete(self, index_id: str, ref_doc_ids: List[str]) -> None:
+        self._append({"op": "delete", "index_id": index_id, "ref_doc_ids": ref_doc_ids})
+
+    def _apply(self, record: dict) -> None:
+        index_store = self.storage_context.index_store
+        docstore = self.storage_context.docstore
+        index_struct = index_store.get_index_struct(record["index_id"])
+        if index_struct is None:
+            return
+        if record["op"] == "insert":
+            nodes = [json_to_doc(node_json) for node_json in record["nodes"]]
+            node_ids = {node.node_id for node in nodes}
+            # Like the ingestion pipeline's upserts: nodes of a re-ingested document replace its old nodes
+            remove_ref_docs(self.storage_context, index_struct, record["hashes"].keys(), keep_node_ids=node_ids)
+            self.storage_context.vector_store.add([node for node in nodes if node.embedding is not None])
+            # Records written before the documents were logged have none
+            docstore.add_documents([json_to_doc(doc_json) for doc_json in record.get("documents", [])], allow_update=True)
+            docstore.add_documents(nodes, allow_update=True)
+            for ref_doc_id, doc_hash in record["hashes"].items():
+                if doc_hash is not None:
+                    docstore.set_document_hash(ref_doc_id, doc_hash)
+            for node in nodes:
+                index_struct.add_node(node)
+        elif record["op"] == "delete":
+            remove_ref_docs(self.storage_context, index_struct, record["ref_doc_ids"])
+        index_store.add_index_struct(index_struct)
+
+    def replay(self) -> None:
+        """Apply the log to the storage context, dropping a trailing record cut short by a crash."""
+        if not os.path.exists(self.log_path):
+            return
+        with self._lock:
+            with open(self.log_path, "rb+") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        record = json.loads(line.decode("utf-8"))
+                    except (UnicodeDecodeError, json.JSONDecodeError):
+                        print(f"Dropped an incomplete record at byte {offset} of {self.log_path}")
+                        f.truncate(offset)
+                        break
+                    self._apply(record)
+                    self.num_records += 1
+                    offset += len(line)
+        print(f"Replayed {self.num_records} records from {self.log_path}")
+
+    def compact(self) -> None:
+        """Write a new snapshot of the stores and clear the log."""
+        with self._lock:
+            tmp_dir = self.persist_dir + ".compact"
+            os.makedirs(self.persist_dir, exist_ok=True)
+            self.storage_context.persist(persist_dir=tmp_dir)
+            # Each file is replaced atomically. The log is only removed once the snapshot is complete,
+            # and replaying it over a partly replaced snapshot gives the same state.
+            for name in os.listdir(tmp_dir):
+                os.replace(os.path.join(tmp_dir, name), os.path.join(self.persist_dir, name))
+            os.rmdir(tmp_dir)
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+            self.num_records = 0
+        print(f"Compacted storage into {self.persist_dir}")
+
+def create_storage_log(storage_context: StorageContext, persist_dir: str = PERSIST_DIR) -> StorageLog:
+    storage_log = StorageLog(storage_context, persist_dir=persist_dir, log_path=os.path.join(persist_dir, STORAGE_LOG_FILE))
+    storage_log.replay()
+    return storage_log
@@ -1,34 +1,86 @@
 # Store context
 # https://docs.llamaindex.ai/en/stable/module_guides/storing/customization/
+# Every knowledge base has its own storage context: a storage directory in development environment,
+# a Redis namespace and a vector collection in production. Knowledge bases are loaded on first use
+# and unloaded when idle by the registry in server/index.py.
 
+import os
+import re
+from typing import List, Optional, Tuple
 from llama_index.core import StorageContext
-from config import THINKRAG_ENV
-from server.stores.doc_store import DOC_STORE
-from server.stores.vector_store import VECTOR_STORE
-from server.stores.index_store import INDEX_STORE
+from config import THINKRAG_ENV, DEV_VS_TYPE, STORAGE_DIR, DEFAULT_INDEX_NAME, KB_STORAGE_SUBDIR
+from server.stores.doc_store import create_doc_store
+from server.stores.vector_store import create_kb_vector_store
+from server.stores.index_store import create_index_store
+from server.stores.storage_log import StorageLog, create_storage_log
 
-def create_storage_context():
+# Used in directory, Redis key and collection names
+KB_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,48}$")
+
+def check_kb_name(kb_name: str) -> None:
+    if not KB_NAME_PATTERN.match(kb_name):
+        raise ValueError(f"Invalid knowledge base name: {kb_name!r}, use 1-48 letters, digits, '_' or '-'")
+
+def kb_persist_dir(kb_name: str) -> str:
+    # The default knowledge base keeps the storage directory layout of a single knowledge base
+    if kb_name == DEFAULT_INDEX_NAME:
+        return "./" + STORAGE_DIR
+    return f"./{STORAGE_DIR}/{KB_STORAGE_SUBDIR}/{kb_name}"
+
+def kb_namespace(kb_name: str) -> str:
+    # Redis namespace and vector collection, "think" for the default knowledge base as before
+    if kb_name == DEFAULT_INDEX_NAME:
+        return "think"
+    return f"think_{kb_name}"
+
+def list_kb_names() -> List[str]:
+    # Knowledge bases with a storage directory, the default one is always listed
+    kb_dir = f"./{STORAGE_DIR}/{KB_STORAGE_SUBDIR}"
+    names = [DEFAULT_INDEX_NAME]
+    if os.path.isdir(kb_dir):
+        names.extend(sorted(
+            name for name in os.listdir(kb_dir)
+            if KB_NAME_PATTERN.match(name) and name != DEFAULT_INDEX_NAME and os.path.isdir(os.path.join(kb_dir, name))
+        ))
+    return names
+
+def create_storage_context(kb_name: str = DEFAULT_INDEX_NAME) -> StorageContext:
+    check_kb_name(kb_name)
+    namespace = kb_namespace(kb_name)
     if THINKRAG_ENV == "development":
         # Development environment
-        import os
-        from config import STORAGE_DIR
-        persist_dir = "./" + STORAGE_DIR
-        if os.path.exists(STORAGE_DIR + "/docstore.json"):
+        persist_dir = kb_persist_dir(kb_name)
+        # SimpleVectorStore is loaded by StorageContext, other local vector stores load themselves
+        vector_store = None if DEV_VS_TYPE == "simple" else create_kb_vector_store(namespace=namespace, persist_dir=persist_dir)
+        if os.path.exists(persist_dir + "/docstore.json"):
             dev_storage_context = StorageContext.from_defaults(
-                persist_dir=persist_dir # Load from the persist directory
+                persist_dir=persist_dir, # Load from the persist directory
+                vector_store=vector_store,
             )
             print(f"Loaded storage context from {persist_dir}")
             return dev_storage_context
         else:
-            dev_storage_context = StorageContext.from_defaults() # Created new storage context, need persistence
-            print(f"Created new storage context")
+            dev_storage_context = StorageContext.from_defaults(vector_store=vector_store) # Created new storage context, need persistence
+            print(f"Created new storage context for {kb_name}")
             return dev_storage_context
     elif THINKRAG_ENV == "production":
         pro_storage_context = StorageContext.from_defaults(
-            docstore=DOC_STORE,
-            index_store=INDEX_STORE,
-            vector_store=VECTOR_STORE,
+            docstore=create_doc_store(namespace=namespace),
+            index_store=create_index_store(namespace=namespace),
+            vector_store=create_kb_vector_store(namespace=namespace),
         )
         return pro_storage_context
 
-STORAGE_CONTEXT = create_storage_context()
\ No newline at end of file
+def create_storage(kb_name: str = DEFAULT_INDEX_NAME) -> Tuple[StorageContext, Optional[StorageLog]]:
+    """Create the storage context of a knowledge base and its storage log.
+
+    The log is replayed before the stores are read. It is None in production environment.
+    """
+    storage_context = create_storage_context(kb_name)
+    storage_log = None
+    # Changes to the local stores are appended to a log in development environment, see server/stores/storage_log.py
+    persist_dir = kb_persist_dir(kb_name)
+    os.makedirs(persist_dir, exist_ok=True) # also holds the BM25 index, and lists the knowledge base
+    if THINKRAG_ENV == "development":
+        storage_log = create_storage_log(storage_context, persist_dir=persist_dir)
+    return storage_context, storage_log
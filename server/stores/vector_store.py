@@ -3,9 +3,12 @@
 # https://docs.llamaindex.ai/en/stable/examples/vector_stores/ChromaIndexDemo/
 # https://docs.llamaindex.ai/en/stable/module_guides/storing/customization/
 
+import os
 import config
 
-def create_vector_store(type=config.DEFAULT_VS_TYPE):
+# namespace is the collection (index, table) of a knowledge base in a vector database,
+# persist_dir the storage directory of a knowledge base for the local vector stores
+def create_vector_store(type=config.DEFAULT_VS_TYPE, namespace="think", persist_dir="./" + config.STORAGE_DIR):
     if type == "chroma":
         # Vector database Chroma
 
@@ -16,11 +19,12 @@ def create_vector_store(type=config.DEFAULT_VS_TYPE):
         from llama_index.vector_stores.chroma import ChromaVectorStore
 
         db = chromadb.PersistentClient(path=".chroma")
-        chroma_collection = db.get_or_create_collection("think")
+        chroma_collection = db.get_or_create_collection(namespace)
         chroma_vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
         return chroma_vector_store
     elif type == "es":
-        # Todo: use Metadata Filters
+        # ElasticsearchStore only translates EQ metadata filters, the filters of queries are applied
+        # to the retrieved nodes instead, see PostFilteredVectorRetriever in server/retriever.py
 
         # Vector database ES
         # https://docs.llamaindex.ai/en/stable/examples/vector_stores/ElasticsearchIndexDemo/
@@ -37,7 +41,7 @@ def create_vector_store(type=config.DEFAULT_VS_TYPE):
 
         es_vector_store = ElasticsearchStore(
         es_url="http://localhost:9200",
-        index_name="think",
+        index_name=namespace,
         retrieval_strategy=AsyncDenseVectorStrategy(hybrid=False),
         )
         return es_vector_store
@@ -50,16 +54,33 @@ def create_vector_store(type=config.DEFAULT_VS_TYPE):
         reranker = LinearCombinationReranker(weight=0.9)
 
         lance_vector_store = LanceDBVectorStore(
-            uri=".lancedb", mode="overwrite", query_type="vector", reranker=reranker
+            uri=".lancedb", table_name=namespace, mode="overwrite", query_type="vector", reranker=reranker
         )
         return lance_vector_store
     elif type == "simple":
         from llama_index.core.vector_stores import SimpleVectorStore
         return SimpleVectorStore()
+    elif type == "mmap":
+        # Local vector store with a memory-mapped float32 embedding matrix, loaded from the storage directory
+        from server.stores.mmap_vector_store import MmapVectorStore
+        return MmapVectorStore.from_persist_path(
+            os.path.join(persist_dir, "default__vector_store.json"),
+            quantization=config.VS_QUANTIZATION, rescore_factor=config.VS_RESCORE_FACTOR,
+        )
+    elif type == "hnsw":
+        # Local approximate nearest neighbour index (HNSW graph), loaded from the storage directory
+
+        # Install hnswlib
+        """ pip install hnswlib """
+
+        from server.stores.hnsw_vector_store import HnswVectorStore
+        return HnswVectorStore.from_persist_path(os.path.join(persist_dir, "default__vector_store.json"))
     else:
         raise ValueError(f"Invalid vector store type: {type}")
 
-if config.THINKRAG_ENV == "production":
-    VECTOR_STORE = create_vector_store(type="chroma")
-else:
-    VECTOR_STORE = create_vector_store(type="simple")
\ No newline at end of file
+# Vector store of a knowledge base
+def create_kb_vector_store(namespace="think", persist_dir="./" + config.STORAGE_DIR):
+    if config.THINKRAG_ENV == "production":
+        return create_vector_store(type="chroma", namespace=namespace)
+    else:
+        return create_vector_store(type=config.DEV_VS_TYPE, namespace=namespace, persist_dir=persist_dir)
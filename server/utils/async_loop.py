@@ -0,0 +1,37 @@
+# Shared event loop
+# One event loop, running in a background thread, for the async query path of the synchronous
+# Streamlit pages. Every session submits its queries to this loop instead of starting an event loop
+# per query, so the LLM clients keep their connections (an async client is bound to the loop that
+# created it) and concurrent queries wait on I/O without holding a thread each.
+
+import asyncio
+import threading
+from typing import AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOCK = threading.Lock()
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+    with _LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="async-query-loop", daemon=True).start()
+        return _LOOP
+
+async def _await(awaitable: Awaitable[T]) -> T:
+    return await awaitable
+
+def run_coroutine(awaitable: Awaitable[T], timeout: Optional[float] = None) -> T:
+    """Run an awaitable on the shared loop and wait for its result in the calling thread."""
+    return asyncio.run_coroutine_threadsafe(_await(awaitable), get_event_loop()).result(timeout)
+
+def iterate_async(async_iterator: AsyncIterator[T]) -> Iterator[T]:
+    """Consume an async iterator, e.g. a streamed answer, from synchronous code."""
+    while True:
+        try:
+            yield run_coroutine(async_iterator.__anext__())
+        except StopAsyncIteration:
+            return
@@ -0,0 +1,47 @@
+# Lazy providers
+# Shared objects (stores, clients, caches) are built by their provider on first use instead of at
+# import time, so importing a module neither connects to Redis nor loads files and heavy libraries.
+#
+#   @lazy
+#   def get_chat_store():
+#       return SimpleChatStore()
+#
+#   get_chat_store() # built on the first call, the same instance afterwards
+
+import threading
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+_UNSET = object()
+
+class LazyProvider(Generic[T]):
+    """Call the factory once, on first use, and return its result on every call."""
+
+    def __init__(self, factory: Callable[[], T]) -> None:
+        self._factory = factory
+        self._value = _UNSET
+        self._lock = threading.Lock()
+        self.__name__ = getattr(factory, "__name__", "provider")
+        self.__doc__ = getattr(factory, "__doc__", None)
+
+    def __call__(self) -> T:
+        value = self._value
+        if value is _UNSET:
+            with self._lock:
+                if self._value is _UNSET: # another thread may have built it meanwhile
+                    self._value = self._factory()
+                value = self._value
+        return value
+
+    @property
+    def loaded(self) -> bool:
+        return self._value is not _UNSET
+
+    def reset(self) -> None:
+        """Drop the built object, the next call builds a new one."""
+        with self._lock:
+            self._value = _UNSET
+
+def lazy(factory: Callable[[], T]) -> LazyProvider[T]:
+    return LazyProvider(factory)
@@ -0,0 +1,195 @@
+# Concurrent web fetching
+# Web readers fetch their pages with a WebFetcher instead of one requests.get after another: pages
+# are downloaded by a thread pool sharing one keep-alive session, at most per_host at a time from the
+# same host (for a reader service like Jina Reader, the host of the page it reads), every request has connect/read timeouts and a total deadline, and requests that fail to
+# connect, time out or get status 429 or 5xx are retried with exponential backoff.
+# See benchmarks/web_fetch.py and tests/test_web_fetch.py, which run against a local stub server.
+
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from server.utils.lazy import lazy
+from config import (
+    WEB_FETCH_WORKERS, WEB_FETCH_PER_HOST, WEB_FETCH_TIMEOUT, WEB_FETCH_TOTAL_TIMEOUT, WEB_FETCH_MAX_BYTES,
+    WEB_FETCH_RETRIES, WEB_FETCH_BACKOFF, WEB_FETCH_MAX_BACKOFF, WEB_FETCH_USER_AGENT, JINA_READER_URL,
+)
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+CHUNK_SIZE = 64 * 1024
+
+class FetchError(Exception):
+    """A page could not be fetched, after all retries."""
+
+class FetchResult:
+    """Outcome of fetching a url: the response, or the error of the last attempt."""
+
+    def __init__(
+        self,
+        url: str,
+        response: Optional[requests.Response] = None,
+        error: Optional[Exception] = None,
+        attempts: int = 0,
+        elapsed: float = 0.0,
+    ) -> None:
+        self.url = url
+        self.response = response
+        self.error = error
+        self.attempts = attempts
+        self.elapsed = elapsed # seconds, retries and waits included
+
+    @property
+    def ok(self) -> bool:
+        return self.response is not None
+
+class _RetryableStatus(Exception):
+    def __init__(self, response: requests.Response) -> None:
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+def _retry_after(response: Optional[requests.Response]) -> Optional[float]:
+    # Seconds to wait given by a Retry-After header, as a number of seconds or an HTTP date
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class WebFetcher:
+    """Fetch web pages concurrently with a shared keep-alive session.
+
+    fetch() downloads one page in the calling thread, fetch_all() downloads pages with
+    max_workers threads and returns their results in the order of the urls. A FetchResult
+    without response carries the error of its last attempt, so one failing host does not
+    fail the other pages.
+
+    The per_host limit applies to the host of the page: a url starting with one of
+    reader_prefixes (a service that fetches the page given after its prefix) counts
+    against the host of that page, not against the service.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = WEB_FETCH_WORKERS,
+        per_host: int = WEB_FETCH_PER_HOST,
+        timeout: Tuple[float, float] = WEB_FETCH_TIMEOUT,
+        total_timeout: float = WEB_FETCH_TOTAL_TIMEOUT,
+        max_bytes: int = WEB_FETCH_MAX_BYTES,
+        retries: int = WEB_FETCH_RETRIES,
+        backoff: float = WEB_FETCH_BACKOFF,
+        max_backoff: float = WEB_FETCH_MAX_BACKOFF,
+        headers: Optional[Dict[str, str]] = None,
+        reader_prefixes: Sequence[str] = (JINA_READER_URL,),
+        verbose: bool = False,
+    ) -> None:
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reader_prefixes = tuple(reader_prefixes)
+        self.verbose = verbose
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = WEB_FETCH_USER_AGENT
+        self.session.headers.update(headers or {})
+        # Keep a connection per worker alive, retries are done here to share the backoff and host limits
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url: str) -> str:
+        for prefix in self.reader_prefixes:
+            if url.startswith(prefix):
+                url = url[len(prefix):]
+                break
+        return (urlparse(url).hostname or "").lower()
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = self._host(url)
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.per_host)
+                self._host_slots[host] = slot
+            return slot
+
+    def _get(self, url: str, deadline: float) -> requests.Response:
+        # One attempt: the body is read in chunks, so a page trickling in cannot exceed the deadline
+        with self._host_slot(url):
+            response = self.session.get(url, timeout=self.timeout, stream=True)
+            try:
+                if response.status_code in RETRY_STATUS:
+                    raise _RetryableStatus(response)
+                response.raise_for_status()
+                chunks, size = [], 0
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise FetchError(f"{url} is larger than {self.max_bytes} bytes")
+                    if time.monotonic() > deadline:
+                        raise requests.Timeout(f"{url} took longer than {self.total_timeout}s")
+                    chunks.append(chunk)
+                response._content = b"".join(chunks) # response.content and response.text use it
+            finally:
+                response.close() # returns the connection to the pool
+            return response
+
+    def fetch(self, url: str) -> FetchResult:
+        """Fetch url, retrying connection errors, timeouts and status 429 or 5xx."""
+        start = time.monotonic()
+        deadline = start + self.total_timeout
+        attempt = 0
+        while True:
+            attempt += 1
+            response = None
+            try:
+                response = self._get(url, deadline)
+                return FetchResult(url, response=response, attempts=attempt, elapsed=time.monotonic() - start)
+            except (requests.ConnectionError, requests.Timeout, _RetryableStatus) as e:
+                error = e
+                response = getattr(e, "response", None)
+            except Exception as e: # invalid url, status 4xx, page too large: retrying does not help
+                return FetchResult(url, error=e, attempts=attempt, elapsed=time.monotonic() - start)
+            wait = _retry_after(response)
+            if wait is None:
+                wait = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5) # jitter spreads retries to the same host
+            wait = min(wait, self.max_backoff)
+            if attempt > self.retries or time.monotonic() + wait > deadline:
+                return FetchResult(url, error=error, attempts=attempt, elapsed=time.monotonic() - start)
+            time.sleep(wait)
+
+    def fetch_all(self, urls: List[str]) -> List[FetchResult]:
+        """Fetch urls concurrently, results are in the order of urls."""
+        if len(urls) == 0:
+            return []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls)), thread_name_prefix="web-fetch") as pool:
+            results = list(pool.map(self.fetch, urls))
+        if self.verbose:
+            failed = sum(not result.ok for result in results)
+            print(f"Fetched {len(urls) - failed} of {len(urls)} pages in {time.perf_counter() - start:.2f}s")
+        return results
+
+    def close(self) -> None:
+        self.session.close()
+
+# Shared by the web readers, so connections stay alive across calls
+get_web_fetcher = lazy(WebFetcher)
@@ -0,0 +1,18 @@
+# Shared fixtures: tests run from the project root with `python -m pytest`, with a mock embedding
+# model and in a temporary working directory, so the local stores never touch ./storage
+
+import pytest
+from llama_index.core import Settings
+from llama_index.core.embeddings import MockEmbedding
+
+@pytest.fixture(autouse=True)
+def mock_embedding():
+    previous = Settings._embed_model
+    Settings.embed_model = MockEmbedding(embed_dim=8)
+    yield Settings.embed_model
+    Settings._embed_model = previous
+
+@pytest.fixture(autouse=True)
+def in_tmp_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,57 @@
+# Answer cache: exact matches, and the vectorised similarity lookup when a threshold is set
+
+from server.stores.answer_cache import AnswerCache, CachedAnswer
+
+def make_answer(query, embedding=None, settings_key="engine", ref_doc_ids=()):
+    return CachedAnswer(
+        query=query, answer=f"answer to {query}", sources=[("node", 1.0)],
+        ref_doc_ids=set(ref_doc_ids), settings_key=settings_key, embedding=embedding,
+    )
+
+def test_exact_match_only_by_default():
+    cache = AnswerCache(max_size=10)
+    assert cache.similarity_threshold is None
+    cache.put(make_answer("What is RAG?", embedding=[1.0, 0.0]))
+    assert cache.get("engine", "  What  is RAG? ").answer == "answer to What is RAG?"
+    assert cache.get("engine", "What is BM25?", embedding=[1.0, 0.0]) is None
+
+def test_most_similar_answer_above_threshold():
+    cache = AnswerCache(max_size=10, similarity_threshold=0.9)
+    cache.put(make_answer("a", embedding=[1.0, 0.0, 0.0]))
+    cache.put(make_answer("b", embedding=[0.8, 0.6, 0.0]))
+    cache.put(make_answer("c", embedding=[1.0, 0.0, 0.0], settings_key="other"))
+    assert cache.get("engine", "query", embedding=[0.9, 0.1, 0.0]).query == "a"
+    assert cache.get("engine", "query", embedding=[0.7, 0.7, 0.0]).query == "b"
+    assert cache.get("engine", "query", embedding=[0.0, 0.0, 1.0]) is None
+    assert cache.get("other", "query", embedding=[0.0, 1.0, 0.0]) is None
+
+def test_similarity_lookup_follows_evictions_and_invalidations():
+    cache = AnswerCache(max_size=2, similarity_threshold=0.9)
+    cache.put(make_answer("a", embedding=[1.0, 0.0], ref_doc_ids=["doc-a"]))
+    assert cache.get("engine", "query", embedding=[1.0, 0.0]).query == "a"
+    cache.invalidate_ref_docs(["doc-a"])
+    assert cache.get("engine", "query", embedding=[1.0, 0.0]) is None
+    cache.put(make_answer("b", embedding=[0.0, 1.0]))
+    cache.put(make_answer("c", embedding=[1.0, 0.0]))
+    cache.put(make_answer("d", embedding=[1.0, 1.0])) # evicts b
+    assert cache.get("engine", "query", embedding=[0.0, 1.0]) is None
+    assert cache.get("engine", "query", embedding=[1.0, 0.1]).query == "c"
+
+def test_answer_citing_a_deleted_node_is_answered_again():
+    from llama_index.core import VectorStoreIndex
+    from llama_index.core.base.response.schema import StreamingResponse
+    from llama_index.core.llms import MockLLM
+    from llama_index.core.schema import TextNode
+    from server.engine import CachedQueryEngine, SimpleRetrieverQueryEngine
+    from server.retriever import SimpleHybridRetriever
+
+    index = VectorStoreIndex([TextNode(id_=f"n{i}", text=f"apple banana {i}") for i in range(5)])
+    query_engine = SimpleRetrieverQueryEngine.from_args(retriever=SimpleHybridRetriever(index, top_k=2), llm=MockLLM(max_tokens=8))
+    cache = AnswerCache(similarity_threshold=None)
+    engine = CachedQueryEngine(query_engine, docstore=index.docstore, settings_key="test", answer_cache=cache)
+    first = engine.query("apple")
+    assert isinstance(engine.query("apple"), StreamingResponse) # from the cache
+    index.delete_nodes([first.source_nodes[0].node.node_id], delete_from_docstore=True)
+    response = engine.query("apple") # a source node is gone, answered again
+    assert not isinstance(response, StreamingResponse)
+    assert first.source_nodes[0].node.node_id not in {node.node.node_id for node in response.source_nodes}
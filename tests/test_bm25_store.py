@@ -0,0 +1,120 @@
+# BM25 index persistence: changes are appended to a log, replayed on load and compacted into the index file
+
+import os
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from server.stores import bm25_store
+from server.stores.bm25_store import BM25Index
+
+def whitespace_tokenizer(text):
+    return text.lower().split()
+
+def make_nodes(ref_doc_id, texts, start=0):
+    nodes = []
+    for i, text in enumerate(texts, start=start):
+        node = TextNode(id_=f"{ref_doc_id}-{i}", text=text, metadata={"file_name": f"{ref_doc_id}.txt"})
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id)
+        nodes.append(node)
+    return nodes
+
+def load(path):
+    index = BM25Index.from_persist_path(path)
+    index.tokenizer = whitespace_tokenizer
+    return index
+
+def state(index):
+    return index.postings, index.doc_lens, index.ref_docs, index.total_len
+
+def test_inserts_append_to_the_log_and_replay(tmp_path, monkeypatch):
+    monkeypatch.setattr(bm25_store, "BM25_LOG_COMPACT_RATIO", 100.0) # never compact
+    path = str(tmp_path / "bm25_index.json")
+    index = BM25Index(tokenizer=whitespace_tokenizer, persist_path=path)
+    index.add_nodes(make_nodes("a", ["apple banana", "banana cherry"]))
+    index.persist() # the first persist writes the index file
+    snapshot = open(path, encoding="utf-8").read()
+    index.add_nodes(make_nodes("b", ["cherry date", "date elderberry"]))
+    index.persist()
+    index.add_nodes(make_nodes("a", ["apple fig"], start=1)) # replaces a-1
+    index.delete_ref_docs(["b"])
+    index.persist()
+    assert open(path, encoding="utf-8").read() == snapshot # the index file was not rewritten
+    assert os.path.exists(path + ".log")
+    loaded = load(path)
+    assert state(loaded) == state(index)
+    assert loaded.get_scores(["apple"]).keys() == {"a-0", "a-1"}
+
+def test_log_is_compacted_into_a_new_generation(tmp_path, monkeypatch):
+    monkeypatch.setattr(bm25_store, "BM25_LOG_COMPACT_RATIO", 0.5)
+    path = str(tmp_path / "bm25_index.json")
+    index = BM25Index(tokenizer=whitespace_tokenizer, persist_path=path)
+    index.add_nodes(make_nodes("a", ["apple banana"]))
+    index.persist()
+    for i in range(20):
+        index.add_nodes(make_nodes(f"doc{i}", [f"word{i} banana cherry"]))
+        index.persist()
+        assert not os.path.exists(path + ".log") or os.path.getsize(path + ".log") <= 0.5 * os.path.getsize(path)
+    assert load(path)._generation > 1
+    assert state(load(path)) == state(index)
+
+def test_stale_and_torn_records_are_not_replayed(tmp_path, monkeypatch):
+    monkeypatch.setattr(bm25_store, "BM25_LOG_COMPACT_RATIO", 100.0)
+    path = str(tmp_path / "bm25_index.json")
+    index = BM25Index(tokenizer=whitespace_tokenizer, persist_path=path)
+    index.add_nodes(make_nodes("a", ["apple banana"]))
+    index.persist()
+    index.add_nodes(make_nodes("b", ["banana cherry"]))
+    index.persist()
+    stale_log = open(path + ".log", encoding="utf-8").read()
+    # A crash after a compaction replaced the index file but before it removed the log
+    index.delete_ref_docs(["b"])
+    index.compact()
+    with open(path + ".log", "w", encoding="utf-8") as f:
+        f.write(stale_log)
+    assert state(load(path)) == state(index)
+    # A crash while appending leaves a partial record, which is dropped
+    index.add_nodes(make_nodes("c", ["cherry date"]))
+    index.persist()
+    with open(path + ".log", "a", encoding="utf-8") as f:
+        f.write('{"generation": 1, "op": "add", "nod')
+    assert state(load(path)) == state(index)
+
+def test_reingested_documents_replace_their_nodes():
+    # A changed document ingested again gets new node ids: its old nodes must leave the BM25 index,
+    # or the BM25 leg keeps returning ids that are gone from the docstore
+    from llama_index.core import Document, QueryBundle
+    from server.index import KB_REGISTRY, IndexManager
+    from server.ingestion import AdvancedIngestionPipeline
+    from server.retriever import SimpleBM25Retriever
+
+    def ingest(manager, version):
+        documents = [
+            Document(text=" ".join(f"Version {version} sentence {i} about apples in document {d}." for i in range(150)), id_=f"https://example.com/{d}")
+            for d in range(3)
+        ]
+        with manager._locked_kb() as kb:
+            nodes = AdvancedIngestionPipeline(storage_context=kb.storage_context, stages=["split"]).run(documents=documents)
+            manager.insert_nodes(nodes)
+
+    manager = IndexManager("bm25_reingest")
+    try:
+        for version in range(3):
+            ingest(manager, version)
+        kb = manager.knowledge_base
+        docstore_node_ids = {node_id for node_id, node in kb.storage_context.docstore.docs.items() if node.ref_doc_id is not None}
+        assert set(kb.bm25_index.doc_lens) == docstore_node_ids
+        assert set(load(kb.bm25_index.persist_path).doc_lens) == docstore_node_ids
+        retriever = SimpleBM25Retriever.from_defaults(manager.index, similarity_top_k=5, bm25_index=kb.bm25_index)
+        assert len(retriever.retrieve(QueryBundle("apples"))) == 5
+    finally:
+        KB_REGISTRY.unload("bm25_reingest")
+
+def test_retriever_skips_nodes_missing_from_the_docstore():
+    from llama_index.core import QueryBundle
+    from llama_index.core.storage.docstore import SimpleDocumentStore
+    from server.retriever import SimpleBM25Retriever
+    nodes = make_nodes("a", ["apple banana", "apple cherry", "apple date"])
+    docstore = SimpleDocumentStore()
+    docstore.add_documents(nodes[1:])
+    index = BM25Index(tokenizer=whitespace_tokenizer, persist_path=None)
+    index.add_nodes(nodes)
+    retriever = SimpleBM25Retriever(docstore=docstore, bm25_index=index, similarity_top_k=3)
+    assert sorted(result.node.node_id for result in retriever.retrieve(QueryBundle("apple"))) == ["a-1", "a-2"]
@@ -0,0 +1,21 @@
+# Score fusion of the hybrid retriever
+
+import numpy as np
+import pytest
+from server.retriever import FUSION_MODES, fuse_scores
+
+SCORES = np.array([
+    [0.9, 0.5, np.nan],
+    [np.nan, 2.0, 1.0],
+])
+
+@pytest.mark.parametrize("weights", [[0.0, 0.0], [-1.0, 2.0], [0.5, np.nan], [np.inf, 1.0]])
+@pytest.mark.parametrize("mode", [mode.value for mode in FUSION_MODES])
+def test_invalid_weights_are_rejected(mode, weights):
+    with pytest.raises(ValueError):
+        fuse_scores(SCORES, mode, weights)
+
+def test_weights_are_normalized():
+    fused = fuse_scores(SCORES, FUSION_MODES.RELATIVE_SCORE.value, [3.0, 1.0])
+    np.testing.assert_allclose(fused, [0.75, 0.25, 0.0])
+    np.testing.assert_allclose(fuse_scores(SCORES, FUSION_MODES.RELATIVE_SCORE.value, [1.0, 0.0]), [1.0, 0.0, 0.0])
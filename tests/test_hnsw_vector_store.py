@@ -0,0 +1,60 @@
+# HNSW vector store: label reuse after deletions, and filtered searches the graph cannot satisfy
+
+import numpy as np
+import pytest
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+pytest.importorskip("hnswlib")
+
+from server.stores.hnsw_vector_store import HnswVectorStore
+from server.stores.metadata_index import build_metadata_filters
+
+DIM = 16
+
+def make_nodes(embeddings, start=0, ref_doc_id=None, ext=lambda i: "txt"):
+    nodes = []
+    for i, embedding in enumerate(embeddings, start=start):
+        node = TextNode(id_=f"node-{i}", embedding=embedding.tolist(), metadata={"file_name": f"file-{i}.{ext(i)}"})
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id or f"doc-{i}")
+        nodes.append(node)
+    return nodes
+
+def test_deleted_labels_are_reused():
+    rng = np.random.default_rng(0)
+    store = HnswVectorStore()
+    store.add(make_nodes(rng.standard_normal((100, DIM))))
+    for round in range(5):
+        store.delete_nodes([f"node-{i}" for i in range(100 * round, 100 * round + 50)])
+        store.add(make_nodes(rng.standard_normal((50, DIM)), start=100 * (round + 1)))
+        store.delete_nodes([f"node-{i}" for i in range(100 * round + 50, 100 * round + 100)])
+        store.add(make_nodes(rng.standard_normal((50, DIM)), start=100 * (round + 1) + 50))
+    assert len(store._node_ids) == 100
+    assert store.client.get_current_count() == 100
+    embedding = store.get("node-520")
+    result = store.query(VectorStoreQuery(query_embedding=embedding, similarity_top_k=1))
+    assert result.ids == ["node-520"]
+
+def test_deleted_ref_doc_does_not_delete_reused_labels():
+    rng = np.random.default_rng(1)
+    store = HnswVectorStore()
+    store.add(make_nodes(rng.standard_normal((3, DIM)), ref_doc_id="old"))
+    store.delete_nodes(["node-0", "node-1"])
+    store.add(make_nodes(rng.standard_normal((2, DIM)), start=10, ref_doc_id="new"))
+    store.delete("old")
+    result = store.query(VectorStoreQuery(query_embedding=rng.standard_normal(DIM).tolist(), similarity_top_k=10))
+    assert sorted(result.ids) == ["node-10", "node-11"]
+
+def test_filtered_search_with_too_few_reachable_candidates():
+    # A sparse graph, thinned by deletions: the filtered graph search reaches fewer than top_k
+    # of the allowed nodes and hnswlib raises, the store scores the candidates exactly instead
+    rng = np.random.default_rng(0)
+    store = HnswVectorStore(m=2, ef_construction=4, ef_search=1, filter_brute_force=0)
+    store.add(make_nodes(rng.standard_normal((3000, DIM)), ext=lambda i: "pdf" if i % 20 == 0 else "txt"))
+    store.delete_nodes([f"node-{i}" for i in range(3000) if i % 10])
+    filters = build_metadata_filters(file_types=["pdf"])
+    for _ in range(5):
+        result = store.query(VectorStoreQuery(query_embedding=rng.standard_normal(DIM).tolist(), similarity_top_k=140, filters=filters))
+        assert len(result.ids) == 140
+        assert all(int(node_id.split("-")[1]) % 20 == 0 for node_id in result.ids)
+        assert result.similarities == sorted(result.similarities, reverse=True)
@@ -0,0 +1,52 @@
+# Hybrid retrieval: dropped legs and the answer cache
+
+import time
+import asyncio
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import pytest
+from llama_index.core import VectorStoreIndex
+from llama_index.core.llms import MockLLM
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import TextNode
+from server.engine import CachedQueryEngine, SimpleRetrieverQueryEngine
+from server.retriever import SimpleHybridRetriever
+from server.stores.answer_cache import AnswerCache
+
+class SlowRetriever(BaseRetriever):
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.calls = 0
+        super().__init__()
+
+    def _retrieve(self, query_bundle):
+        self.calls += 1
+        time.sleep(self.delay)
+        return []
+
+def build_engine(slow_vector_leg: bool):
+    index = VectorStoreIndex([TextNode(id_=f"n{i}", text=f"apple banana {i}") for i in range(5)])
+    retriever = SimpleHybridRetriever(index, top_k=2, timeout=0.3)
+    if slow_vector_leg:
+        retriever.vector_retriever = SlowRetriever(delay=1.0)
+    query_engine = SimpleRetrieverQueryEngine.from_args(retriever=retriever, llm=MockLLM(max_tokens=8))
+    answer_cache = AnswerCache(similarity_threshold=None)
+    return CachedQueryEngine(query_engine, docstore=index.docstore, settings_key="test", answer_cache=answer_cache), answer_cache
+
+@pytest.mark.parametrize("slow_vector_leg", [False, True])
+def test_degraded_answers_are_not_cached(slow_vector_leg):
+    engine, answer_cache = build_engine(slow_vector_leg)
+    response = engine.query("apple")
+    assert len(response.source_nodes) > 0 # answered from the BM25 leg when the vector leg is dropped
+    assert (answer_cache.get("test", "apple") is None) == slow_vector_leg
+
+@pytest.mark.parametrize("slow_vector_leg", [False, True])
+def test_degraded_answers_are_not_cached_async(slow_vector_leg):
+    engine, answer_cache = build_engine(slow_vector_leg)
+    asyncio.run(engine.aquery("apple"))
+    assert (answer_cache.get("test", "apple") is None) == slow_vector_leg
+
+def test_leg_queued_past_its_deadline_does_not_run():
+    retriever = SlowRetriever(delay=0)
+    with pytest.raises(FutureTimeoutError):
+        SimpleHybridRetriever._timed_retrieve(retriever, "apple", deadline=time.monotonic() - 1)
+    assert retriever.calls == 0
@@ -0,0 +1,19 @@
+# Import-time budget: importing the server modules in a fresh interpreter stays within IMPORT_TIME_BUDGET
+# and leaves DEFERRED_IMPORTS unloaded, in development and in production (where the caches use Redis)
+
+import json
+import pytest
+from benchmarks.import_time import run_child
+from config import IMPORT_TIME_BUDGET, DEFERRED_IMPORTS
+
+@pytest.mark.parametrize("environment", ["development", "production"])
+@pytest.mark.parametrize("module", ["server.engine", "server.models.embedding"])
+def test_import_within_budget(module, environment, monkeypatch):
+    monkeypatch.setenv("THINKRAG_ENV", environment)
+    times = []
+    for _ in range(3): # the best of fresh interpreters, like the benchmark
+        result = json.loads(run_child(module).stdout.strip().splitlines()[-1])
+        times.append(result["elapsed"])
+        loaded = [name for name in DEFERRED_IMPORTS if name in result["modules"]]
+        assert loaded == [], f"imported eagerly: {loaded}"
+    assert min(times) <= IMPORT_TIME_BUDGET
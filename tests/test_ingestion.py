@@ -0,0 +1,37 @@
+# Parallel ingestion stages give the same nodes as serial ones, and fall back to serial when the pool breaks
+
+import os
+import multiprocessing
+from typing import List
+from llama_index.core import Document
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode, TransformComponent
+from server.ingestion import ParallelTransformation
+
+def make_documents():
+    return [
+        Document(text=" ".join(f"Sentence {i} of document {d} is about retrieval." for i in range(40)), id_=f"doc-{d}")
+        for d in range(6)
+    ]
+
+def node_contents(nodes):
+    return [(node.ref_doc_id, node.get_content(), node.start_char_idx, node.end_char_idx) for node in nodes]
+
+class CrashInWorker(TransformComponent):
+    # Kills the worker process it runs in, works in the main process
+    def __call__(self, nodes: List[BaseNode], **kwargs) -> List[BaseNode]:
+        if multiprocessing.parent_process() is not None:
+            os._exit(1)
+        return nodes
+
+def test_parallel_split_equals_serial_split():
+    splitter = SentenceSplitter(chunk_size=64, chunk_overlap=8)
+    serial = splitter(make_documents())
+    parallel = ParallelTransformation(transformation=splitter, num_workers=3)(make_documents())
+    assert len(serial) > len(make_documents())
+    assert node_contents(parallel) == node_contents(serial)
+
+def test_broken_pool_falls_back_to_serial():
+    documents = make_documents()
+    nodes = ParallelTransformation(transformation=CrashInWorker(), num_workers=2)(documents)
+    assert [node.id_ for node in nodes] == [document.id_ for document in documents]
@@ -0,0 +1,55 @@
+# Metadata filters on vector stores that cannot apply them (only EQ filters, like ElasticsearchStore)
+
+import pytest
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores import SimpleVectorStore
+from server.retriever import PostFilteredVectorRetriever, SimpleHybridRetriever, create_vector_retriever
+from server.stores.metadata_index import build_metadata_filters
+
+class EqOnlyVectorStore(SimpleVectorStore):
+    # Like ElasticsearchStore, which converts the filters with MetadataFilters.legacy_filters()
+    def query(self, query, **kwargs):
+        if query.filters is not None:
+            query.filters.legacy_filters() # ValueError for operators other than EQ
+        return super().query(query, **kwargs)
+
+def build_index(num_pdf=50, num_txt=3):
+    # Nodes without the derived keys, like nodes ingested before they existed
+    nodes = [
+        TextNode(id_=f"pdf{i}", text=f"apple report {i}", metadata={"file_name": f"report{i}.pdf", "creation_date": "2024-01-10"})
+        for i in range(num_pdf)
+    ] + [
+        TextNode(id_=f"txt{i}", text=f"apple notes {i}", metadata={"file_name": f"notes{i}.txt", "creation_date": "2024-06-10"})
+        for i in range(num_txt)
+    ]
+    storage_context = StorageContext.from_defaults(vector_store=EqOnlyVectorStore())
+    return VectorStoreIndex(nodes, storage_context=storage_context)
+
+def test_eq_only_store_rejects_pushed_down_filters():
+    index = build_index()
+    retriever = create_vector_retriever(index, similarity_top_k=2, filters=None)
+    retriever._filters = build_metadata_filters(file_types=["txt"])
+    with pytest.raises(ValueError):
+        retriever.retrieve("apple")
+
+def test_filters_are_applied_to_retrieved_nodes():
+    index = build_index()
+    filters = build_metadata_filters(file_types=["TXT"], created_after="2024-06-01")
+    retriever = create_vector_retriever(index, similarity_top_k=2, filters=filters)
+    assert isinstance(retriever, PostFilteredVectorRetriever)
+    nodes = retriever.retrieve("apple")
+    assert len(nodes) == 2
+    assert all(node.node.metadata["file_name"].endswith(".txt") for node in nodes)
+
+def test_candidates_grow_until_enough_match():
+    index = build_index(num_pdf=50, num_txt=3)
+    retriever = PostFilteredVectorRetriever(index, build_metadata_filters(file_types=["txt"]), similarity_top_k=3, fetch_factor=1, max_k=100)
+    assert sorted(node.node_id for node in retriever.retrieve("apple")) == ["txt0", "txt1", "txt2"]
+
+def test_hybrid_retriever_keeps_the_vector_leg():
+    index = build_index()
+    retriever = SimpleHybridRetriever(index, top_k=2, filters=build_metadata_filters(file_types=["txt"]))
+    nodes = retriever.retrieve("apple")
+    assert retriever.last_latencies["vector"] is not None
+    assert len(nodes) > 0 and all(node.node.metadata["file_name"].endswith(".txt") for node in nodes)
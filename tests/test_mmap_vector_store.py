@@ -0,0 +1,55 @@
+# Memory-mapped vector store: queries running while other threads add and delete nodes
+
+import threading
+import numpy as np
+import pytest
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from server.stores.mmap_vector_store import MmapVectorStore
+
+DIM = 16
+
+def make_nodes(embeddings, start=0):
+    nodes = []
+    for i, embedding in enumerate(embeddings, start=start):
+        node = TextNode(id_=f"node-{i}", embedding=embedding.tolist(), metadata={"file_name": f"file-{i}.txt"})
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=f"doc-{i}")
+        nodes.append(node)
+    return nodes
+
+@pytest.mark.parametrize("quantization", [None, "int8"])
+def test_queries_during_adds_and_deletes(quantization):
+    rng = np.random.default_rng(0)
+    store = MmapVectorStore(quantization=quantization)
+    store.add(make_nodes(rng.standard_normal((100, DIM))))
+    batches = [make_nodes(rng.standard_normal((7, DIM)), start=100 + 7 * i) for i in range(300)]
+    query_embedding = rng.standard_normal(DIM).tolist()
+    errors = []
+    done = threading.Event()
+
+    def write():
+        try:
+            for batch in batches:
+                store.add(batch)
+                store.delete_nodes([batch[0].node_id]) # deleted rows give the queries a mask
+        finally:
+            done.set()
+
+    def read():
+        while not done.is_set():
+            try:
+                result = store.query(VectorStoreQuery(query_embedding=query_embedding, similarity_top_k=10))
+                assert len(result.ids) == 10
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert store.num_vectors == 100 + 6 * len(batches)
+    result = store.query(VectorStoreQuery(query_embedding=store.get("node-101"), similarity_top_k=1))
+    assert result.ids == ["node-101"]
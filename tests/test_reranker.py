@@ -0,0 +1,52 @@
+# Reranker registry: a model loads once, and loading one model does not block the others
+
+import time
+import threading
+from server.models.reranker import RerankerRegistry
+
+class SlowRegistry(RerankerRegistry):
+    def __init__(self, load_seconds):
+        super().__init__(idle_timeout=None)
+        self.load_seconds = load_seconds
+        self.loads = []
+
+    def _load(self, model_path, device, max_length, backend):
+        self.loads.append(model_path)
+        time.sleep(self.load_seconds[model_path])
+        return object()
+
+def get_concurrently(registry, model_paths):
+    models = [None] * len(model_paths)
+    def get(i):
+        models[i] = registry.get(model_paths[i], "cpu")
+    threads = [threading.Thread(target=get, args=(i,)) for i in range(len(model_paths))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return models
+
+def test_model_is_loaded_once():
+    registry = SlowRegistry({"a": 0.2})
+    models = get_concurrently(registry, ["a"] * 4)
+    assert registry.loads == ["a"]
+    assert all(model is models[0] for model in models)
+
+def test_loaded_model_is_served_while_another_loads():
+    registry = SlowRegistry({"a": 0.0, "b": 1.0})
+    registry.get("a", "cpu")
+    loading = threading.Thread(target=registry.get, args=("b", "cpu"))
+    loading.start()
+    time.sleep(0.1) # b is loading
+    start = time.monotonic()
+    registry.get("a", "cpu")
+    assert time.monotonic() - start < 0.5
+    assert registry.loaded_models() == ["a"]
+    loading.join()
+
+def test_models_load_in_parallel():
+    registry = SlowRegistry({"a": 0.5, "b": 0.5})
+    start = time.monotonic()
+    get_concurrently(registry, ["a", "b"])
+    assert time.monotonic() - start < 0.9
+    assert sorted(registry.loaded_models()) == ["a", "b"]
@@ -0,0 +1,62 @@
+# Storage log: replaying inserts over the last snapshot gives the stores the ingestion left behind
+
+from llama_index.core import Document, Settings, StorageContext, VectorStoreIndex
+from llama_index.core.ingestion import DocstoreStrategy, IngestionPipeline
+from llama_index.core.node_parser import SentenceSplitter
+from server.stores.storage_log import create_storage_log
+
+def ingest(storage_context, index, storage_log, documents):
+    # Like IndexManager: the pipeline upserts documents and nodes, then the nodes are inserted and logged
+    pipeline = IngestionPipeline(
+        transformations=[SentenceSplitter(chunk_size=64, chunk_overlap=0), Settings.embed_model],
+        docstore=storage_context.docstore,
+        vector_store=storage_context.vector_store,
+        docstore_strategy=DocstoreStrategy.UPSERTS,
+    )
+    nodes = pipeline.run(documents=documents)
+    index.insert_nodes(nodes)
+    storage_log.log_insert(index.index_id, nodes)
+
+def make_documents(version):
+    return [
+        Document(text=" ".join(f"Version {version} sentence {i} of document {d}." for i in range(20)), id_=f"doc-{d}")
+        for d in range(3)
+    ]
+
+def test_replay_restores_documents_and_nodes(tmp_path):
+    persist_dir = str(tmp_path / "storage")
+    storage_context = StorageContext.from_defaults()
+    index = VectorStoreIndex([], storage_context=storage_context)
+    storage_context.persist(persist_dir=persist_dir)
+    storage_log = create_storage_log(storage_context, persist_dir=persist_dir)
+    ingest(storage_context, index, storage_log, make_documents(1))
+    ingest(storage_context, index, storage_log, make_documents(2)) # re-ingested documents replace their nodes
+
+    replayed = StorageContext.from_defaults(persist_dir=persist_dir)
+    create_storage_log(replayed, persist_dir=persist_dir)
+    assert replayed.docstore.docs.keys() == storage_context.docstore.docs.keys()
+    assert replayed.docstore.get_document("doc-0").text == make_documents(2)[0].text
+    assert replayed.docstore.get_all_document_hashes() == storage_context.docstore.get_all_document_hashes()
+    assert replayed.vector_store.data.embedding_dict.keys() == storage_context.vector_store.data.embedding_dict.keys()
+
+def test_live_index_equals_replayed_index_after_reingest():
+    # The nodes of a re-ingested document replace its old nodes in the running process as in the replay
+    from server.index import KB_REGISTRY, IndexManager
+    from server.ingestion import AdvancedIngestionPipeline
+
+    manager = IndexManager("storage_log_reingest")
+    try:
+        for version in range(3):
+            with manager._locked_kb() as kb:
+                pipeline = AdvancedIngestionPipeline(storage_context=kb.storage_context, stages=["split"])
+                manager.insert_nodes(pipeline.run(documents=make_documents(version)))
+        kb = manager.knowledge_base
+        live_node_ids = set(manager.index.index_struct.nodes_dict.values())
+        docstore_node_ids = {node_id for node_id, node in kb.storage_context.docstore.docs.items() if node.ref_doc_id is not None}
+        assert live_node_ids == docstore_node_ids
+        KB_REGISTRY.unload("storage_log_reingest")
+        replayed = manager.load_index() # loads the snapshot and replays the log
+        assert set(replayed.index_struct.nodes_dict.values()) == live_node_ids
+        assert manager.knowledge_base.storage_context.docstore.docs.keys() == kb.storage_context.docstore.docs.keys()
+    finally:
+        KB_REGISTRY.unload("storage_log_reingest")
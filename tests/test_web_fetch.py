@@ -0,0 +1,55 @@
+# Concurrent web fetching against the local stub server of benchmarks/web_fetch.py
+
+import threading
+import pytest
+from benchmarks.web_fetch import StubServer
+from server.utils.web_fetch import WebFetcher
+
+@pytest.fixture
+def server():
+    server = StubServer(delay=0.05, hang=3.0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+def make_fetcher(**kwargs):
+    options = dict(max_workers=8, per_host=8, timeout=(1, 0.5), total_timeout=2, retries=2, backoff=0.01)
+    options.update(kwargs)
+    return WebFetcher(**options)
+
+def test_results_in_order_with_retries_and_timeouts(server):
+    base = server.base_url
+    urls = [f"{base}/hang", f"{base}/missing"] + [f"{base}/page/{i}" for i in range(10)] + [f"{base}/flaky/{i}" for i in range(3)]
+    fetcher = make_fetcher()
+    results = fetcher.fetch_all(urls)
+    fetcher.close()
+    assert [result.url for result in results] == urls
+    by_url = {result.url: result for result in results}
+    hang, missing = by_url[f"{base}/hang"], by_url[f"{base}/missing"]
+    assert not hang.ok and hang.attempts > 1 and hang.elapsed < server.hang
+    assert not missing.ok and missing.attempts == 1
+    for i in range(10):
+        assert f"/page/{i}<" in by_url[f"{base}/page/{i}"].response.text
+    for i in range(3):
+        flaky = by_url[f"{base}/flaky/{i}"]
+        assert flaky.ok and flaky.attempts == 2 and "recovered" in flaky.response.text
+
+def test_per_host_limit(server):
+    fetcher = make_fetcher(per_host=2)
+    results = fetcher.fetch_all([f"{server.base_url}/page/{i}" for i in range(12)])
+    fetcher.close()
+    assert all(result.ok for result in results)
+    assert server.max_in_flight == 2
+
+def test_reader_urls_are_limited_by_the_host_of_the_page(server):
+    # The stub server plays the reader service: each page of a different host gets its own slot
+    reader = f"{server.base_url}/page/read/"
+    fetcher = make_fetcher(per_host=1, reader_prefixes=(reader,))
+    results = fetcher.fetch_all([f"{reader}https://host-{i}.example/doc" for i in range(8)])
+    assert all(result.ok for result in results)
+    assert server.max_in_flight > 1
+    server.max_in_flight = 0
+    results = fetcher.fetch_all([f"{reader}https://same-host.example/doc/{i}" for i in range(8)])
+    fetcher.close()
+    assert all(result.ok for result in results)
+    assert server.max_in_flight == 1